@@ -0,0 +1,7 @@
+"""
+效能基準測試 (合成資料 + 本機模擬 API)
+
+    python -m benchmarks.run --size 10k                       # 10k / 100k / 1m
+    python -m benchmarks.run compare old.json new.json        # 比較兩次結果
+    python -m benchmarks.moa_stub --rows 100000 --latency 0.2 # 單獨啟動模擬 API
+"""
@@ -0,0 +1,153 @@
+"""
+本機模擬的農業部走失動物 API ($top / $skip 分頁)
+可設定延遲與失敗率，用於量測 fetcher 與重試行為；資料來自 benchmarks.synthetic
+案件的 PICTURE 指向本 stub 的 /pets/<seed>/<編號>.jpg，回傳合成照片 (照片索引測試用，需 Pillow)
+
+    python -m benchmarks.moa_stub --rows 100000 --port 8765 --latency 0.2 --failure-rate 0.05
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from functools import lru_cache
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from benchmarks.synthetic import pet_page, pet_image
+
+class MOAStub:
+    """
+    :param total: 資料總筆數
+    :param latency: 每個請求的延遲秒數
+    :param failure_rate: 回傳 503 的機率 (0~1)
+    :param seed: 合成資料的 seed
+    :param crosspost_ratio: 跨案件重複刊登 (同一張照片) 的比例
+    """
+    def __init__(self, total, latency=0.0, failure_rate=0.0, seed=0, host="127.0.0.1", port=0,
+                 crosspost_ratio=0.0):
+        self.total = total
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.seed = seed
+        self.crosspost_ratio = crosspost_ratio
+        self.requests = 0
+        self.failures = 0
+        self.photo_requests = 0
+        self._rng = random.Random(f"stub:{seed}")
+        self._lock = threading.Lock()
+        self._page = lru_cache(maxsize=64)(self._render_page)
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def url(self):
+        return f"{self.base_url}/Service/OpenData/TransService.aspx?UnitId=IFJomqVzyB0i"
+
+    def _render_page(self, skip, top):
+        rows = pet_page(skip, top, self.total, seed=self.seed, crosspost_ratio=self.crosspost_ratio,
+                        picture_base=f"{self.base_url}/pets")
+        return json.dumps(rows, ensure_ascii=False).encode("utf-8")
+
+    def _photo(self, path, query):
+        """/pets/<seed>/<編號>.jpg[?v=n] -> JPEG；格式不符回傳 None"""
+        parts = path.strip("/").split("/")
+        if len(parts) != 3 or not parts[2].endswith(".jpg"):
+            return None
+        try:
+            seed, number = int(parts[1]), int(parts[2][:-4])
+            variant = int(query.get("v", ["0"])[0])
+        except ValueError:
+            return None
+        return pet_image(seed, number, variant)
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                query = parse_qs(parsed.query)
+                if parsed.path.startswith("/pets/"):
+                    return self._send_photo(parsed.path, query)
+                with stub._lock:
+                    stub.requests += 1
+                    fail = stub._rng.random() < stub.failure_rate
+                    if fail:
+                        stub.failures += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if fail:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                try:
+                    top = int(query.get("$top", ["1000"])[0])
+                    skip = int(query.get("$skip", ["0"])[0])
+                except ValueError:
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+                body = stub._page(skip, top)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_photo(self, path, query):
+                with stub._lock:
+                    stub.photo_requests += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                body = stub._photo(path, query)
+                if body is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本機模擬農業部走失動物 API")
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--crosspost-ratio", type=float, default=0.0)
+    args = parser.parse_args()
+
+    stub = MOAStub(args.rows, latency=args.latency, failure_rate=args.failure_rate,
+                   seed=args.seed, host="0.0.0.0", port=args.port, crosspost_ratio=args.crosspost_ratio)
+    print(f"🧪 MOA stub: {stub.url} ({args.rows} 筆)")
+    stub._server.serve_forever()
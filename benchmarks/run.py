@@ -0,0 +1,676 @@
+"""
+效能基準測試：在暫存目錄建立合成資料庫，依序執行各情境並輸出 JSON 結果
+
+    python -m benchmarks.run --size 10k
+    python -m benchmarks.run --size 100k --only get_recent_pets,api_pets
+    python -m benchmarks.run compare benchmarks/results/abc123_10k.json benchmarks/results/def456_10k.json
+
+結果預設寫到 benchmarks/results/<commit>_<size>.json；compare 列出兩份結果各指標的變化
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import db
+from fetcher import MOAClient
+from benchmarks.synthetic import SIZES, CHUNK_SIZE, iter_pet_chunks, generate_clinics
+from benchmarks.moa_stub import MOAStub
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _summary(samples, rows=None):
+    """延遲樣本 (秒) -> 統計值；rows 為處理筆數時另外算每秒筆數"""
+    ordered = sorted(samples)
+    total = sum(ordered)
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000
+
+    result = {
+        "n": len(ordered),
+        "total_s": round(total, 4),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p50_ms": round(pct(50), 3),
+        "p95_ms": round(pct(95), 3),
+        "p99_ms": round(pct(99), 3),
+    }
+    if rows is not None and total:
+        result["rows"] = rows
+        result["rows_per_s"] = round(rows / total, 1)
+    return result
+
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+class Context:
+    """一次基準測試的共用狀態 (暫存目錄、資料庫路徑、資料量)"""
+    def __init__(self, total, seed, workdir, fetch_rows, concurrency, requests):
+        self.total = total
+        self.seed = seed
+        self.workdir = workdir
+        self.fetch_rows = fetch_rows
+        self.concurrency = concurrency
+        self.requests = requests
+        self.db_path = os.path.join(workdir, "bench.db")
+        self.client = MOAClient(raw_cache=False)
+
+    def use_db(self, path):
+        db.DB_NAME = path
+        db.init_db()
+
+    def chunks(self, limit_rows=None):
+        return iter_pet_chunks(limit_rows or self.total, seed=self.seed)
+
+def scenario_clean_data(ctx):
+    """MOAClient._clean_data：每塊 1000 筆原始資料的清洗"""
+    samples = []
+    rows = 0
+    for chunk in ctx.chunks(min(ctx.total, 50 * CHUNK_SIZE)):
+        elapsed, clean = _timed(ctx.client._clean_data, chunk)
+        samples.append(elapsed)
+        rows += len(clean)
+    return _summary(samples, rows)
+
+def scenario_upsert_pet(ctx):
+    """
+    寫入：逐筆 upsert_pet (1000 筆，空資料庫) 與整批 upsert_pets (全部資料)，
+    再以相同資料重跑一次 (指紋未變，應全數略過)
+    之後的情境使用這裡建立的資料庫
+    """
+    ctx.use_db(os.path.join(ctx.workdir, "single.db"))
+    sample = ctx.client._clean_data(next(iter(ctx.chunks(CHUNK_SIZE))))
+    single = [_timed(db.upsert_pet, pet)[0] for pet in sample]
+
+    ctx.use_db(ctx.db_path)
+    bulk = []
+    unchanged = []
+    rows = 0
+    for chunk in ctx.chunks():
+        clean = ctx.client._clean_data(chunk)
+        bulk.append(_timed(db.upsert_pets, clean)[0])
+        rows += len(clean)
+    for chunk in ctx.chunks():
+        clean = ctx.client._clean_data(chunk)
+        unchanged.append(_timed(db.upsert_pets, clean)[0])
+    clinics = generate_clinics(max(ctx.total // 20, 100), seed=ctx.seed)
+    clinic_time, _ = _timed(db.replace_clinics, clinics)
+
+    return {
+        "single_row": _summary(single, len(sample)),
+        "bulk": _summary(bulk, rows),
+        "bulk_unchanged": _summary(unchanged, rows),
+        "replace_clinics": {"rows": len(clinics), "total_s": round(clinic_time, 4)},
+    }
+
+def scenario_close_missing_pets(ctx):
+    """close_missing_pets：在資料庫副本上關閉約 10% 的 Open 案件"""
+    with db.write_connection() as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    with db.read_connection() as conn:
+        open_ids = [row[0] for row in conn.execute("SELECT id FROM lost_pets WHERE status = 'Open'")]
+    active = [pet_id for i, pet_id in enumerate(open_ids) if i % 10]
+
+    copy_path = os.path.join(ctx.workdir, "close.db")
+    shutil.copy(ctx.db_path, copy_path)
+    ctx.use_db(copy_path)
+    try:
+        elapsed, closed = _timed(db.close_missing_pets, active)
+    finally:
+        ctx.use_db(ctx.db_path)
+    return {"open": len(open_ids), "closed": closed, "total_s": round(elapsed, 4)}
+
+RECENT_QUERIES = {
+    "default": {},
+    "city": {"city_filter": "台北"},
+    "district": {"city_filter": "台中", "district_filter": "西屯"},
+    "type": {"type_filter": "貓"},
+    "fts": {"q": "米克斯"},
+    "fts_short": {"q": "黑"},
+}
+
+def scenario_get_recent_pets(ctx, repeat=50):
+    """get_recent_pets：常見查詢 (最近 30 天、每頁 50 筆)，以及依 cursor 連續翻 5 頁"""
+    results = {}
+    for name, kwargs in RECENT_QUERIES.items():
+        samples = [_timed(db.get_recent_pets, days=30, limit=50, **kwargs)[0] for _ in range(repeat)]
+        results[name] = _summary(samples)
+
+    samples = []
+    for _ in range(repeat // 5 or 1):
+        cursor = None
+        for _ in range(5):
+            elapsed, rows = _timed(db.get_recent_pets, days=365, limit=50, cursor=cursor)
+            samples.append(elapsed)
+            if not rows:
+                break
+            cursor = db.pet_cursor(rows[-1])
+    results["paged"] = _summary(samples)
+    return results
+
+def scenario_pet_snapshot(ctx, repeat=200):
+    """
+    Open 案件記憶體快照：建立時間、記憶體用量 (對照全部 Open 案件轉成 dict 的大小)，
+    以及 get_recent_pets 常見查詢 (不含關鍵字) 在 SQLite 與快照上的吞吐量；兩邊結果須完全相同
+    """
+    import tracemalloc
+    import pet_snapshot
+
+    load_time, loaded = _timed(db.load_open_pets)
+    build_time, snapshot = _timed(pet_snapshot.PetSnapshot, *loaded)
+    del loaded
+
+    tracemalloc.start()
+    as_dicts = db.get_recent_pets(days=0)
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del as_dicts
+
+    memory = snapshot.memory_bytes()
+    results = {
+        "rows": len(snapshot),
+        "load_s": round(load_time, 4),
+        "build_s": round(build_time, 4),
+        "memory_bytes": memory,
+        "bytes_per_row": round(memory / len(snapshot), 1) if len(snapshot) else 0,
+        "dict_rows_bytes": dict_bytes,
+        "queries": {},
+    }
+    for name, kwargs in RECENT_QUERIES.items():
+        if "q" in kwargs:
+            continue
+        sql = [_timed(db.get_recent_pets, days=30, limit=50, **kwargs) for _ in range(repeat)]
+        mem = [_timed(snapshot.query, days=30, limit=50, **kwargs) for _ in range(repeat)]
+        sql_summary = _summary([elapsed for elapsed, _ in sql])
+        mem_summary = _summary([elapsed for elapsed, _ in mem])
+        results["queries"][name] = {
+            "sql": dict(sql_summary, qps=round(repeat / sql_summary["total_s"], 1)),
+            "snapshot": dict(mem_summary, qps=round(repeat / mem_summary["total_s"], 1)),
+            "speedup": round(sql_summary["total_s"] / mem_summary["total_s"], 1),
+            "identical": sql[0][1] == mem[0][1],
+        }
+
+    # 依 cursor 連續翻 5 頁 (最近 365 天)
+    paged = {}
+    for label, query in (("sql", db.get_recent_pets), ("snapshot", snapshot.query)):
+        samples = []
+        pages = []
+        for _ in range(repeat // 5 or 1):
+            cursor = None
+            pages = []
+            for _ in range(5):
+                elapsed, rows = _timed(query, days=365, limit=50, cursor=cursor)
+                samples.append(elapsed)
+                pages.append(rows)
+                if not rows:
+                    break
+                cursor = db.pet_cursor(rows[-1])
+        summary = _summary(samples)
+        paged[label] = (dict(summary, qps=round(len(samples) / summary["total_s"], 1)), pages)
+    results["queries"]["paged"] = {
+        "sql": paged["sql"][0],
+        "snapshot": paged["snapshot"][0],
+        "speedup": round(paged["sql"][0]["total_s"] / paged["snapshot"][0]["total_s"], 1),
+        "identical": paged["sql"][1] == paged["snapshot"][1],
+    }
+    return results
+
+def scenario_fetch(ctx):
+    """MOAClient.stream_lost_pets 對本機 stub (每請求 50ms 延遲、2% 失敗)，含清洗，不寫入"""
+    rows = min(ctx.total, ctx.fetch_rows)
+    with MOAStub(rows, latency=0.05, failure_rate=0.02, seed=ctx.seed) as stub:
+        client = MOAClient(rate_limit=0, backoff_base=0.05, raw_cache=False)
+        client.url = stub.url
+        elapsed, result = _timed(client.stream_lost_pets, lambda page: None)
+        requests, failures = stub.requests, stub.failures
+    return {"rows": result["rows"], "complete": result["complete"], "total_s": round(elapsed, 4),
+            "rows_per_s": round(result["rows"] / elapsed, 1) if elapsed else None,
+            "requests": requests, "failures": failures}
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class _ApiServer:
+    """在背景執行緒啟動 API (不觸發 startup 事件，因此不會啟動爬蟲)"""
+    def __init__(self):
+        import uvicorn
+        import server
+        self.port = _free_port()
+        config = uvicorn.Config(server.app, host="127.0.0.1", port=self.port, lifespan="off", log_level="warning")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.05)
+        return f"http://127.0.0.1:{self.port}"
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
+
+def _load(base_url, paths, total_requests, concurrency, cold):
+    """
+    以 concurrency 個執行緒平行送出 total_requests 個請求
+    cold=True 時每個請求帶不同的無作用參數，讓回應快取全部未命中 (量測資料庫路徑)
+    """
+    import httpx
+    local = threading.local()
+
+    def request(i):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = httpx.Client(base_url=base_url, timeout=30)
+        path = paths[i % len(paths)]
+        if cold:
+            path += ("&" if "?" in path else "?") + f"_bench={i}"
+        start = time.perf_counter()
+        response = client.get(path)
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(request, range(total_requests)))
+    wall = time.perf_counter() - start
+
+    summary = _summary([elapsed for elapsed, _ in results])
+    summary["requests_per_s"] = round(total_requests / wall, 1)
+    summary["errors"] = sum(1 for _, status in results if status != 200)
+    summary["concurrency"] = concurrency
+    return summary
+
+PETS_PATHS = ["/pets?days=30&limit=50", "/pets?city=台北&days=30&limit=50", "/pets?type=貓&days=30&limit=50",
+              "/pets?q=米克斯&days=30&limit=50", "/pets?days=365&limit=200&fields=id,pet_name,lost_time"]
+STATS_PATHS = ["/stats", "/stats?days=7", "/stats?days=90&breakdown=city,day"]
+
+def scenario_api_pets(ctx):
+    """/pets 在並行負載下 (cold: 快取未命中；warm: 快取命中)"""
+    with _ApiServer() as base_url:
+        return {
+            "cold": _load(base_url, PETS_PATHS, ctx.requests, ctx.concurrency, cold=True),
+            "warm": _load(base_url, PETS_PATHS, ctx.requests, ctx.concurrency, cold=False),
+        }
+
+def scenario_api_stats(ctx):
+    """/stats 在並行負載下"""
+    with _ApiServer() as base_url:
+        return {
+            "cold": _load(base_url, STATS_PATHS, ctx.requests, ctx.concurrency, cold=True),
+            "warm": _load(base_url, STATS_PATHS, ctx.requests, ctx.concurrency, cold=False),
+        }
+
+def _time_to_first_response(env, path="/pets?limit=1", timeout=60):
+    """啟動 uvicorn 子行程，量測到第一個成功 (200) 回應的秒數"""
+    import httpx
+    port = _free_port()
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1",
+                             "--port", str(port), "--log-level", "warning"],
+                            cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f"server 啟動失敗 (exit {proc.returncode})")
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}{path}", timeout=5).status_code == 200:
+                    return time.perf_counter() - start
+            except httpx.TransportError:
+                pass
+            if time.perf_counter() - start > timeout:
+                raise TimeoutError(f"server 在 {timeout}s 內沒有回應")
+            time.sleep(0.01)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+def scenario_cold_start(ctx, repeat=3):
+    """
+    冷啟動：從啟動 uvicorn 到第一個成功的 /pets 回應
+    web 為 RUN_CRAWLER=0；embedded 為內嵌爬蟲 (第一次爬取延後，不連網)
+    另外量測單純 import server 的時間
+    """
+    with db.write_connection() as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    env = dict(os.environ, DB_PATH=ctx.db_path, RAW_CACHE_DIR=os.path.join(ctx.workdir, "raw_cache"),
+               CRAWL_STARTUP_DELAY="3600")
+    results = {}
+    for mode, run_crawler in (("web", "0"), ("embedded", "1")):
+        samples = [_time_to_first_response(dict(env, RUN_CRAWLER=run_crawler)) for _ in range(repeat)]
+        results[mode] = _summary(samples)
+
+    samples = []
+    for _ in range(repeat):
+        elapsed, _ = _timed(subprocess.run, [sys.executable, "-c", "import server"], cwd=REPO_ROOT, env=env,
+                            check=True)
+        samples.append(elapsed)
+    results["import_server"] = _summary(samples)
+    return results
+
+def scenario_photos(ctx, rows=2000, queries=1000, table_size=100_000):
+    """
+    照片索引 (需 Pillow)：從 stub 抓 rows 筆案件 (5% 跨案件重複刊登) 寫入獨立資料庫，
+    index_photos 下載 (每張 20ms 延遲) 並計算雜湊與縮圖；量測找到重複刊登的比例，
+    以及 table_size 個隨機雜湊上多重索引與逐一比對的查詢時間
+    """
+    import photos
+    if not photos.available():
+        return {"skipped": "Pillow 未安裝"}
+    rows = min(ctx.total, rows)
+    ctx.use_db(os.path.join(ctx.workdir, "photos.db"))
+    try:
+        store = photos.ThumbnailStore(os.path.join(ctx.workdir, "photo_cache"))
+        with MOAStub(rows, latency=0.02, seed=ctx.seed, crosspost_ratio=0.05) as stub:
+            client = MOAClient(rate_limit=0, raw_cache=False)
+            client.url = stub.url
+            ingest = db.PetIngest()
+            client.stream_lost_pets(ingest.write_page)
+            ingest.finish(True)
+            elapsed, stats = _timed(photos.index_photos, downloader=photos.PhotoDownloader(concurrency=8),
+                                    store=store)
+            downloads = stub.photo_requests
+
+        index = photos.PhotoIndex()
+        refresh_s, _ = _timed(index.refresh)
+        # 同一張原圖 (網址去掉 ?v=) 的案件互為重複刊登
+        pets = db.get_pets_by_ids([pet_id for pet_id, _, _ in db.get_photo_hashes()], fields="picture_url")
+        groups = {}
+        for pet_id, pet in pets.items():
+            groups.setdefault(pet["picture_url"].split("?")[0], set()).add(pet_id)
+        pairs = found = false_matches = 0
+        for pet_id, pet in pets.items():
+            expected = groups[pet["picture_url"].split("?")[0]] - {pet_id}
+            similar = {other for other, _ in index.similar(pet_id)}
+            pairs += len(expected)
+            found += len(expected & similar)
+            false_matches += len(similar - expected)
+    finally:
+        ctx.use_db(ctx.db_path)
+
+    rng = random.Random(f"mih:{ctx.seed}")
+    hashes = [rng.getrandbits(64) for _ in range(table_size)]
+    table = photos.MultiIndexHash()
+    build_s, _ = _timed(lambda: [table.add(h, i) for i, h in enumerate(hashes)])
+    probes = [h ^ (1 << rng.randrange(64)) for h in rng.sample(hashes, queries)]
+    table_samples = [_timed(table.search, h, photos.DUPLICATE_DISTANCE)[0] for h in probes]
+    linear_samples = [_timed(lambda h: [x for x in hashes if photos.hamming(h, x) <= photos.DUPLICATE_DISTANCE], h)[0]
+                      for h in probes[:50]]
+
+    return {
+        "index": dict(stats, total_s=round(elapsed, 4), photo_requests=downloads,
+                      photos_per_s=round(stats["downloaded"] / elapsed, 1) if elapsed else None),
+        "refresh_s": round(refresh_s, 4),
+        "duplicate_pairs": pairs,
+        "duplicate_pairs_found": found,
+        "false_matches": false_matches,
+        "index_build_s": round(build_s, 4),
+        "index_lookup": _summary(table_samples),
+        "linear_lookup": _summary(linear_samples),
+    }
+
+# 拾獲者描述的寫法與案件登記不同 (別名、部分毛色)
+SIGHTING_BREEDS = {"米克斯": "混種", "貴賓": "泰迪", "馬爾濟斯": "瑪爾濟斯犬", "黃金獵犬": "黃金", "哈士奇": "雪橇犬",
+                   "英國短毛貓": "英短", "美國短毛貓": "美短"}
+SIGHTING_COLORS = {"黑白": "賓士", "虎斑": "虎班", "咖啡色": "咖啡", "黑色": "黑", "白色": "白"}
+
+def _sightings(ctx, queries):
+    """從 Open 案件隨機抽樣，加上雜訊做成拾獲資料 -> [(原案件 id, Sighting 參數), ...]"""
+    import matching
+    rng = random.Random(f"match:{ctx.seed}")
+    pets = []
+    with db.read_connection() as conn:
+        max_rowid = conn.execute("SELECT MAX(rowid) FROM lost_pets").fetchone()[0] or 0
+        for _ in range(queries * 20):
+            if len(pets) == queries:
+                break
+            row = conn.execute('''
+                SELECT id, status, pet_type, breed, sex, color, lost_time, city, district FROM lost_pets
+                WHERE rowid >= ? ORDER BY rowid LIMIT 1
+            ''', (rng.randint(1, max_rowid),)).fetchone()
+            if row and row["status"] == "Open" and row["pet_type"] in ("狗", "貓") and row["district"] \
+                    and matching.day_number(row["lost_time"]) is not None:
+                pets.append(dict(row))
+
+    sightings = []
+    for pet in pets:
+        sightings.append((pet["id"], {
+            "pet_type": pet["pet_type"],
+            "breed": SIGHTING_BREEDS.get(pet["breed"], pet["breed"]) if rng.random() < 0.8 else None,
+            "color": SIGHTING_COLORS.get(pet["color"], pet["color"]) if rng.random() < 0.9 else None,
+            "sex": pet["sex"] if rng.random() < 0.5 else None,
+            "location": f"{pet['city']}{pet['district']}",
+            "seen_on": matching.day_date(matching.day_number(pet["lost_time"]) + rng.randint(0, 14)),
+        }))
+    return sightings
+
+def scenario_match_pets(ctx, queries=500, scan_queries=50, k=10):
+    """
+    拾獲比對：從 Open 案件抽樣加上雜訊做成拾獲資料，量測 find_matching_pets 的延遲、候選數，
+    以及原案件出現在前 k 名的比例 (recall)
+    對照組 scan 不用比對索引：讀出日期視窗內所有 Open 案件，逐筆正規化後篩選計分
+    另量測重建比對索引的時間
+    """
+    import matching
+    sightings = _sightings(ctx, queries)
+    samples = []
+    candidates = []
+    hits = 0
+    for pet_id, kwargs in sightings:
+        elapsed, (data, count) = _timed(lambda: db.find_matching_pets(matching.Sighting(**kwargs), limit=k))
+        samples.append(elapsed)
+        candidates.append(count)
+        hits += any(pet["id"] == pet_id for pet in data)
+
+    def scan(kwargs):
+        sighting = matching.Sighting(**kwargs)
+        first, last = matching.day_date(sighting.first_day), matching.day_date(sighting.last_day)
+        rows = []
+        with db.read_connection() as conn:
+            for pet in conn.execute('''
+                SELECT id, pet_type, breed, sex, color, lost_time, city, district FROM lost_pets
+                WHERE status = 'Open' AND lost_time BETWEEN ? AND ?
+            ''', (first.isoformat(), last.isoformat())):
+                for row in matching.index_rows(*tuple(pet)[1:])[:1]:
+                    if row[0] == sighting.pet_type and row[1] in sighting.areas:
+                        rows.append((row[1], pet["id"]) + row[4:])
+        return matching.rank(sighting, rows, k)
+
+    scan_samples = [_timed(scan, kwargs)[0] for _, kwargs in sightings[:scan_queries]]
+    with db.read_connection() as conn:
+        index_size = conn.execute("SELECT COUNT(*) FROM pet_match_index").fetchone()[0]
+    rebuild_s, _ = _timed(db.rebuild_match_index)
+    return {
+        "queries": len(sightings),
+        "index_rows": index_size,
+        "match": _summary(samples),
+        "candidates_mean": round(statistics.fmean(candidates), 1) if candidates else 0,
+        "candidates_max": max(candidates, default=0),
+        f"recall_at_{k}": round(hits / len(sightings), 3) if sightings else None,
+        "scan": _summary(scan_samples),
+        "rebuild_s": round(rebuild_s, 3),
+    }
+
+def scenario_resource_parse(ctx, repeat=3, max_rows=100_000):
+    """
+    動物醫院資料集解析 (resource_crawler.parse_resource)：Big5 / UTF-8 BOM CSV 與 JSON 各一份
+    時間取 repeat 次中最快的一次；peak_mb 為另外以 tracemalloc 量測一次的記憶體高峰
+    """
+    import tracemalloc
+    import resource_crawler
+    from benchmarks.synthetic import clinic_dataset
+    rows = min(ctx.total, max_rows)
+    result = {}
+    for fmt, encoding in (("csv", "cp950"), ("csv", "utf-8-sig"), ("json", "utf-8")):
+        content = clinic_dataset(rows, seed=ctx.seed, fmt=fmt, encoding=encoding)
+        elapsed = min(_timed(resource_crawler.parse_resource, content, resource_crawler.VET_CLINICS)[0]
+                      for _ in range(repeat))
+        tracemalloc.start()
+        df = resource_crawler.parse_resource(content, resource_crawler.VET_CLINICS)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        result[f"{fmt}_{encoding}"] = {
+            "rows": len(df), "size_mb": round(len(content) / 1e6, 1), "total_s": round(elapsed, 4),
+            "rows_per_s": round(len(df) / elapsed, 1) if elapsed else None, "peak_mb": round(peak / 1e6, 1),
+        }
+    return result
+
+# 需要 upsert_pet 先建立資料庫的情境
+NEEDS_DB = ("close_missing_pets", "get_recent_pets", "pet_snapshot", "api_pets", "api_stats", "cold_start", "match_pets")
+
+# 執行順序固定：upsert_pet 建立後續情境使用的資料庫
+SCENARIOS = {
+    "clean_data": scenario_clean_data,
+    "upsert_pet": scenario_upsert_pet,
+    "close_missing_pets": scenario_close_missing_pets,
+    "get_recent_pets": scenario_get_recent_pets,
+    "pet_snapshot": scenario_pet_snapshot,
+    "match_pets": scenario_match_pets,
+    "fetch": scenario_fetch,
+    "api_pets": scenario_api_pets,
+    "api_stats": scenario_api_stats,
+    "cold_start": scenario_cold_start,
+    "photos": scenario_photos,
+    "resource_parse": scenario_resource_parse,
+}
+
+def _git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                               text=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def run(size="10k", seed=0, only=None, output=None, fetch_rows=50_000, concurrency=8, requests=400):
+    total = SIZES[size]
+    names = list(SCENARIOS) if not only else [name for name in SCENARIOS if name in only]
+    # 後續情境需要 upsert_pet 建立的資料庫
+    if any(name in NEEDS_DB for name in names) and "upsert_pet" not in names:
+        names.insert(0, "upsert_pet")
+
+    commit = _git_commit()
+    report = {
+        "meta": {
+            "commit": commit,
+            "size": size,
+            "rows": total,
+            "seed": seed,
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "scenarios": {},
+    }
+
+    original_db = db.DB_NAME
+    workdir = tempfile.mkdtemp(prefix="pet-bench-")
+    ctx = Context(total, seed, workdir, fetch_rows, concurrency, requests)
+    try:
+        for name in names:
+            print(f"[{datetime.now()}] ⏱️ {name} ({size})...")
+            elapsed, result = _timed(SCENARIOS[name], ctx)
+            result["wall_s"] = round(elapsed, 3)
+            report["scenarios"][name] = result
+            print(f"   ✅ {name}: {elapsed:.2f}s")
+    finally:
+        db.DB_NAME = original_db
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report["meta"]["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    output = output or os.path.join(RESULTS_DIR, f"{commit}_{size}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"📄 結果已寫入 {output}")
+    return report
+
+def _flatten(prefix, value, out):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            _flatten(f"{prefix}.{key}" if prefix else key, item, out)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        out[prefix] = value
+    return out
+
+def compare(old_path, new_path, threshold=0.10):
+    """
+    比較兩份結果：時間類 (_ms / _s) 越小越好，速率類 (per_s) 越大越好
+    變差超過 threshold 的項目標記為 ⚠️
+    """
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+    old_metrics = _flatten("", old["scenarios"], {})
+    new_metrics = _flatten("", new["scenarios"], {})
+    print(f"{old['meta']['commit']} ({old['meta']['size']}) -> {new['meta']['commit']} ({new['meta']['size']})")
+
+    regressions = 0
+    for key in sorted(set(old_metrics) & set(new_metrics)):
+        if key.endswith("per_s"):
+            higher_is_better = True
+        elif key.endswith("_ms") or key.endswith("_s"):
+            higher_is_better = False
+        else:
+            continue
+        before, after = old_metrics[key], new_metrics[key]
+        if not before:
+            continue
+        change = (after - before) / before
+        worse = -change if higher_is_better else change
+        flag = "⚠️" if worse > threshold else ("🚀" if worse < -threshold else "  ")
+        regressions += worse > threshold
+        print(f"{flag} {key:<45} {before:>12.3f} -> {after:>12.3f} ({change:+.1%})")
+    return regressions
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "compare":
+        parser = argparse.ArgumentParser(prog="benchmarks.run compare")
+        parser.add_argument("old")
+        parser.add_argument("new")
+        parser.add_argument("--threshold", type=float, default=0.10)
+        args = parser.parse_args(argv[1:])
+        return 1 if compare(args.old, args.new, args.threshold) else 0
+
+    parser = argparse.ArgumentParser(prog="benchmarks.run", description="效能基準測試")
+    parser.add_argument("--size", choices=list(SIZES), default="10k")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", help=f"只跑指定情境 (逗號分隔): {', '.join(SCENARIOS)}")
+    parser.add_argument("--output", help="結果 JSON 路徑")
+    parser.add_argument("--fetch-rows", type=int, default=50_000, help="fetch 情境的資料筆數上限")
+    parser.add_argument("--concurrency", type=int, default=8, help="API 情境的並行數")
+    parser.add_argument("--requests", type=int, default=400, help="API 情境每種負載的請求數")
+    args = parser.parse_args(argv)
+    only = set(args.only.split(",")) if args.only else None
+    run(args.size, args.seed, only, args.output, args.fetch_rows, args.concurrency, args.requests)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+"""
+合成測試資料：格式與農業部 API 相同的走失寵物資料，以及動物醫院資料
+- 以 seed 決定內容，同樣參數每次產生相同資料 (可跨 commit 比較)
+- 依 1000 筆一塊產生，1M 筆也不需整份放在記憶體
+- 含中文地名 (台/臺 混用、舊縣名、沒寫縣市)、多種民國 / 西元日期格式、重複的 (晶片號碼, 寵物名)
+- 可選的跨案件重複刊登 (不同鍵、同一張照片的重新壓縮版本) 與對應的合成照片 (需 Pillow)
+"""
+import io
+import random
+from datetime import date, timedelta
+from taiwan_admin import DIVISIONS
+
+CHUNK_SIZE = 1000
+
+SIZES = {"10k": 10_000, "100k": 100_000, "500k": 500_000, "1m": 1_000_000}
+
+PET_NAMES = ["小白", "咪咪", "黑糖", "球球", "豆豆", "妞妞", "可樂", "旺財", "小黑", "阿福", "Lucky", "Money",
+             "花花", "皮皮", "胖虎", "嚕嚕", "奶茶", "麻糬", "布丁", "饅頭", "橘子", "湯圓", "Coco", "Lucy"]
+BREEDS = {
+    "狗": ["米克斯", "柴犬", "貴賓", "博美", "黃金獵犬", "臘腸", "法國鬥牛犬", "吉娃娃", "馬爾濟斯", "哈士奇"],
+    "貓": ["米克斯", "英國短毛貓", "美國短毛貓", "波斯貓", "布偶貓", "暹羅貓", "橘貓"],
+    "其他": ["兔", "鸚鵡", "天竺鼠", "刺蝟"],
+}
+COLORS = ["黑色", "白色", "黃色", "咖啡色", "黑白", "虎斑", "三花", "灰色", "米色", "花色"]
+ROADS = ["中正路", "中山路", "民生路", "復興路", "建國路", "和平東路", "忠孝東路", "仁愛路", "光復路", "自由路",
+         "三民路", "中華路", "文化路", "民族路", "成功路"]
+LANDMARKS = ["公園", "國小", "市場", "捷運站", "夜市", "河堤", "全聯"]
+SURNAMES = "陳林黃張李王吳劉蔡楊許鄭謝郭洪曾邱廖賴徐"
+CLINIC_WORDS = ["安心", "仁愛", "大安", "寵愛", "毛孩", "樂活", "康橋", "佳佳", "全民", "慈心", "和平", "幸福"]
+
+_PLACES = [(city, district) for city, districts in DIVISIONS.items() for district in districts]
+_OLD_COUNTIES = {"新北市": "臺北縣", "桃園市": "桃園縣", "臺中市": "臺中縣", "臺南市": "臺南縣", "高雄市": "高雄縣"}
+
+def _chunk_rng(seed, chunk, salt):
+    return random.Random(f"{salt}:{seed}:{chunk}")
+
+def _place(rng):
+    city, district = rng.choice(_PLACES)
+    style = rng.random()
+    road = f"{rng.choice(ROADS)}{rng.randint(1, 3)}段{rng.randint(1, 400)}號"
+    if style < 0.5:
+        city_text = city.replace("臺", "台") if rng.random() < 0.5 else city
+        return f"{city_text}{district}{road}"
+    if style < 0.65:
+        return f"{city}{district}{rng.choice(LANDMARKS)}附近"
+    if style < 0.75 and city in _OLD_COUNTIES and district.endswith("區"):
+        # 升格前的寫法：臺北縣板橋市
+        return f"{_OLD_COUNTIES[city]}{district[:-1]}市{road}"
+    if style < 0.9:
+        # 沒寫縣市
+        return f"{district}{road}"
+    return f"{city[:2]}{rng.choice(LANDMARKS)}"
+
+def _lost_time(rng, today):
+    day = today - timedelta(days=int(rng.expovariate(1 / 120)) % 1095)
+    style = rng.random()
+    roc = day.year - 1911
+    if style < 0.55:
+        return f"{roc}/{day.month:02d}/{day.day:02d}"
+    if style < 0.7:
+        return f"{roc}/{day.month}/{day.day} {rng.randint(0, 23):02d}:{rng.choice(['00', '30'])}"
+    if style < 0.8:
+        return f"{roc}.{day.month}.{day.day}"
+    if style < 0.9:
+        return day.strftime("%Y/%m/%d")
+    if style < 0.97:
+        return day.isoformat()
+    return ""
+
+def _pet_key(rng):
+    chip = "" if rng.random() < 0.1 else f"{rng.choice(['900', '982', '985'])}{rng.randint(0, 10**12 - 1):012d}"
+    name = "" if rng.random() < 0.03 else rng.choice(PET_NAMES)
+    return chip, name
+
+PICTURE_BASE = "https://example.invalid/pets"
+
+def pet_chunk(index, seed=0, total=None, duplicate_ratio=0.02, today=None,
+              crosspost_ratio=0.0, picture_base=PICTURE_BASE):
+    """
+    第 index 塊 (每塊 CHUNK_SIZE 筆) 的原始 API 資料
+    :param total: 資料總筆數 (最後一塊截短)
+    :param duplicate_ratio: 重複 (晶片號碼, 寵物名) 的比例；重複列沿用同塊中較早一列的鍵，內容可能不同
+    :param crosspost_ratio: 跨案件重複刊登的比例；該列的鍵是新的，照片為同塊中較早一列照片的變形版本 (?v=1~3)
+    :param picture_base: 照片網址前綴 ({picture_base}/{seed}/{編號}.jpg)
+    """
+    rng = _chunk_rng(seed, index, "pet")
+    today = today or date.today()
+    start = index * CHUNK_SIZE
+    count = CHUNK_SIZE if total is None else max(0, min(CHUNK_SIZE, total - start))
+    rows = []
+    for i in range(count):
+        if rows and rng.random() < duplicate_ratio:
+            previous = rng.choice(rows)
+            chip, name = previous["晶片號碼"], previous["寵物名"]
+        else:
+            chip, name = _pet_key(rng)
+        picture = f"{picture_base}/{seed}/{start + i}.jpg"
+        # crosspost_ratio 為 0 時不多抽亂數，既有資料不變
+        if crosspost_ratio and rows and rng.random() < crosspost_ratio:
+            picture = f"{rng.choice(rows)['PICTURE'].split('?')[0]}?v={rng.randint(1, 3)}"
+        pet_type = rng.choices(["狗", "貓", "其他"], weights=[70, 25, 5])[0]
+        rows.append({
+            "晶片號碼": chip,
+            "寵物名": name,
+            "寵物別": pet_type,
+            "性別": rng.choice(["公", "母", "未知"]),
+            "品種": rng.choice(BREEDS[pet_type]),
+            "毛色": rng.choice(COLORS),
+            "遺失時間": _lost_time(rng, today),
+            "遺失地點": _place(rng),
+            "飼主姓名": f"{rng.choice(SURNAMES)}{rng.choice(['先生', '小姐', '○○'])}",
+            "連絡電話": f"09{rng.randint(0, 99):02d}-{rng.randint(0, 999):03d}-{rng.randint(0, 999):03d}",
+            "PICTURE": picture,
+        })
+    return rows
+
+def iter_pet_chunks(total, seed=0, **kwargs):
+    """依序產生各塊原始資料，總計 total 筆"""
+    for index in range((total + CHUNK_SIZE - 1) // CHUNK_SIZE):
+        yield pet_chunk(index, seed=seed, total=total, **kwargs)
+
+def pet_page(skip, top, total, seed=0, **kwargs):
+    """模擬 API 的 $skip / $top 分頁 (可跨塊)"""
+    end = min(skip + top, total)
+    rows = []
+    index = skip // CHUNK_SIZE
+    while index * CHUNK_SIZE < end:
+        chunk = pet_chunk(index, seed=seed, total=total, **kwargs)
+        base = index * CHUNK_SIZE
+        rows.extend(chunk[max(skip - base, 0):end - base])
+        index += 1
+    return rows
+
+def pet_image(seed, number, variant=0, size=(640, 480)):
+    """
+    第 number 筆案件的合成照片 (JPEG bytes)，同樣參數內容相同
+    variant > 0 為同一張照片的變形版本：不同尺寸、壓縮品質與亮度 (模擬其他來源轉貼)
+    """
+    from PIL import Image, ImageDraw, ImageEnhance
+    rng = random.Random(f"image:{seed}:{number}")
+    image = Image.new("RGB", size, tuple(rng.randint(0, 255) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x0, y0 = rng.randint(0, size[0] - 40), rng.randint(0, size[1] - 40)
+        box = (x0, y0, x0 + rng.randint(40, size[0] // 2), y0 + rng.randint(40, size[1] // 2))
+        color = tuple(rng.randint(0, 255) for _ in range(3))
+        (draw.ellipse if rng.random() < 0.5 else draw.rectangle)(box, fill=color)
+    quality = 90
+    if variant:
+        vrng = random.Random(f"variant:{seed}:{number}:{variant}")
+        scale = vrng.uniform(0.5, 0.9)
+        image = image.resize((int(size[0] * scale), int(size[1] * scale)))
+        image = ImageEnhance.Brightness(image).enhance(vrng.uniform(0.9, 1.1))
+        quality = vrng.randint(40, 75)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+def generate_clinics(total, seed=0):
+    """動物醫院資料 (resource_crawler 清洗後的欄位)"""
+    rng = random.Random(f"clinic:{seed}")
+    clinics = []
+    for i in range(total):
+        city, district = rng.choice(_PLACES)
+        clinics.append({
+            "name": f"{rng.choice(CLINIC_WORDS)}動物醫院{i}",
+            "tel": f"0{rng.randint(2, 8)}-{rng.randint(1000000, 9999999)}",
+            "address": f"{city}{district}{rng.choice(ROADS)}{rng.randint(1, 500)}號",
+            "doctor_name": f"{rng.choice(SURNAMES)}醫師",
+            "google_map_link": "",
+        })
+    return clinics
+
+# 農業部動物醫院資料集的原始欄位 (含 resource_crawler 用不到的欄位)
+CLINIC_HEADER = ["縣市", "字號", "狀態", "機構名稱", "負責獸醫", "機構電話", "發照日期", "機構地址", "備註"]
+
+def clinic_dataset(total, seed=0, fmt="csv", encoding="cp950"):
+    """
+    動物醫院原始資料集 (下載回來的 bytes)：fmt 為 "csv" 或 "json"
+    encoding 為 "cp950" (Big5)、"utf-8" 或 "utf-8-sig" (含 BOM)
+    """
+    import csv
+    import json
+    rows = []
+    for i, clinic in enumerate(generate_clinics(total, seed=seed)):
+        rows.append([clinic["address"][:3], f"北市動字第{i:07d}號", "開業", clinic["name"], clinic["doctor_name"][0] + "獸醫",
+                     clinic["tel"], f"{90 + i % 23}/{1 + i % 12:02d}/{1 + i % 28:02d}", clinic["address"], ""])
+    if fmt == "json":
+        text = json.dumps([dict(zip(CLINIC_HEADER, row)) for row in rows], ensure_ascii=False)
+    else:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\r\n")
+        writer.writerow(CLINIC_HEADER)
+        writer.writerows(rows)
+        text = buffer.getvalue()
+    return text.encode(encoding)
@@ -1,204 +1,1856 @@
-
 import sqlite3
 import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 import json
+import base64
+import hashlib
+import functools
+import re
+from array import array
+from bisect import bisect_left
+import metrics
+from taiwan_admin import parse_location, city_candidates, district_candidates
+from gazetteer import locate, bounding_box, haversine_km
+import matching
+from matching import index_rows, MATCH_INDEX_VERSION
 
-DB_NAME = "pets.db"
+DB_NAME = os.environ.get("DB_PATH", "pets.db")
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_NAME)
-    conn.execute("PRAGMA journal_mode=WAL")
+# 資料表結構版本 (存在 PRAGMA user_version)：init_db 的內容有變動時 +1
+# 資料庫已是此版本時 init_db 直接略過所有檢查與回填
+SCHEMA_VERSION = 4
+
+# 連線池設定 (API 唯讀連線數量上限、等待逾時秒數)
+READ_POOL_SIZE = int(os.environ.get("DB_READ_POOL_SIZE", "8"))
+READ_POOL_TIMEOUT = float(os.environ.get("DB_READ_POOL_TIMEOUT", "30"))
+
+# 每條連線建立時只套用一次的 PRAGMA
+CONNECTION_PRAGMAS = [
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA synchronous=NORMAL",      # WAL 模式下 NORMAL 即可保證一致性
+    "PRAGMA cache_size=-16000",       # 約 16MB page cache
+    "PRAGMA mmap_size=268435456",     # 256MB memory-mapped I/O
+    "PRAGMA temp_store=MEMORY",
+]
+
+DB_CALL_SECONDS = metrics.histogram("pet_db_call_duration_seconds", "db 函式執行時間", ["function"])
+SQL_SECONDS = metrics.histogram("pet_db_statement_duration_seconds",
+                                "SQL 敘述執行時間 (execute 本身，不含之後逐列讀取)", ["statement"])
+
+_FIRST_NAME = re.compile(r"\w+")
+
+# 各動作後面接資料表名稱的關鍵字
+_STATEMENT_TARGET = {"INSERT": "INTO", "REPLACE": "INTO", "SELECT": "FROM", "DELETE": "FROM", "WITH": "FROM"}
+
+@functools.lru_cache(maxsize=1024)
+def _statement_label(sql):
+    """SQL -> 低基數的標籤 (動作 + 主要資料表)，例如 INSERT lost_pets、SELECT vet_clinics、PRAGMA busy_timeout"""
+    words = sql.split()
+    if not words:
+        return ""
+    action = words[0].upper()
+    target = None
+    if action in _STATEMENT_TARGET:
+        upper = [w.upper() for w in words[:-1]]
+        if _STATEMENT_TARGET[action] in upper:
+            target = words[upper.index(_STATEMENT_TARGET[action]) + 1]
+    elif len(words) > 1:
+        target = words[1]
+    name = _FIRST_NAME.match(target) if target else None
+    return f"{action} {name.group(0)}" if name else action
+
+class _TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            SQL_SECONDS.observe(time.perf_counter() - start, statement=_statement_label(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            SQL_SECONDS.observe(time.perf_counter() - start, statement=_statement_label(sql))
+
+class _TimedConnection(sqlite3.Connection):
+    """記錄每個 SQL 敘述執行時間的連線 (指標停用時不使用)"""
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+_CONNECTION_FACTORY = _TimedConnection if metrics.ENABLED else sqlite3.Connection
+
+def _configure_connection(conn, read_only=False):
+    if not read_only:
+        conn.execute("PRAGMA journal_mode=WAL")
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    if read_only:
+        conn.execute("PRAGMA query_only=1")
     conn.row_factory = sqlite3.Row
     return conn
 
-def init_db():
-    """初始化資料庫表格"""
-    conn = get_db_connection()
-    c = conn.cursor()
-    
-    # 走失寵物表
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS lost_pets (
-            id TEXT PRIMARY KEY,
-            chip_num TEXT,
-            pet_name TEXT,
-            pet_type TEXT,
-            breed TEXT,
-            sex TEXT,
-            color TEXT,
-            lost_place TEXT,
-            lost_time TEXT,
-            owner_name TEXT,
-            phone TEXT,
-            picture_url TEXT,
-            created_at TEXT,
-            status TEXT DEFAULT 'Open',
-            notified INTEGER DEFAULT 0
-        )
+def get_db_connection():
+    """開啟一條獨立的連線 (一次性工具用；服務內請用 read_connection / write_connection)"""
+    conn = sqlite3.connect(DB_NAME, factory=_CONNECTION_FACTORY)
+    return _configure_connection(conn)
+
+class ConnectionPool:
+    """
+    唯讀連線池：供 FastAPI threadpool 中的請求共用
+    連線只在建立時設定一次 PRAGMA，用完放回池中重複使用
+    """
+    def __init__(self, path, max_size=READ_POOL_SIZE, timeout=READ_POOL_TIMEOUT):
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._acquisitions = 0
+        self._waits = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _connect(self):
+        uri = f"file:{os.path.abspath(self.path)}?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, factory=_CONNECTION_FACTORY)
+        return _configure_connection(conn, read_only=True)
+
+    def acquire(self):
+        start = time.perf_counter()
+        waited = False
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.max_size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                waited = True
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError(f"等待資料庫連線逾時 ({self.timeout}s)")
+
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._in_use += 1
+            self._acquisitions += 1
+            self._total_wait += elapsed
+            self._max_wait = max(self._max_wait, elapsed)
+            if waited:
+                self._waits += 1
+        return conn
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._created = self._in_use
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_size": self.max_size,
+                "created": self._created,
+                "in_use": self._in_use,
+                "idle": self._idle.qsize(),
+                "acquisitions": self._acquisitions,
+                "waits": self._waits,
+                "avg_wait_ms": round(self._total_wait / self._acquisitions * 1000, 3) if self._acquisitions else 0.0,
+                "max_wait_ms": round(self._max_wait * 1000, 3),
+            }
+
+class _Writer:
+    """單一寫入連線 (Daemon / 資源爬蟲共用)，以鎖序列化所有寫入"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = _configure_connection(sqlite3.connect(path, check_same_thread=False,
+                                                          factory=_CONNECTION_FACTORY))
+        self.acquisitions = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+_pool_lock = threading.Lock()
+_read_pool = None
+_writer = None
+
+def _get_read_pool():
+    global _read_pool
+    with _pool_lock:
+        if _read_pool is None or _read_pool.path != DB_NAME:
+            if _read_pool is not None:
+                _read_pool.close_all()
+            _read_pool = ConnectionPool(DB_NAME)
+        return _read_pool
+
+def _get_writer():
+    global _writer
+    with _pool_lock:
+        if _writer is None or _writer.path != DB_NAME:
+            _writer = _Writer(DB_NAME)
+        return _writer
+
+@contextmanager
+def read_connection():
+    """從唯讀連線池借出一條連線 (API 查詢用)"""
+    pool = _get_read_pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+@contextmanager
+def write_connection():
+    """取得唯一的寫入連線；正常離開時 commit，發生例外時 rollback"""
+    writer = _get_writer()
+    start = time.perf_counter()
+    with writer.lock:
+        elapsed = time.perf_counter() - start
+        writer.acquisitions += 1
+        writer.total_wait += elapsed
+        writer.max_wait = max(writer.max_wait, elapsed)
+        try:
+            yield writer.conn
+        except BaseException:
+            if writer.conn.in_transaction:
+                writer.conn.rollback()
+            raise
+        else:
+            if writer.conn.in_transaction:
+                writer.conn.commit()
+
+def pool_stats():
+    """連線池使用統計 (用於調整 pool 大小)"""
+    stats = {"read": _get_read_pool().stats()}
+    writer = _writer
+    if writer is not None:
+        stats["write"] = {
+            "acquisitions": writer.acquisitions,
+            "avg_wait_ms": round(writer.total_wait / writer.acquisitions * 1000, 3) if writer.acquisitions else 0.0,
+            "max_wait_ms": round(writer.max_wait * 1000, 3),
+        }
+    return stats
+
+# 全文檢索設定：來源表 -> 建立索引的欄位
+FTS_TABLES = {
+    "lost_pets": ["pet_name", "breed", "color", "lost_place", "pet_type"],
+    "vet_clinics": ["name", "address"],
+}
+FTS_MIN_TERM_LEN = 3  # trigram 至少需要 3 個字元才能走索引
+
+def _init_fts(c, table, columns):
+    """建立 external content 的 FTS5 表與同步觸發器，首次建立時從來源表回填"""
+    fts = f"{table}_fts"
+    exists = c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (fts,)).fetchone()
+    if exists:
+        return
+
+    cols = ", ".join(columns)
+    new_cols = ", ".join(f"new.{col}" for col in columns)
+    old_cols = ", ".join(f"old.{col}" for col in columns)
+    try:
+        c.execute(f"CREATE VIRTUAL TABLE {fts} USING fts5({cols}, content='{table}', content_rowid='rowid', tokenize='trigram')")
+    except sqlite3.OperationalError as e:
+        print(f"[{datetime.now()}] ⚠️ 此 SQLite 不支援 FTS5 trigram，全文檢索改用 LIKE: {e}")
+        return
+
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts}(rowid, {cols}) VALUES (new.rowid, {new_cols});
+        END
     ''')
-    
-    # 用戶訂閱表 (用於通知功能)
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS subscriptions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            platform TEXT,  -- 'line', 'discord'
-            webhook_url TEXT,
-            city_filter TEXT, -- e.g., '台北市'
-            created_at TEXT
-        )
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.rowid, {old_cols});
+        END
     ''')
+    # 只有被索引的欄位變動才需要同步 (例如關閉案件只改 status，不觸發)
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {cols} ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.rowid, {old_cols});
+            INSERT INTO {fts}(rowid, {cols}) VALUES (new.rowid, {new_cols});
+        END
+    ''')
+    c.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
 
-    # 動物醫院表
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS vet_clinics (
-            id TEXT PRIMARY KEY,
-            name TEXT,
-            tel TEXT,
-            address TEXT,
-            doctor_name TEXT,
-            google_map_link TEXT,
-            updated_at TEXT
-        )
+# 空間索引：以 rowid 對應來源表的 (lat, lon)，點資料的 min/max 相同
+GEO_TABLES = ("lost_pets", "vet_clinics")
+
+def _init_geo(c, table):
+    """建立 R*Tree 座標索引與同步觸發器，首次建立時從來源表回填"""
+    geo = f"{table}_geo"
+    exists = c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (geo,)).fetchone()
+    if exists:
+        return
+
+    try:
+        c.execute(f"CREATE VIRTUAL TABLE {geo} USING rtree(rid, min_lat, max_lat, min_lon, max_lon)")
+    except sqlite3.OperationalError as e:
+        print(f"[{datetime.now()}] ⚠️ 此 SQLite 不支援 R*Tree，附近搜尋改用全表掃描: {e}")
+        return
+
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {geo}_ai AFTER INSERT ON {table} WHEN new.lat IS NOT NULL BEGIN
+            INSERT INTO {geo} VALUES (new.rowid, new.lat, new.lat, new.lon, new.lon);
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {geo}_ad AFTER DELETE ON {table} BEGIN
+            DELETE FROM {geo} WHERE rid = old.rowid;
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {geo}_au AFTER UPDATE OF lat, lon ON {table} BEGIN
+            DELETE FROM {geo} WHERE rid = old.rowid;
+            INSERT INTO {geo} SELECT new.rowid, new.lat, new.lat, new.lon, new.lon WHERE new.lat IS NOT NULL;
+        END
     ''')
+    c.execute(f"INSERT INTO {geo} SELECT rowid, lat, lat, lon, lon FROM {table} WHERE lat IS NOT NULL")
+
+def _fts_filter(table, q, columns=None):
+    """
+    將自由文字 q 轉成 WHERE 條件 (以空白分隔的多個詞，需全部符合)
+    長度 >= 3 的詞走 FTS5 MATCH；較短的詞 (如「台北」) trigram 無法索引，改用 LIKE
+    :param columns: 比對的欄位，預設為 FTS_TABLES[table]；沒有 FTS 表的表格 (如封存表) 全部走 LIKE
+    :return: (sql_fragment, params)
+    """
+    terms = [t for t in q.split() if t]
+    if not terms:
+        return "", []
+
+    fts = f"{table}_fts"
+    with read_connection() as conn:
+        has_fts = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (fts,)).fetchone()
+    columns = columns or FTS_TABLES[table]
+
+    clauses = []
+    params = []
+    match_terms = []
+    for term in terms:
+        if has_fts and len(term) >= FTS_MIN_TERM_LEN:
+            match_terms.append('"' + term.replace('"', '""') + '"')
+        else:
+            clauses.append("(" + " OR ".join(f"{table}.{col} LIKE ?" for col in columns) + ")")
+            params.extend([f"%{term}%"] * len(columns))
+
+    if match_terms:
+        clauses.insert(0, f"{table}.rowid IN (SELECT rowid FROM {fts} WHERE {fts} MATCH ?)")
+        params.insert(0, " AND ".join(match_terms))
+
+    return " AND " + " AND ".join(clauses), params
+
+@DB_CALL_SECONDS.time()
+def _schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def init_db(force=False):
+    """初始化資料庫表格 (結構已是 SCHEMA_VERSION 時直接返回；force=True 時仍完整檢查)"""
+    with write_connection() as conn:
+        if not force and _schema_version(conn) == SCHEMA_VERSION:
+            return
+        c = conn.cursor()
+        # 整個初始化在同一個交易中：多個行程同時啟動時依序執行，不會重複建立 FTS / R*Tree 表
+        c.execute("BEGIN IMMEDIATE")
+        if not force and _schema_version(conn) == SCHEMA_VERSION:
+            return  # 等待期間已由其他行程完成
+
+        # 走失寵物表
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS lost_pets (
+                id TEXT PRIMARY KEY,
+                chip_num TEXT,
+                pet_name TEXT,
+                pet_type TEXT,
+                breed TEXT,
+                sex TEXT,
+                color TEXT,
+                lost_place TEXT,
+                lost_time TEXT,
+                owner_name TEXT,
+                phone TEXT,
+                picture_url TEXT,
+                created_at TEXT,
+                status TEXT DEFAULT 'Open',
+                notified INTEGER DEFAULT 0,
+                content_hash TEXT,
+                city TEXT,
+                district TEXT,
+                lat REAL,
+                lon REAL
+            )
+        ''')
+
+        # 已關閉案件 (冷資料)：lost_pets 只留 Open 案件，關閉時整列移到這裡；重新開啟時再移回
+        # 欄位同 lost_pets，另記錄這次開啟與關閉的時間 (舊資料移轉時關閉時間不明，為 NULL)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS lost_pets_archive (
+                id TEXT PRIMARY KEY,
+                chip_num TEXT,
+                pet_name TEXT,
+                pet_type TEXT,
+                breed TEXT,
+                sex TEXT,
+                color TEXT,
+                lost_place TEXT,
+                lost_time TEXT,
+                owner_name TEXT,
+                phone TEXT,
+                picture_url TEXT,
+                created_at TEXT,
+                status TEXT DEFAULT 'Close',
+                notified INTEGER DEFAULT 0,
+                content_hash TEXT,
+                city TEXT,
+                district TEXT,
+                lat REAL,
+                lon REAL,
+                opened_at TEXT,
+                closed_at TEXT
+            )
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_archive_time_id ON lost_pets_archive (lost_time, id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_archive_city_time ON lost_pets_archive (city, lost_time)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_archive_district_time ON lost_pets_archive (district, lost_time)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_archive_closed_at ON lost_pets_archive (closed_at)")
+
+        # 案件狀態變更紀錄 (只新增、不修改)：opened / closed / reopened
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS pet_status_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                pet_id TEXT NOT NULL,
+                event TEXT NOT NULL,
+                at TEXT             -- 與 created_at 同格式；舊資料移轉的關閉時間不明時為 NULL
+            )
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_status_log_pet ON pet_status_log (pet_id, id)")
+
+        # 舊版資料庫補上新欄位 (內容指紋、正規化縣市/鄉鎮區、座標)
+        added = _add_missing_columns(c, "lost_pets", {"content_hash": "TEXT", "city": "TEXT", "district": "TEXT",
+                                                      "lat": "REAL", "lon": "REAL"})
+        locations_added = "city" in added or "lat" in added
+        if "lat" in added:
+            # 已解析過縣市的舊資料也要補座標：清空 city 讓 backfill_locations 重新處理
+            c.execute("UPDATE lost_pets SET city = NULL")
     
-    # 加上索引以加速查詢
-    c.execute("CREATE INDEX IF NOT EXISTS idx_status_time ON lost_pets (status, lost_time)")
+        # 用戶訂閱表 (用於通知功能)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS subscriptions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                platform TEXT,  -- 'line', 'discord'
+                webhook_url TEXT,
+                city_filter TEXT, -- e.g., '台北市'
+                created_at TEXT
+            )
+        ''')
+
+        # 動物醫院表
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS vet_clinics (
+                id TEXT PRIMARY KEY,
+                name TEXT,
+                tel TEXT,
+                address TEXT,
+                doctor_name TEXT,
+                google_map_link TEXT,
+                updated_at TEXT,
+                city TEXT,
+                district TEXT,
+                lat REAL,
+                lon REAL
+            )
+        ''')
+        added = _add_missing_columns(c, "vet_clinics", {"city": "TEXT", "district": "TEXT",
+                                                        "lat": "REAL", "lon": "REAL"})
+        if "lat" in added:
+            c.execute("UPDATE vet_clinics SET city = NULL")
     
-    conn.commit()
-    conn.close()
+        # 加上索引以加速查詢
+        # (status, lost_time, id) 同時支援日期篩選與 keyset 分頁，取代舊的 (status, lost_time)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_status_time_id ON lost_pets (status, lost_time, id)")
+        c.execute("DROP INDEX IF EXISTS idx_status_time")
+        # 縣市 / 鄉鎮區等值查詢
+        c.execute("CREATE INDEX IF NOT EXISTS idx_status_city_time ON lost_pets (status, city, lost_time)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_status_district_time ON lost_pets (status, district, lost_time)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_clinic_city_district ON vet_clinics (city, district)")
+
+        # 通知外寄佇列 (Outbox)：爬蟲只負責寫入，由 notifier 的 worker 非同步投遞
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS notification_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                pet_id TEXT,
+                platform TEXT,          -- 'line', 'discord'
+                endpoint TEXT,          -- webhook URL / token (用於分開限速)
+                payload TEXT,           -- 案件資料 (JSON)
+                status TEXT DEFAULT 'pending',  -- pending / sending / sent / failed / suppressed
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL,   -- epoch 秒
+                created_at REAL,
+                sent_at REAL,
+                last_error TEXT,
+                UNIQUE (pet_id, platform, endpoint)
+            )
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status_next ON notification_outbox (status, next_attempt_at)")
+
+        # 系統資訊 (資料世代、爬蟲上次執行時間等)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS app_meta (
+                key TEXT PRIMARY KEY,
+                value
+            )
+        ''')
+
+        # 跨行程租約 (爬蟲領導者選舉)：過期前只有 holder 能續約
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                acquired_at REAL,       -- epoch 秒，holder 取得租約的時間
+                expires_at REAL NOT NULL
+            )
+        ''')
+
+        # 照片索引：photos 以原圖內容雜湊為鍵 (相同圖片只算一次)，pet_photos 記錄案件目前照片網址對應的內容
+        # phash 為 64-bit 感知雜湊 (以有號整數存放)；下載失敗且不需重試時 sha256 為 NULL、error 記錄原因
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS photos (
+                sha256 TEXT PRIMARY KEY,
+                phash INTEGER NOT NULL,
+                width INTEGER,
+                height INTEGER,
+                created_at REAL
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS pet_photos (
+                pet_id TEXT PRIMARY KEY,
+                url TEXT,               -- 處理時的 picture_url，網址變更後重新下載
+                sha256 TEXT,
+                fetched_at REAL,
+                error TEXT
+            )
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_pet_photos_url ON pet_photos (url)")
+
+        # 拾獲比對用的反向索引 (只含 Open 案件)：(種類, 地區, 走失週, 品種 / 毛色 token) -> 案件
+        # 每列附帶計分需要的正規化欄位，比對時不必回查 lost_pets；由同步流程在同一交易中增量維護
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS pet_match_index (
+                pet_type TEXT,
+                area TEXT,          -- 縣市 + 鄉鎮區 (只知道縣市時為縣市)
+                week INTEGER,       -- lost_day // 7
+                token TEXT,         -- b:品種 / c:毛色 / * (兩者皆不詳)
+                pet_id TEXT,
+                breed TEXT,
+                sex TEXT,
+                colors TEXT,
+                lost_day INTEGER,   -- 1970-01-01 起算的天數
+                PRIMARY KEY (pet_type, area, week, token, pet_id)
+            ) WITHOUT ROWID
+        ''')
+
+        # 統計彙總表：(日期, 種類, 縣市) -> Open 案件數，由同步流程增量維護
+        stats_exists = c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='pet_stats_daily'").fetchone()
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS pet_stats_daily (
+                day TEXT,
+                pet_type TEXT,
+                city TEXT,
+                open_count INTEGER,
+                PRIMARY KEY (day, pet_type, city)
+            ) WITHOUT ROWID
+        ''')
+        if not stats_exists:
+            _apply_stat_deltas(c, _compute_pet_stats(c))
+
+        # 全文檢索索引 (FTS5 trigram，適合中文子字串搜尋)
+        for table, columns in FTS_TABLES.items():
+            _init_fts(c, table, columns)
+
+        # 座標空間索引 (R*Tree)
+        for table in GEO_TABLES:
+            _init_geo(c, table)
+
+    # 舊資料回填縣市 / 鄉鎮區 / 座標 (分批，不長時間鎖住寫入)
+    filled = backfill_locations()
+    if locations_added and filled:
+        # 統計表的縣市鍵改用正規化縣市，需重建
+        rebuild_pet_stats()
+
+    # 舊資料的已關閉案件移到 lost_pets_archive (分批)
+    archive_closed_pets()
+
+    # 比對索引剛建立或正規化規則 (MATCH_INDEX_VERSION) 變更時重建；在回填之後，地區才是正確的
+    if get_meta("match_index_version") != MATCH_INDEX_VERSION:
+        rebuild_match_index()
+
+    # 回填也完成後才記錄版本，中途中斷時下次啟動會重做
+    with write_connection() as conn:
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
     print(f"[{datetime.now()}] ✅ 資料庫 {DB_NAME} 初始化完成 (含索引)")
 
+def _add_missing_columns(c, table, columns: dict):
+    """補上舊版資料庫缺少的欄位，回傳實際新增的欄位名稱"""
+    existing_cols = {row[1] for row in c.execute(f"PRAGMA table_info({table})")}
+    added = []
+    for name, col_type in columns.items():
+        if name not in existing_cols:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {name} {col_type}")
+            added.append(name)
+    return added
+
+def _location(text):
+    """
+    解析地點 -> (city, district, lat, lon)
+    縣市/鄉鎮區無法判斷時存空字串 (NULL 代表尚未解析)；座標取離線對照表的鄉鎮區代表點
+    """
+    city, district = parse_location(text)
+    point = locate(city, district) or (None, None)
+    return (city or "", district or "") + tuple(point)
+
+@DB_CALL_SECONDS.time()
+def backfill_locations(batch_size=2000):
+    """
+    為尚未解析的舊資料填入 city / district / 座標，每批一個交易
+    :return: 回填筆數
+    """
+    total = 0
+    for table, source in (("lost_pets", "lost_place"), ("vet_clinics", "address")):
+        while True:
+            with read_connection() as conn:
+                rows = conn.execute(f"SELECT rowid, {source} FROM {table} WHERE city IS NULL LIMIT ?",
+                                    (batch_size,)).fetchall()
+            if not rows:
+                break
+            updates = [_location(row[1]) + (row[0],) for row in rows]
+            with write_connection() as conn:
+                conn.executemany(f"UPDATE {table} SET city = ?, district = ?, lat = ?, lon = ? WHERE rowid = ?",
+                                 updates)
+            total += len(rows)
+    if total:
+        print(f"[{datetime.now()}] 🗺️ 已回填 {total} 筆縣市/鄉鎮區")
+    return total
+
+# lost_pets 與 lost_pets_archive 共有的欄位 (status 另外指定)
+_ARCHIVE_COPY_COLUMNS = ("id, chip_num, pet_name, pet_type, breed, sex, color, lost_place, lost_time, owner_name, "
+                         "phone, picture_url, created_at, notified, content_hash, city, district, lat, lon")
+
+def _log_status(c, events):
+    """在既有交易中寫入狀態變更紀錄 [(pet_id, event, at), ...]"""
+    if events:
+        c.executemany("INSERT INTO pet_status_log (pet_id, event, at) VALUES (?, ?, ?)", events)
+
+def _archive_pets(c, ids, closed_at):
+    """
+    在既有交易中把案件從 lost_pets 移到 lost_pets_archive 並記錄關閉
+    opened_at 取自狀態紀錄中最近一次開啟；closed_at 為 None 表示關閉時間不明
+    """
+    batch_size = 900
+    for i in range(0, len(ids), batch_size):
+        batch = ids[i:i+batch_size]
+        placeholders = ','.join(['?'] * len(batch))
+        c.execute(f'''
+            INSERT OR REPLACE INTO lost_pets_archive ({_ARCHIVE_COPY_COLUMNS}, status, opened_at, closed_at)
+            SELECT {_ARCHIVE_COPY_COLUMNS}, 'Close',
+                   (SELECT at FROM pet_status_log l WHERE l.pet_id = p.id AND l.event <> 'closed'
+                    ORDER BY l.id DESC LIMIT 1),
+                   ?
+            FROM lost_pets p WHERE id IN ({placeholders})
+        ''', [closed_at, *batch])
+        c.execute(f"DELETE FROM lost_pets WHERE id IN ({placeholders})", batch)
+    _log_status(c, [(pet_id, 'closed', closed_at) for pet_id in ids])
+
+@DB_CALL_SECONDS.time()
+def archive_closed_pets(batch_size=2000):
+    """
+    舊資料移轉：為既有案件補上開啟紀錄，再把 lost_pets 中已關閉的案件分批移到 lost_pets_archive
+    每批一個交易，不長時間鎖住寫入；可重複執行，中斷後下次從剩下的繼續
+    舊資料沒有時間紀錄：開啟時間以第一次抓到的時間 (created_at) 代替，關閉時間不明 (NULL)
+    :return: 移轉的已關閉案件數
+    """
+    with read_connection() as conn:
+        max_rowid = conn.execute("SELECT MAX(rowid) FROM lost_pets").fetchone()[0] or 0
+    for start in range(0, max_rowid, batch_size):
+        with write_connection() as conn:
+            conn.execute('''
+                INSERT INTO pet_status_log (pet_id, event, at)
+                SELECT id, 'opened', created_at FROM lost_pets p
+                WHERE rowid > ? AND rowid <= ?
+                  AND NOT EXISTS (SELECT 1 FROM pet_status_log l WHERE l.pet_id = p.id)
+                ORDER BY rowid
+            ''', (start, start + batch_size))
+
+    moved = 0
+    while True:
+        with write_connection() as conn:
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            ids = [row[0] for row in c.execute("SELECT id FROM lost_pets WHERE status <> 'Open' LIMIT ?",
+                                               (batch_size,))]
+            if not ids:
+                break
+            _archive_pets(c, ids, None)
+        moved += len(ids)
+    if moved:
+        print(f"[{datetime.now()}] 🗄️ 已將 {moved} 筆已關閉案件移到 lost_pets_archive")
+    return moved
+
+def _bump_generation(c, key='generation'):
+    """資料世代 +1：讀取端的回應快取以此判斷資料是否變動"""
+    c.execute('''
+        INSERT INTO app_meta (key, value) VALUES (?, 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1
+    ''', (key,))
+
+@DB_CALL_SECONDS.time()
+def get_generation(key='generation'):
+    """目前的資料世代 (每次寫入有變動的同步後遞增；照片索引另用 photo_generation)"""
+    with read_connection() as conn:
+        row = conn.execute("SELECT value FROM app_meta WHERE key = ?", (key,)).fetchone()
+    return int(row[0]) if row else 0
+
+@DB_CALL_SECONDS.time()
+def get_meta(key, default=None):
+    with read_connection() as conn:
+        row = conn.execute("SELECT value FROM app_meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+@DB_CALL_SECONDS.time()
+def set_meta(key, value):
+    with write_connection() as conn:
+        conn.execute('''
+            INSERT INTO app_meta (key, value) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        ''', (key, value))
+
+@DB_CALL_SECONDS.time()
+def acquire_lease(name, holder, ttl):
+    """
+    取得或續約租約 (單一敘述，跨行程原子)
+    :return: 是否持有租約；他人持有且尚未過期時為 False
+    """
+    now = time.time()
+    with write_connection() as conn:
+        cur = conn.execute('''
+            INSERT INTO leases (name, holder, acquired_at, expires_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                holder = excluded.holder,
+                acquired_at = CASE WHEN leases.holder = excluded.holder
+                                   THEN leases.acquired_at ELSE excluded.acquired_at END,
+                expires_at = excluded.expires_at
+            WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+        ''', (name, holder, now, now + ttl, now))
+        return cur.rowcount == 1
+
+@DB_CALL_SECONDS.time()
+def release_lease(name, holder):
+    """釋放自己持有的租約 (正常結束時呼叫，其他行程不必等到過期)"""
+    with write_connection() as conn:
+        conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+def get_lease(name):
+    """租約目前狀態；沒有人持有時回傳 None"""
+    with read_connection() as conn:
+        row = conn.execute("SELECT * FROM leases WHERE name = ?", (name,)).fetchone()
+    return dict(row) if row else None
+
+def _text(value):
+    if value is None or (isinstance(value, float) and value != value):
+        return ""
+    return str(value)
+
+def _add_stat(deltas: dict, lost_time, pet_type, city, n):
+    key = (_text(lost_time), _text(pet_type), _text(city))
+    deltas[key] = deltas.get(key, 0) + n
+
+def _apply_stat_deltas(c, deltas: dict):
+    """將 (日期, 種類, 縣市) 的 Open 案件增減量累加進 pet_stats_daily"""
+    rows = [(day, pet_type, city, n) for (day, pet_type, city), n in deltas.items() if n]
+    if not rows:
+        return
+    c.executemany('''
+        INSERT INTO pet_stats_daily (day, pet_type, city, open_count) VALUES (?, ?, ?, ?)
+        ON CONFLICT(day, pet_type, city) DO UPDATE SET open_count = open_count + excluded.open_count
+    ''', rows)
+    c.execute("DELETE FROM pet_stats_daily WHERE open_count = 0")
+
+def _compute_pet_stats(c):
+    """從 lost_pets 重新計算統計 (用於重建與一致性檢查)"""
+    c.execute('''
+        SELECT COALESCE(lost_time, ''), COALESCE(pet_type, ''), COALESCE(city, ''), COUNT(*)
+        FROM lost_pets WHERE status = 'Open'
+        GROUP BY 1, 2, 3
+    ''')
+    return {(row[0], row[1], row[2]): row[3] for row in c.fetchall()}
+
+@DB_CALL_SECONDS.time()
+def rebuild_pet_stats():
+    """從頭重建 pet_stats_daily"""
+    with write_connection() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("DELETE FROM pet_stats_daily")
+        _apply_stat_deltas(c, _compute_pet_stats(c))
+
+@DB_CALL_SECONDS.time()
+def check_pet_stats(repair=False):
+    """
+    一致性檢查：重新計算並與增量維護的 pet_stats_daily 比對
+    :param repair: 不一致時是否直接重建
+    :return: dict - ok 與不一致的列 [(day, pet_type, city, 表中數字, 實際數字), ...]
+    """
+    with read_connection() as conn:
+        c = conn.cursor()
+        expected = _compute_pet_stats(c)
+        c.execute("SELECT day, pet_type, city, open_count FROM pet_stats_daily")
+        actual = {(row[0], row[1], row[2]): row[3] for row in c.fetchall()}
+
+    mismatches = [key + (actual.get(key, 0), expected.get(key, 0))
+                  for key in sorted(set(expected) | set(actual))
+                  if actual.get(key, 0) != expected.get(key, 0)]
+    if mismatches:
+        print(f"[{datetime.now()}] ⚠️ 統計表有 {len(mismatches)} 列不一致{'，重建中' if repair else ''}")
+        if repair:
+            rebuild_pet_stats()
+    return {"ok": not mismatches, "mismatches": mismatches}
+
+@DB_CALL_SECONDS.time()
+def get_stats(days=30, breakdown=()):
+    """
+    從 pet_stats_daily 彙總最近 days 天的 Open 案件數
+    :param breakdown: 需要的細項 ('city', 'day')
+    """
+    from datetime import timedelta
+    cutoff_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+
+    with read_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT pet_type, SUM(open_count) FROM pet_stats_daily WHERE day >= ? GROUP BY pet_type",
+                  (cutoff_date,))
+        by_type = c.fetchall()
+
+        total_open = sum(row[1] for row in by_type)
+        dogs = sum(row[1] for row in by_type if "狗" in row[0])
+        cats = sum(row[1] for row in by_type if "貓" in row[0])
+
+        result = {
+            "days": days,
+            "total_active_cases": total_open,
+            "dogs": dogs,
+            "cats": cats,
+            "others": total_open - dogs - cats
+        }
+
+        if "city" in breakdown:
+            c.execute('''
+                SELECT city, SUM(open_count) FROM pet_stats_daily WHERE day >= ?
+                GROUP BY city ORDER BY 2 DESC
+            ''', (cutoff_date,))
+            result["by_city"] = {row[0]: row[1] for row in c.fetchall()}
+
+        if "day" in breakdown:
+            c.execute('''
+                SELECT day, SUM(open_count) FROM pet_stats_daily WHERE day >= ?
+                GROUP BY day ORDER BY day DESC
+            ''', (cutoff_date,))
+            result["by_day"] = {row[0]: row[1] for row in c.fetchall()}
+
+    return result
+
+_MATCH_INSERT = '''
+    INSERT OR REPLACE INTO pet_match_index (pet_type, area, week, token, pet_id, breed, sex, colors, lost_day)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+def _match_rows(pet_id, pet_type, breed, sex, color, lost_time, city, district):
+    """一筆案件 -> pet_match_index 的列 (欄位順序同 _MATCH_INSERT)"""
+    return [row[:4] + (pet_id,) + row[4:]
+            for row in index_rows(pet_type, breed, sex, color, lost_time, city, district)]
+
+def _index_matches(c, pets):
+    """
+    在既有交易中將案件加入比對索引
+    :param pets: [(id, pet_type, breed, sex, color, lost_time, city, district), ...]
+    """
+    rows = [row for pet in pets for row in _match_rows(*pet)]
+    if rows:
+        c.executemany(_MATCH_INSERT, rows)
+
+def _unindex_matches(c, pets):
+    """在既有交易中移除案件「舊內容」的索引列 (由舊內容重算出完整主鍵刪除，不需要 pet_id 的索引)"""
+    keys = [row[:5] for pet in pets for row in _match_rows(*pet)]
+    if keys:
+        c.executemany("DELETE FROM pet_match_index WHERE pet_type = ? AND area = ? AND week = ? AND token = ? AND pet_id = ?",
+                      keys)
+
+@DB_CALL_SECONDS.time()
+def rebuild_match_index():
+    """從 Open 案件重建比對索引 (單一交易，重建期間的同步寫入會等待，索引不會與 lost_pets 不一致)"""
+    with write_connection() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("DELETE FROM pet_match_index")
+        pets = conn.execute("SELECT id, pet_type, breed, sex, color, lost_time, city, district FROM lost_pets WHERE status = 'Open'")
+        count = 0
+        while True:
+            batch = pets.fetchmany(5000)
+            if not batch:
+                break
+            _index_matches(c, batch)
+            count += len(batch)
+        c.execute('''
+            INSERT INTO app_meta (key, value) VALUES ('match_index_version', ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        ''', (MATCH_INDEX_VERSION,))
+    print(f"[{datetime.now()}] 🔎 比對索引已重建 ({count} 筆 Open 案件)")
+    return count
+
+@DB_CALL_SECONDS.time()
 def upsert_pet(pet_data: dict):
     """
     新增或更新寵物資料
     :param pet_data: 字典格式的寵物資料
     :return: is_new (Boolean) - 是否為新案件
     """
-    conn = get_db_connection()
-    c = conn.cursor()
-    
-    pet_id = pet_data.get("UniqueKey")
+    return bool(upsert_pets([pet_data]))
+
+def _pet_row(pet: dict, now: str):
+    city, district, lat, lon = _location(pet.get("LostPlace", ""))
+    return (
+        pet.get("UniqueKey"),
+        pet.get("ChipNum", ""),
+        pet.get("PetName", ""),
+        pet.get("PetType", ""),
+        pet.get("Breed", ""),
+        pet.get("Sex", ""),
+        pet.get("Color", ""),
+        pet.get("LostPlace", ""),
+        pet.get("LostTime", ""),
+        pet.get("OwnerName", ""),
+        pet.get("Phone", ""),
+        pet.get("Picture", ""),
+        now,
+        'Open',
+        pet.get("Fingerprint", ""),
+        city,
+        district,
+        lat,
+        lon
+    )
+
+def _write_pets(c, records: list):
+    """
+    在既有交易中寫入一批寵物資料，只寫入指紋 (Fingerprint) 有變動的列
+    :return: (new_ids, changed_ids, unchanged_count)
+    """
     now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    
-    # 檢查是否存在
-    c.execute('SELECT id FROM lost_pets WHERE id = ?', (pet_id,))
-    exists = c.fetchone()
-    
-    is_new = False
-    
-    if not exists:
-        # 新增
-        c.execute('''
-            INSERT INTO lost_pets (
-                id, chip_num, pet_name, pet_type, breed, sex, color, 
-                lost_place, lost_time, owner_name, phone, picture_url, 
-                created_at, status
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            pet_id,
-            pet_data.get("ChipNum", ""),
-            pet_data.get("PetName", ""),
-            pet_data.get("PetType", ""),
-            pet_data.get("Breed", ""),
-            pet_data.get("Sex", ""),
-            pet_data.get("Color", ""),
-            pet_data.get("LostPlace", ""),
-            pet_data.get("LostTime", ""),
-            pet_data.get("OwnerName", ""),
-            pet_data.get("Phone", ""),
-            pet_data.get("Picture", ""),
-            now,
-            'Open'
-        ))
-        is_new = True
-    else:
-        # 更新 (通常政府資料會變動不多，但可以更新狀態或圖片)
-        c.execute('''
-            UPDATE lost_pets SET 
-                status = 'Open',
-                lost_place = ?,
-                phone = ?,
-                picture_url = ?
-            WHERE id = ?
-        ''', (
-            pet_data.get("LostPlace", ""),
-            pet_data.get("Phone", ""),
-            pet_data.get("Picture", ""),
-            pet_id
-        ))
-    
-    conn.commit()
-    conn.close()
-    return is_new
 
-def upsert_clinic(clinic_data: dict):
-    """新增或更新動物醫院"""
-    conn = get_db_connection()
-    c = conn.cursor()
-    
+    # 同批次重複的 ID 以最後一筆為準
+    latest = {}
+    for pet in records:
+        latest[pet.get("UniqueKey")] = pet
+
+    # 先撈出既有的指紋與狀態 (分批避免參數過多)
+    batch_ids = list(latest)
+    existing = {}
+    batch_size = 900
+    for i in range(0, len(batch_ids), batch_size):
+        batch = batch_ids[i:i+batch_size]
+        placeholders = ','.join(['?'] * len(batch))
+        c.execute(f"SELECT id, content_hash, status, lost_time, pet_type, city, breed, sex, color, district "
+                  f"FROM lost_pets WHERE id IN ({placeholders})", batch)
+        existing.update((row[0], tuple(row[1:])) for row in c.fetchall())
+
+    # 不在 lost_pets 的 ID 再查封存表：已關閉後又出現的案件要移回 (保留第一次抓到的時間)
+    archived = {}
+    unknown_ids = [pet_id for pet_id in batch_ids if pet_id not in existing]
+    for i in range(0, len(unknown_ids), batch_size):
+        batch = unknown_ids[i:i+batch_size]
+        placeholders = ','.join(['?'] * len(batch))
+        c.execute(f"SELECT id, created_at FROM lost_pets_archive WHERE id IN ({placeholders})", batch)
+        archived.update((row[0], row[1]) for row in c.fetchall())
+
+    new_rows = []
+    changed_rows = []
+    unchanged_count = 0
+    stat_deltas = {}
+    unindexed = []
+    events = []
+    for pet_id, pet in latest.items():
+        if pet_id not in existing:
+            row = _pet_row(pet, now)
+            if pet_id in archived:
+                row = row[:12] + (archived[pet_id],) + row[13:]
+                changed_rows.append(row)
+                events.append((pet_id, 'reopened', now))
+            else:
+                new_rows.append(row)
+                events.append((pet_id, 'opened', now))
+            _add_stat(stat_deltas, row[8], row[3], row[15], 1)
+            continue
+        old_hash, old_status, old_time, old_type, old_city, old_breed, old_sex, old_color, old_district = existing[pet_id]
+        fingerprint = pet.get("Fingerprint", "")
+        # 沒有指紋的資料 (非 MOAClient 來源) 一律視為有變動
+        if fingerprint and fingerprint == old_hash and old_status == 'Open':
+            unchanged_count += 1
+        else:
+            row = _pet_row(pet, now)
+            changed_rows.append(row)
+            if old_status == 'Open':
+                _add_stat(stat_deltas, old_time, old_type, old_city, -1)
+                unindexed.append((pet_id, old_type, old_breed, old_sex, old_color, old_time, old_city, old_district))
+            else:
+                events.append((pet_id, 'reopened', now))
+            _add_stat(stat_deltas, row[8], row[3], row[15], 1)
+
+    c.executemany('''
+        INSERT INTO lost_pets (
+            id, chip_num, pet_name, pet_type, breed, sex, color,
+            lost_place, lost_time, owner_name, phone, picture_url,
+            created_at, status, content_hash, city, district, lat, lon
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            status = 'Open',
+            pet_type = excluded.pet_type,
+            breed = excluded.breed,
+            sex = excluded.sex,
+            color = excluded.color,
+            lost_place = excluded.lost_place,
+            lost_time = excluded.lost_time,
+            owner_name = excluded.owner_name,
+            phone = excluded.phone,
+            picture_url = excluded.picture_url,
+            content_hash = excluded.content_hash,
+            city = excluded.city,
+            district = excluded.district,
+            lat = excluded.lat,
+            lon = excluded.lon
+    ''', new_rows + changed_rows)
+    if archived:
+        c.executemany("DELETE FROM lost_pets_archive WHERE id = ?", [(pet_id,) for pet_id in archived])
+    _log_status(c, events)
+    _apply_stat_deltas(c, stat_deltas)
+    _unindex_matches(c, unindexed)
+    _index_matches(c, [(row[0], row[3], row[4], row[5], row[6], row[8], row[15], row[16])
+                       for row in new_rows + changed_rows])
+    if new_rows or changed_rows:
+        _bump_generation(c)
+
+    new_ids = {row[0] for row in new_rows}
+    changed_ids = {row[0] for row in changed_rows}
+    return new_ids, changed_ids, unchanged_count
+
+@DB_CALL_SECONDS.time()
+def upsert_pets(records: list):
+    """
+    批次新增或更新寵物資料 (單一交易 + ON CONFLICT)
+    :param records: List of dict (MOAClient 清洗後的格式)
+    :return: new_ids (set) - 本批次中新出現的案件 ID
+    """
+    if not records:
+        return set()
+
+    with write_connection() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        new_ids, _, _ = _write_pets(c, records)
+
+    return new_ids
+
+@DB_CALL_SECONDS.time()
+def sync_pets(records: list, close_missing=True, outbox_targets=None):
+    """
+    同步一次完整抓取的結果：寫入有變動的案件，並關閉來源已撤銷的案件 (單一交易)
+    :param records: List of dict (MOAClient 清洗後的格式)
+    :param close_missing: 是否關閉不在 records 中的案件；只有完整抓取時才可為 True
+    :param outbox_targets: [(platform, endpoint), ...]；新案件會在同一交易中寫入通知佇列
+    :return: dict - 變動摘要
+        new_ids / changed_ids: 新增與內容變動的案件 ID
+        inserted / changed / unchanged / closed: 各類筆數
+    """
+    summary = {"new_ids": set(), "changed_ids": set(),
+               "inserted": 0, "changed": 0, "unchanged": 0, "closed": 0}
+    if not records:
+        return summary
+
+    with write_connection() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        new_ids, changed_ids, unchanged_count = _write_pets(c, records)
+        if outbox_targets and new_ids:
+            new_pets = {pet["UniqueKey"]: pet for pet in records if pet.get("UniqueKey") in new_ids}
+            _enqueue_notifications(c, list(new_pets.values()), outbox_targets)
+        closed_count = 0
+        if close_missing:
+            active_ids = [pet["UniqueKey"] for pet in records if "UniqueKey" in pet]
+            closed_count = _close_missing(c, active_ids)
+
+    summary.update({
+        "new_ids": new_ids,
+        "changed_ids": changed_ids,
+        "inserted": len(new_ids),
+        "changed": len(changed_ids),
+        "unchanged": unchanged_count,
+        "closed": closed_count
+    })
+    return summary
+
+class SeenIds:
+    """
+    爬取過程中看過的案件 ID，只存 64-bit 雜湊 (每筆 8 bytes)
+    全量爬取時不必把所有 ID 字串留在記憶體，最後仍可找出未出現的 Open 案件
+    雜湊存在排序好的 array (二分搜尋)，新加入的先放在小 set，累積夠多再併入，
+    每頁都能便宜地查詢某個 ID 是否已出現過
+    """
+    # 新雜湊累積到 max(此值, 已排序筆數 / 4) 時併入排序 array (攤銷後每筆 O(log n))
+    MERGE_THRESHOLD = 4096
+
+    def __init__(self, ids=()):
+        self._hashes = array("Q")
+        self._recent = set()
+        self.add_many(ids)
+
+    @staticmethod
+    def _hash(pet_id):
+        return int.from_bytes(hashlib.blake2b(str(pet_id).encode("utf-8"), digest_size=8).digest(), "big")
+
+    def _contains_hash(self, value):
+        if value in self._recent:
+            return True
+        i = bisect_left(self._hashes, value)
+        return i < len(self._hashes) and self._hashes[i] == value
+
+    def add_many(self, ids):
+        self.add_new(ids)
+
+    def add_new(self, ids):
+        """加入 ids，回傳其中先前沒出現過的 ID (set)"""
+        fresh = set()
+        hashes, recent, count = self._hashes, self._recent, len(self._hashes)
+        for pet_id in ids:
+            value = self._hash(pet_id)
+            if value in recent:
+                continue
+            i = bisect_left(hashes, value)
+            if i == count or hashes[i] != value:
+                recent.add(value)
+                fresh.add(pet_id)
+        if len(self._recent) > max(self.MERGE_THRESHOLD, len(self._hashes) // 4):
+            self._hashes = array("Q", sorted(self._hashes + array("Q", self._recent)))
+            self._recent = set()
+        return fresh
+
+    def __contains__(self, pet_id):
+        return self._contains_hash(self._hash(pet_id))
+
+    def __len__(self):
+        """不重複的 ID 數"""
+        return len(self._hashes) + len(self._recent)
+
+    def missing(self, items, key=None):
+        """
+        逐筆比對 items，回傳 ID 沒出現過的項目 (items 可為資料庫 cursor，不需整批載入)
+        :param key: 從項目取出 ID 的函式 (預設項目本身即為 ID)
+        """
+        seen = set(self._hashes)
+        seen.update(self._recent)
+        return [item for item in items if self._hash(key(item) if key else item) not in seen]
+
+class PetIngest:
+    """
+    串流同步：每收到一頁就寫入 (各頁一個交易)，同時累積看過的 ID
+    全部頁面處理完後呼叫 finish()，只有完整爬取才關閉未出現的案件
+    """
+    def __init__(self, outbox_targets=None):
+        self.outbox_targets = outbox_targets
+        self.seen = SeenIds()
+        self.summary = {"pages": 0, "inserted": 0, "changed": 0, "unchanged": 0, "closed": 0}
+
+    @DB_CALL_SECONDS.time()
+    def write_page(self, records: list):
+        """
+        寫入一頁資料 (新案件在同一交易中寫入通知佇列)
+        本次爬取較早頁面已出現過的 ID 略過 (以第一次出現的為準)：上游分頁時同一案件可能出現在兩頁，
+        若再寫入一次會被算成「變動」，且兩個版本每次爬取都互相覆寫
+        :return: dict - 該頁的 new_ids / changed_ids / unchanged
+        """
+        fresh = self.seen.add_new(pet["UniqueKey"] for pet in records if "UniqueKey" in pet)
+        records = [pet for pet in records if "UniqueKey" not in pet or pet["UniqueKey"] in fresh]
+        new_ids, changed_ids, unchanged_count = set(), set(), 0
+        if records:
+            with write_connection() as conn:
+                c = conn.cursor()
+                c.execute("BEGIN IMMEDIATE")
+                new_ids, changed_ids, unchanged_count = _write_pets(c, records)
+                if self.outbox_targets and new_ids:
+                    new_pets = {pet["UniqueKey"]: pet for pet in records if pet.get("UniqueKey") in new_ids}
+                    _enqueue_notifications(c, list(new_pets.values()), self.outbox_targets)
+
+        self.summary["pages"] += 1
+        self.summary["inserted"] += len(new_ids)
+        self.summary["changed"] += len(changed_ids)
+        self.summary["unchanged"] += unchanged_count
+        return {"new_ids": new_ids, "changed_ids": changed_ids, "unchanged": unchanged_count}
+
+    @DB_CALL_SECONDS.time()
+    def mark_seen(self, ids):
+        """內容未變動而略過寫入的頁面：只記錄其中的 ID，避免被當成已撤銷"""
+        self.seen.add_many(ids)
+
+    @DB_CALL_SECONDS.time()
+    def finish(self, complete: bool):
+        """
+        收尾：complete 為 True (每一頁都成功) 才關閉本次沒看到的 Open 案件
+        :return: dict - 累計的 pages / inserted / changed / unchanged / closed / seen
+        """
+        if complete and len(self.seen):
+            self.summary["closed"] = close_missing_pets(self.seen)
+        self.summary["seen"] = len(self.seen)
+        return dict(self.summary)
+
+def _clinic_row(clinic_data: dict, now: str):
     # 使用 名稱+地址 作為唯一ID (未必完美但堪用)
     unique_id = f"{clinic_data.get('name')}_{clinic_data.get('address')}"
-    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-    c.execute('''
-        INSERT OR REPLACE INTO vet_clinics (
-            id, name, tel, address, doctor_name, google_map_link, updated_at
-        ) VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (
+    city, district, lat, lon = _location(clinic_data.get('address', ''))
+    return (
         unique_id,
         clinic_data.get('name', ''),
         clinic_data.get('tel', ''),
         clinic_data.get('address', ''),
         clinic_data.get('doctor_name', ''),
         clinic_data.get('google_map_link', ''),
-        now
-    ))
-    
-    conn.commit()
-    conn.close()
+        now,
+        city,
+        district,
+        lat,
+        lon
+    )
+
+_CLINIC_INSERT_COLUMNS = "id, name, tel, address, doctor_name, google_map_link, updated_at, city, district, lat, lon"
+# 來源提供的內容欄位 (比對快照差異用；city/district/座標由 address 推導)
+_CLINIC_CONTENT_COLUMNS = ["name", "tel", "address", "doctor_name", "google_map_link"]
+
+def _clinic_changed_sql(new, old):
+    """兩個別名之間任一內容欄位不同的 SQL 條件 (IS NOT 可正確比較 NULL)"""
+    return " OR ".join(f"{new}.{col} IS NOT {old}.{col}" for col in _CLINIC_CONTENT_COLUMNS)
+
+@DB_CALL_SECONDS.time()
+def upsert_clinic(clinic_data: dict):
+    """新增或更新動物醫院"""
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    with write_connection() as conn:
+        conn.execute(f'''
+            INSERT INTO vet_clinics ({_CLINIC_INSERT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                name = excluded.name,
+                tel = excluded.tel,
+                address = excluded.address,
+                doctor_name = excluded.doctor_name,
+                google_map_link = excluded.google_map_link,
+                updated_at = excluded.updated_at,
+                city = excluded.city,
+                district = excluded.district,
+                lat = excluded.lat,
+                lon = excluded.lon
+        ''', _clinic_row(clinic_data, now))
+        _bump_generation(conn)
 
-def close_missing_pets(active_ids: list):
+@DB_CALL_SECONDS.time()
+def replace_clinics(records: list, max_removed_ratio=0.5):
     """
-    將不在 active_ids 列表中的 Open 案件標記為 Close (代表已尋獲或撤銷)
+    以一份完整快照取代動物醫院資料 (單一交易，讀取端只會看到舊快照或新快照)
+    1. 新快照先寫入 writer 連線專用的暫存表 (TEMP，讀取端看不到)
+    2. 以 SQL 比對暫存表與現有資料，算出新增 / 變動 / 移除
+    3. 只把差異套用到 vet_clinics：未變動的列不改寫，全文檢索與座標索引只同步有變動的列
+    :param records: List of dict (name / tel / address / doctor_name / google_map_link)
+    :param max_removed_ratio: 移除筆數超過現有資料的此比例時視為來源異常，不套用
+    :return: dict - added_ids / changed_ids / removed_ids 與 added / changed / removed / unchanged 筆數；
+             未套用時回傳 None
     """
-    if not active_ids:
-        return
-        
-    conn = get_db_connection()
-    c = conn.cursor()
-    
-    # 用 batch 更新比較快，但 SQLite 限制 SQL 長度
-    # 這裡反向操作：先撈出所有狀態為 Open 的 ID
+    if not records:
+        return None
+
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    rows = [_clinic_row(clinic, now) for clinic in records]
+
+    with write_connection() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("DROP TABLE IF EXISTS temp.vet_clinics_staging")
+        c.execute("CREATE TEMP TABLE vet_clinics_staging AS SELECT * FROM main.vet_clinics WHERE 0")
+        c.execute("CREATE UNIQUE INDEX temp.idx_clinic_staging_id ON vet_clinics_staging (id)")
+        # 同一快照內重複的 ID 以最後一筆為準
+        c.executemany(f"INSERT OR REPLACE INTO temp.vet_clinics_staging ({_CLINIC_INSERT_COLUMNS}) "
+                      f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+        added_ids = [row[0] for row in c.execute('''
+            SELECT s.id FROM temp.vet_clinics_staging s
+            WHERE NOT EXISTS (SELECT 1 FROM main.vet_clinics v WHERE v.id = s.id)
+        ''')]
+        removed_ids = [row[0] for row in c.execute('''
+            SELECT v.id FROM main.vet_clinics v
+            WHERE NOT EXISTS (SELECT 1 FROM temp.vet_clinics_staging s WHERE s.id = v.id)
+        ''')]
+        changed_ids = [row[0] for row in c.execute(f'''
+            SELECT s.id FROM temp.vet_clinics_staging s JOIN main.vet_clinics v ON v.id = s.id
+            WHERE {_clinic_changed_sql("s", "v")}
+        ''')]
+        existing_count = c.execute("SELECT COUNT(*) FROM main.vet_clinics").fetchone()[0]
+        staged_count = c.execute("SELECT COUNT(*) FROM temp.vet_clinics_staging").fetchone()[0]
+
+        if existing_count and len(removed_ids) > existing_count * max_removed_ratio:
+            print(f"[{datetime.now()}] ⚠️ 新快照將移除 {len(removed_ids)}/{existing_count} 筆動物醫院，"
+                  f"疑似來源不完整，本次不套用")
+            conn.rollback()
+            return None
+
+        c.execute('''
+            DELETE FROM main.vet_clinics
+            WHERE id NOT IN (SELECT id FROM temp.vet_clinics_staging)
+        ''')
+        # 只改寫內容有變的列 (DO UPDATE ... WHERE)，updated_at 保留上次實際變動的時間
+        c.execute(f'''
+            INSERT INTO main.vet_clinics ({_CLINIC_INSERT_COLUMNS})
+            SELECT {_CLINIC_INSERT_COLUMNS} FROM temp.vet_clinics_staging WHERE true
+            ON CONFLICT(id) DO UPDATE SET
+                name = excluded.name,
+                tel = excluded.tel,
+                address = excluded.address,
+                doctor_name = excluded.doctor_name,
+                google_map_link = excluded.google_map_link,
+                updated_at = excluded.updated_at,
+                city = excluded.city,
+                district = excluded.district,
+                lat = excluded.lat,
+                lon = excluded.lon
+            WHERE {_clinic_changed_sql("excluded", "vet_clinics")}
+        ''')
+        c.execute("DROP TABLE temp.vet_clinics_staging")
+        if added_ids or changed_ids or removed_ids:
+            _bump_generation(c)
+
+    return {
+        "added_ids": added_ids,
+        "changed_ids": changed_ids,
+        "removed_ids": removed_ids,
+        "added": len(added_ids),
+        "changed": len(changed_ids),
+        "removed": len(removed_ids),
+        "unchanged": staged_count - len(added_ids) - len(changed_ids)
+    }
+
+def _close_missing(c, active_ids):
+    """
+    在既有交易中關閉不在 active_ids 內的 Open 案件，回傳關閉筆數
+    :param active_ids: ID 清單或 SeenIds (串流同步時累積的 ID)
+    """
+    # 反向操作：逐列掃過 Open 案件的 ID (lost_pets 只有 Open 案件，只讀索引)，找出 DB 有但 API 沒有的 ID
+    if not isinstance(active_ids, SeenIds):
+        active_ids = SeenIds(active_ids)
     c.execute("SELECT id FROM lost_pets WHERE status = 'Open'")
-    db_open_rows = c.fetchall()
-    db_open_ids = {row[0] for row in db_open_rows}
-    
-    # 找出 DB 有但 API 沒有的 ID (即需關閉者)
-    active_set = set(active_ids)
-    to_close_ids = list(db_open_ids - active_set)
+    to_close_ids = [row[0] for row in active_ids.missing(c, key=lambda row: row[0])]
     
     if to_close_ids:
-        print(f"[{datetime.now()}] 🧹 清理: 發現 {len(to_close_ids)} 筆案件已從來源撤銷，標記為 Close")
-        # 批次更新
+        print(f"[{datetime.now()}] 🧹 清理: 發現 {len(to_close_ids)} 筆案件已從來源撤銷，移到封存表")
         # 分批處理以免太多參數
+        to_close_rows = []
         batch_size = 900
         for i in range(0, len(to_close_ids), batch_size):
             batch = to_close_ids[i:i+batch_size]
             placeholders = ','.join(['?'] * len(batch))
-            sql = f"UPDATE lost_pets SET status = 'Close' WHERE id IN ({placeholders})"
-            c.execute(sql, batch)
+            c.execute(f"SELECT id, lost_time, pet_type, city, breed, sex, color, district FROM lost_pets "
+                      f"WHERE id IN ({placeholders})", batch)
+            to_close_rows.extend(c.fetchall())
+        _archive_pets(c, to_close_ids, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+
+        stat_deltas = {}
+        for _, lost_time, pet_type, city, *_ in to_close_rows:
+            _add_stat(stat_deltas, lost_time, pet_type, city, -1)
+        _apply_stat_deltas(c, stat_deltas)
+        _unindex_matches(c, [(pet_id, pet_type, breed, sex, color, lost_time, city, district)
+                             for pet_id, lost_time, pet_type, city, breed, sex, color, district in to_close_rows])
+        _bump_generation(c)
+
+    return len(to_close_ids)
+
+@DB_CALL_SECONDS.time()
+def close_missing_pets(active_ids):
+    """
+    將不在 active_ids (清單或 SeenIds) 中的 Open 案件關閉並移到封存表 (代表已尋獲或撤銷)
+    :return: 關閉筆數
+    """
+    if not active_ids:
+        return 0
         
-        conn.commit()
-    
-    conn.close()
+    with write_connection() as conn:
+        return _close_missing(conn.cursor(), active_ids)
 
-def get_recent_pets(days=14, city_filter=None, type_filter=None, status='Open'):
-    """取得最近的走失案件 (SQL 優化版)"""
-    conn = get_db_connection()
-    c = conn.cursor()
-    
-    query = "SELECT * FROM lost_pets WHERE status = ?"
+def _enqueue_notifications(c, pets: list, targets: list):
+    now = time.time()
+    rows = [(
+        pet.get("UniqueKey"),
+        platform,
+        endpoint,
+        json.dumps(pet, ensure_ascii=False, default=str),
+        now,
+        now
+    ) for pet in pets for platform, endpoint in targets]
+    # 同一案件同一目的地只排一次
+    c.executemany('''
+        INSERT OR IGNORE INTO notification_outbox (
+            pet_id, platform, endpoint, payload, next_attempt_at, created_at
+        ) VALUES (?, ?, ?, ?, ?, ?)
+    ''', rows)
+    return len(rows)
+
+@DB_CALL_SECONDS.time()
+def enqueue_notifications(pets: list, targets: list):
+    """將案件通知寫入外寄佇列 (不實際發送)"""
+    if not pets or not targets:
+        return 0
+    with write_connection() as conn:
+        return _enqueue_notifications(conn.cursor(), pets, targets)
+
+@DB_CALL_SECONDS.time()
+def claim_outbox(limit=50):
+    """
+    取出到期的待發通知並標記為 sending
+    :return: List of dict (payload 已解析)
+    """
+    now = time.time()
+    with write_connection() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        rows = c.execute('''
+            SELECT * FROM notification_outbox
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY next_attempt_at, id
+            LIMIT ?
+        ''', (now, limit)).fetchall()
+        if rows:
+            c.executemany("UPDATE notification_outbox SET status = 'sending' WHERE id = ?",
+                          [(row["id"],) for row in rows])
+
+    claimed = []
+    for row in rows:
+        item = dict(row)
+        item["payload"] = json.loads(item["payload"])
+        claimed.append(item)
+    return claimed
+
+@DB_CALL_SECONDS.time()
+def reset_stale_outbox():
+    """程序重啟時，把上次中斷在 sending 的通知放回佇列"""
+    with write_connection() as conn:
+        return conn.execute("UPDATE notification_outbox SET status = 'pending' WHERE status = 'sending'").rowcount
+
+@DB_CALL_SECONDS.time()
+def complete_outbox(ids: list):
+    """標記通知已送達"""
+    if not ids:
+        return
+    now = time.time()
+    with write_connection() as conn:
+        conn.executemany('''
+            UPDATE notification_outbox SET status = 'sent', sent_at = ?, attempts = attempts + 1, last_error = NULL
+            WHERE id = ?
+        ''', [(now, outbox_id) for outbox_id in ids])
+
+@DB_CALL_SECONDS.time()
+def retry_outbox(ids: list, delay: float, error: str = None, count_attempt=True):
+    """
+    放回佇列，delay 秒後再送
+    :param count_attempt: 是否計入重試次數 (限速延後不算失敗)
+    """
+    if not ids:
+        return
+    next_attempt = time.time() + delay
+    increment = 1 if count_attempt else 0
+    with write_connection() as conn:
+        conn.executemany('''
+            UPDATE notification_outbox
+            SET status = 'pending', attempts = attempts + ?, next_attempt_at = ?, last_error = COALESCE(?, last_error)
+            WHERE id = ?
+        ''', [(increment, next_attempt, error, outbox_id) for outbox_id in ids])
+
+@DB_CALL_SECONDS.time()
+def fail_outbox(ids: list, error: str):
+    """放棄發送 (超過重試次數或無法重試的錯誤)"""
+    if not ids:
+        return
+    with write_connection() as conn:
+        conn.executemany('''
+            UPDATE notification_outbox SET status = 'failed', attempts = attempts + 1, last_error = ?
+            WHERE id = ?
+        ''', [(error, outbox_id) for outbox_id in ids])
+
+@DB_CALL_SECONDS.time()
+def outbox_stats():
+    """通知佇列指標：佇列深度、最舊待發通知的等待秒數、近一小時平均投遞延遲"""
+    now = time.time()
+    with read_connection() as conn:
+        counts = {row[0]: row[1] for row in conn.execute(
+            "SELECT status, COUNT(*) FROM notification_outbox GROUP BY status")}
+        oldest = conn.execute(
+            "SELECT MIN(created_at) FROM notification_outbox WHERE status IN ('pending', 'sending')").fetchone()[0]
+        recent = conn.execute('''
+            SELECT AVG(sent_at - created_at), MAX(sent_at - created_at), COUNT(*)
+            FROM notification_outbox WHERE status = 'sent' AND sent_at >= ?
+        ''', (now - 3600,)).fetchone()
+
+    return {
+        "queue_depth": counts.get("pending", 0) + counts.get("sending", 0),
+        "pending": counts.get("pending", 0),
+        "sending": counts.get("sending", 0),
+        "sent": counts.get("sent", 0),
+        "failed": counts.get("failed", 0),
+        "suppressed": counts.get("suppressed", 0),
+        "oldest_pending_age_sec": round(now - oldest, 3) if oldest else 0.0,
+        "delivery_lag_avg_sec_1h": round(recent[0], 3) if recent[0] is not None else None,
+        "delivery_lag_max_sec_1h": round(recent[1], 3) if recent[1] is not None else None,
+        "sent_1h": recent[2],
+    }
+
+def _signed64(value):
+    """64-bit 無號雜湊 <-> SQLite INTEGER (有號)"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def _unsigned64(value):
+    return value + (1 << 64) if value < 0 else value
+
+@DB_CALL_SECONDS.time()
+def pets_missing_photos(pet_ids=None, limit=None):
+    """
+    需要處理照片的案件：有照片網址，但還沒處理過或網址已變更 (新案件優先)
+    :param pet_ids: 只檢查指定案件 (不限狀態)；未指定時為所有 Open 案件
+    :return: [(pet_id, picture_url), ...]
+    """
+    source = "lost_pets"
+    params = []
+    if pet_ids is not None:
+        pet_ids = list(pet_ids)
+        if not pet_ids:
+            return []
+        placeholders = ','.join(['?'] * len(pet_ids))
+        source = f'''(SELECT id, picture_url, created_at FROM lost_pets WHERE id IN ({placeholders})
+                     UNION ALL SELECT id, picture_url, created_at FROM lost_pets_archive WHERE id IN ({placeholders}))'''
+        params.extend(pet_ids * 2)
+    query = f'''
+        SELECT p.id, p.picture_url FROM {source} p
+        LEFT JOIN pet_photos f ON f.pet_id = p.id
+        WHERE p.picture_url <> '' AND (f.pet_id IS NULL OR f.url <> p.picture_url)
+    '''
+    query += " ORDER BY p.created_at DESC, p.id"
+    if limit:
+        query += " LIMIT ?"
+        params.append(limit)
+    with read_connection() as conn:
+        return [tuple(row) for row in conn.execute(query, params)]
+
+@DB_CALL_SECONDS.time()
+def get_photos_by_url(urls):
+    """已成功處理過的網址 -> 內容雜湊 (其他案件用到同一網址時不必重新下載)"""
+    found = {}
+    urls = list(urls)
+    batch_size = 900
+    with read_connection() as conn:
+        for i in range(0, len(urls), batch_size):
+            batch = urls[i:i+batch_size]
+            found.update(conn.execute(f'''
+                SELECT f.url, f.sha256 FROM pet_photos f JOIN photos ph ON ph.sha256 = f.sha256
+                WHERE f.url IN ({','.join(['?'] * len(batch))})
+            ''', batch).fetchall())
+    return found
+
+@DB_CALL_SECONDS.time()
+def save_pet_photos(photos: list, links: list):
+    """
+    寫入照片處理結果 (同一交易) 並遞增 photo_generation
+    :param photos: [{"sha256", "phash", "width", "height"}, ...]；內容已存在時略過
+    :param links: [(pet_id, url, sha256, error), ...]
+    """
+    if not photos and not links:
+        return
+    now = time.time()
+    with write_connection() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        c.executemany('''
+            INSERT OR IGNORE INTO photos (sha256, phash, width, height, created_at) VALUES (?, ?, ?, ?, ?)
+        ''', [(p["sha256"], _signed64(p["phash"]), p.get("width"), p.get("height"), now) for p in photos])
+        c.executemany('''
+            INSERT INTO pet_photos (pet_id, url, sha256, fetched_at, error) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(pet_id) DO UPDATE SET
+                url = excluded.url, sha256 = excluded.sha256, fetched_at = excluded.fetched_at, error = excluded.error
+        ''', [(pet_id, url, sha256, now, error) for pet_id, url, sha256, error in links])
+        _bump_generation(c, 'photo_generation')
+
+@DB_CALL_SECONDS.time()
+def get_photo_hashes():
+    """所有已建立照片索引的案件 [(pet_id, phash, sha256), ...] (phash 為無號整數)"""
+    with read_connection() as conn:
+        rows = conn.execute('''
+            SELECT f.pet_id, ph.phash, f.sha256 FROM pet_photos f JOIN photos ph ON ph.sha256 = f.sha256
+        ''').fetchall()
+    return [(pet_id, _unsigned64(phash), sha256) for pet_id, phash, sha256 in rows]
+
+@DB_CALL_SECONDS.time()
+def get_pet_photo(pet_id):
+    """案件的照片資訊 (picture_url、sha256、phash)；查無案件回傳 None，尚未處理照片時 sha256 為 None"""
+    with read_connection() as conn:
+        row = conn.execute('''
+            SELECT p.id, p.picture_url, f.url AS photo_url, f.sha256, f.error, ph.phash, ph.width, ph.height
+            FROM (SELECT id, picture_url FROM lost_pets WHERE id = ?
+                  UNION ALL SELECT id, picture_url FROM lost_pets_archive WHERE id = ?) p
+            LEFT JOIN pet_photos f ON f.pet_id = p.id
+            LEFT JOIN photos ph ON ph.sha256 = f.sha256
+        ''', (pet_id, pet_id)).fetchone()
+    if row is None:
+        return None
+    photo = dict(row)
+    if photo["phash"] is not None:
+        photo["phash"] = _unsigned64(photo["phash"])
+    return photo
+
+@DB_CALL_SECONDS.time()
+def get_pets_by_ids(pet_ids, fields=None):
+    """依 ID 取得案件 -> {id: dict} (Open 案件優先，其餘查封存表)"""
+    select = _projection(fields, PET_COLUMNS, ["id"])
+    pet_ids = list(pet_ids)
+    found = {}
+    batch_size = 900
+    with read_connection() as conn:
+        for table in PET_STATUS_TABLES.values():
+            pending = [pet_id for pet_id in pet_ids if pet_id not in found]
+            for i in range(0, len(pending), batch_size):
+                batch = pending[i:i+batch_size]
+                for row in conn.execute(f"SELECT {select} FROM {table} WHERE id IN ({','.join(['?'] * len(batch))})",
+                                        batch):
+                    found[row["id"]] = dict(row)
+    return found
+
+MATCH_FIELDS = "pet_name,pet_type,breed,sex,color,lost_place,lost_time,picture_url,city,district"
+
+def _match_score_sql(sighting):
+    """
+    Sighting.score 的 SQL 版 (只算總分)：在 SQLite 內計分排序，只有前幾名需要轉成 Python 物件
+    拾獲資料未提供的項目在 Python 端就決定為常數；兩邊的算法須一致
+    :return: (SQL 運算式, 參數)
+    """
+    parts = []
+    params = []
+    if sighting.breed:
+        parts.append("CASE WHEN breed = '' THEN 0.5 WHEN breed = ? THEN ? ELSE 0.0 END")
+        params += [sighting.breed, matching.MIXED_BREED_SCORE if sighting.breed == matching.MIXED_BREED else 1.0]
+    else:
+        parts.append("0.5")
+    if sighting.colors:
+        colors = sorted(sighting.colors)
+        hits = " + ".join(["(instr(',' || colors || ',', ?) > 0)"] * len(colors))
+        parts.append(f"CASE WHEN colors = '' THEN 0.5 ELSE ({hits}) * 1.0 / ? END")
+        params += [f",{color}," for color in colors] + [len(colors)]
+    else:
+        parts.append("0.5")
+    if sighting.sex:
+        parts.append("CASE WHEN sex = '' THEN 0.5 WHEN sex = ? THEN 1.0 ELSE 0.0 END")
+        params.append(sighting.sex)
+    else:
+        parts.append("0.5")
+    parts.append(f"CASE area {' '.join(['WHEN ? THEN ?'] * len(sighting.areas))} ELSE 0.0 END")
+    for area in sighting.areas:
+        params += [area, sighting.proximity(area)]
+    parts.append("MAX(0.0, 1 - MAX(0, ? - lost_day) * 1.0 / ?)" if sighting.days_back else "1.0")
+    params += [sighting.day, sighting.days_back] if sighting.days_back else []
+
+    weights = [matching.WEIGHTS[key] for key in ("breed", "color", "sex", "distance", "recency")]
+    return " + ".join(f"{weight} * ({part})" for weight, part in zip(weights, parts)), params
+
+@DB_CALL_SECONDS.time()
+def find_matching_pets(sighting, limit=20, fields=MATCH_FIELDS):
+    """
+    拾獲 / 目擊資料 -> 可能相符的 Open 案件 (依分數由高到低)
+    只讀取比對索引中 (種類, 附近地區, 日期視窗內的週, 品種或毛色相符) 的列，不掃描整個 lost_pets；
+    計分、去重 (同一案件可能有多個 token 相符) 與排序都在 SQLite 內完成
+    :param sighting: matching.Sighting
+    :return: (data, 候選數)
+    """
+    areas = list(sighting.areas)
+    if not areas:
+        return [], 0
+    score, score_params = _match_score_sql(sighting)
+    where = f'''
+        WHERE pet_type = ? AND area IN ({','.join(['?'] * len(areas))})
+          AND week IN ({','.join(['?'] * len(sighting.weeks))})
+    '''
+    params = [sighting.pet_type, *areas, *sighting.weeks]
+    tokens = sighting.tokens
+    if tokens:
+        where += f" AND token IN ({','.join(['?'] * len(tokens))})"
+        params.extend(tokens)
+    where += " AND lost_day BETWEEN ? AND ?"
+    params.extend([sighting.first_day, sighting.last_day])
+
+    # MAX() 搭配的其他欄位取自分數最高的那一列 (同一案件各列內容相同)
+    query = f'''
+        SELECT pet_id, MAX({score}) AS score, area, breed, sex, colors, lost_day, COUNT(*) OVER () AS candidates
+        FROM pet_match_index {where}
+        GROUP BY pet_id
+        ORDER BY score DESC, pet_id
+        LIMIT ?
+    '''
+    with read_connection() as conn:
+        rows = conn.execute(query, score_params + params + [limit]).fetchall()
+    candidates = rows[0]["candidates"] if rows else 0
+    pets = get_pets_by_ids([row["pet_id"] for row in rows], fields=fields)
+    data = []
+    for row in rows:
+        if row["pet_id"] in pets:
+            score, detail = sighting.score(row["area"], row["breed"], row["sex"], row["colors"], row["lost_day"])
+            data.append(dict(pets[row["pet_id"]], score=score, **detail))
+    return data, candidates
+
+@DB_CALL_SECONDS.time()
+def suppress_outbox(ids: list, reason: str):
+    """不發送 (例如照片與既有案件相同的重複通報)"""
+    if not ids:
+        return
+    with write_connection() as conn:
+        conn.executemany('''
+            UPDATE notification_outbox SET status = 'suppressed', last_error = ? WHERE id = ?
+        ''', [(reason, outbox_id) for outbox_id in ids])
+
+# API 可輸出的欄位 (fields= 投影用)
+PET_COLUMNS = ["id", "chip_num", "pet_name", "pet_type", "breed", "sex", "color",
+               "lost_place", "lost_time", "owner_name", "phone", "picture_url",
+               "created_at", "status", "notified", "city", "district", "lat", "lon"]
+ARCHIVE_COLUMNS = PET_COLUMNS + ["opened_at", "closed_at"]
+# 案件狀態 -> 存放的表格 (lost_pets 只有 Open 案件，已關閉的在封存表)
+PET_STATUS_TABLES = {"Open": "lost_pets", "Close": "lost_pets_archive"}
+CLINIC_COLUMNS = ["id", "name", "tel", "address", "doctor_name", "google_map_link", "updated_at",
+                  "city", "district", "lat", "lon"]
+
+def encode_cursor(values: list):
+    """將排序鍵編碼成不透明的分頁游標"""
+    raw = json.dumps(values, ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str, size: int):
+    """解析分頁游標，格式錯誤時丟出 ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw.decode("utf-8"))
+    except Exception:
+        raise ValueError("cursor 格式錯誤")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("cursor 格式錯誤")
+    return values
+
+def _projection(fields, columns, keys):
+    """
+    將 fields 參數 (逗號分隔字串或 list) 轉成 SELECT 欄位
+    排序鍵 keys 一律保留，分頁游標需要用到
+    未指定時輸出 columns 全部欄位 (不用 *：content_hash 等內部欄位不屬於 API 回應)
+    """
+    if not fields:
+        return ", ".join(columns)
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    selected = [f.strip() for f in fields if f.strip()]
+    unknown = [f for f in selected if f not in columns]
+    if unknown:
+        raise ValueError(f"未知的欄位: {', '.join(unknown)}")
+    selected = keys + [f for f in selected if f not in keys]
+    return ", ".join(selected)
+
+def _iter_rows(query, params):
+    """逐列讀取查詢結果 (借用的連線在迭代結束或中斷時歸還)"""
+    with read_connection() as conn:
+        for row in conn.execute(query, params):
+            yield dict(row)
+
+def _location_filter(text_column, city_filter=None, district_filter=None):
+    """
+    縣市 / 鄉鎮區篩選：可辨識的名稱走 city/district 欄位等值比對 (可用索引)，
+    無法辨識時退回原始文字欄位的子字串比對
+    :return: (sql 片段, 參數)
+    """
+    sql = ""
+    params = []
+    cities = city_candidates(city_filter) if city_filter else []
+    if city_filter:
+        if cities:
+            sql += f" AND city IN ({','.join(['?'] * len(cities))})"
+            params.extend(cities)
+        else:
+            sql += f" AND {text_column} LIKE ?"
+            params.append(f"%{city_filter}%")
+    if district_filter:
+        districts = district_candidates(district_filter, cities[0] if len(cities) == 1 else None)
+        if districts:
+            sql += f" AND district IN ({','.join(['?'] * len(districts))})"
+            params.extend(districts)
+        else:
+            sql += f" AND {text_column} LIKE ?"
+            params.append(f"%{district_filter}%")
+    return sql, params
+
+def pet_cursor(row: dict):
+    return encode_cursor([row["lost_time"], row["id"]])
+
+def clinic_cursor(row: dict):
+    return encode_cursor([row["id"]])
+
+def iter_recent_pets(days=14, city_filter=None, type_filter=None, status='Open', q=None,
+                     fields=None, cursor=None, limit=None, district_filter=None):
+    """
+    依 (lost_time, id) 由新到舊逐列產生走失案件
+    :param fields: 欄位投影 (id 與 lost_time 一律包含)
+    :param cursor: 上一頁最後一筆的 pet_cursor()，從其後繼續
+    :param limit: 最多筆數
+    :param city_filter / district_filter: 縣市、鄉鎮區 (台/臺、省略「市」「區」皆可)
+    :param status: Open 或 Close (已關閉的案件查封存表，多了 opened_at / closed_at 欄位)
+    參數錯誤會在呼叫時立即丟出 ValueError，而不是在迭代時
+    """
+    table = PET_STATUS_TABLES.get(status)
+    if table is None:
+        raise ValueError(f"未知的狀態: {status}")
+    columns = _projection(fields, ARCHIVE_COLUMNS if status == 'Close' else PET_COLUMNS, ["id", "lost_time"])
+    query = f"SELECT {columns} FROM {table} WHERE status = ?"
     params = [status]
     
     # 日期過濾 (SQL層級)
@@ -208,21 +1860,199 @@ def get_recent_pets(days=14, city_filter=None, type_filter=None, status='Open'):
         query += " AND lost_time >= ?"
         params.append(cutoff_date)
     
-    if city_filter:
-        query += " AND lost_place LIKE ?"
-        params.append(f"%{city_filter}%")
-        
+    location_sql, location_params = _location_filter("lost_place", city_filter, district_filter)
+    query += location_sql
+    params.extend(location_params)
+
     if type_filter:
         query += " AND pet_type LIKE ?"
         params.append(f"%{type_filter}%")
 
-    query += " ORDER BY lost_time DESC"
-    
-    c.execute(query, params)
-    rows = c.fetchall()
-    conn.close()
-    
-    return [dict(row) for row in rows]
+    if q:
+        fts_sql, fts_params = _fts_filter(table, q, FTS_TABLES["lost_pets"])
+        query += fts_sql
+        params.extend(fts_params)
+
+    # Keyset 分頁：接在上一頁最後一筆之後
+    if cursor:
+        query += " AND (lost_time, id) < (?, ?)"
+        params.extend(decode_cursor(cursor, 2))
+
+    query += " ORDER BY lost_time DESC, id DESC"
+
+    if limit:
+        query += " LIMIT ?"
+        params.append(int(limit))
+
+    return _iter_rows(query, params)
+
+@DB_CALL_SECONDS.time()
+def get_recent_pets(days=14, city_filter=None, type_filter=None, status='Open', q=None,
+                    fields=None, cursor=None, limit=None, district_filter=None):
+    """取得最近的走失案件 (SQL 優化版，q 為全文檢索關鍵字)"""
+    return list(iter_recent_pets(days, city_filter, type_filter, status, q, fields, cursor, limit,
+                                 district_filter))
+
+@DB_CALL_SECONDS.time()
+def load_open_pets():
+    """
+    在同一個讀取交易中取得資料世代與全部 Open 案件 (記憶體快照用，欄位與順序同 iter_recent_pets)
+    :return: (generation, 欄位名稱, [tuple, ...])
+    """
+    with read_connection() as conn:
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute("SELECT value FROM app_meta WHERE key = 'generation'").fetchone()
+            # 直接取 tuple，不建立 sqlite3.Row
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            cursor.execute(f"SELECT {', '.join(PET_COLUMNS)} FROM lost_pets WHERE status = 'Open' "
+                           f"ORDER BY lost_time DESC, id DESC")
+            columns = [d[0] for d in cursor.description]
+            rows = cursor.fetchall()
+        finally:
+            conn.execute("COMMIT")
+    return (int(row[0]) if row else 0), columns, rows
+
+def iter_clinics(city_filter=None, q=None, fields=None, cursor=None, limit=None, district_filter=None):
+    """依 id 排序逐列產生動物醫院 (參數同 iter_recent_pets，排序鍵為 id)"""
+    columns = _projection(fields, CLINIC_COLUMNS, ["id"])
+    query = f"SELECT {columns} FROM vet_clinics WHERE 1 = 1"
+    params = []
+
+    location_sql, location_params = _location_filter("address", city_filter, district_filter)
+    query += location_sql
+    params.extend(location_params)
+
+    if q:
+        fts_sql, fts_params = _fts_filter("vet_clinics", q)
+        query += fts_sql
+        params.extend(fts_params)
+
+    if cursor:
+        query += " AND id > ?"
+        params.extend(decode_cursor(cursor, 1))
+
+    query += " ORDER BY id"
+
+    if limit:
+        query += " LIMIT ?"
+        params.append(int(limit))
+
+    return _iter_rows(query, params)
+
+@DB_CALL_SECONDS.time()
+def get_clinics(city_filter=None, q=None, fields=None, cursor=None, limit=None, district_filter=None):
+    """搜尋動物醫院 (city/district 為縣市、鄉鎮區，q 為全文檢索關鍵字)"""
+    return list(iter_clinics(city_filter, q, fields, cursor, limit, district_filter))
+
+@DB_CALL_SECONDS.time()
+def get_nearby_clinics(lat, lon, radius_km=5.0, limit=20, fields=None):
+    """
+    半徑內的動物醫院，依距離由近到遠 (附 distance_km)
+    先用 R*Tree 以外接矩形篩選，再對候選算大圓距離排序
+    """
+    columns = _projection(fields, CLINIC_COLUMNS, ["id", "lat", "lon"])
+    min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_km)
+    with read_connection() as conn:
+        has_geo = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='vet_clinics_geo'").fetchone()
+        if has_geo:
+            rows = conn.execute(f'''
+                SELECT {columns} FROM vet_clinics
+                WHERE rowid IN (
+                    SELECT rid FROM vet_clinics_geo
+                    WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?
+                )
+            ''', (min_lat, max_lat, min_lon, max_lon)).fetchall()
+        else:
+            rows = conn.execute(f'''
+                SELECT {columns} FROM vet_clinics
+                WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?
+            ''', (min_lat, max_lat, min_lon, max_lon)).fetchall()
+
+    candidates = []
+    for row in rows:
+        distance = haversine_km(lat, lon, row["lat"], row["lon"])
+        if distance <= radius_km:
+            candidates.append((distance, row["id"], row))
+    candidates.sort(key=lambda item: (item[0], item[1]))
+    if limit:
+        candidates = candidates[:limit]
+
+    results = []
+    for distance, _, row in candidates:
+        item = dict(row)
+        item["distance_km"] = round(distance, 3)
+        results.append(item)
+    return results
+
+@DB_CALL_SECONDS.time()
+def get_pet_location(pet_id):
+    """案件的走失地點 (city, district, lat, lon)；查無案件回傳 None"""
+    with read_connection() as conn:
+        row = conn.execute('''
+            SELECT id, lost_place, city, district, lat, lon FROM lost_pets WHERE id = ?
+            UNION ALL SELECT id, lost_place, city, district, lat, lon FROM lost_pets_archive WHERE id = ?
+        ''', (pet_id, pet_id)).fetchone()
+    return dict(row) if row else None
+
+def _percentile(values, fraction):
+    """已排序數列的百分位數 (最近秩)"""
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+@DB_CALL_SECONDS.time()
+def get_resolution_stats(days=90, breakdown=()):
+    """
+    結案時間統計 (天)：最近 days 天內關閉、且有開啟時間的案件，從開啟到關閉經過的天數
+    只讀封存表；舊資料移轉進來的案件不知道關閉時間，不列入
+    :param breakdown: 額外的分組，可含 "type"、"city"
+    :return: {"days", "count", "mean_days", "median_days", "p90_days", "by_type", "by_city"}
+    """
+    from datetime import timedelta
+    cutoff = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+    with read_connection() as conn:
+        rows = conn.execute('''
+            SELECT pet_type, city, julianday(closed_at) - julianday(opened_at) AS elapsed
+            FROM lost_pets_archive
+            WHERE closed_at >= ? AND opened_at IS NOT NULL
+        ''', (cutoff,)).fetchall()
+
+    def summarize(values):
+        values = sorted(max(0.0, v) for v in values if v is not None)
+        if not values:
+            return {"count": 0, "mean_days": None, "median_days": None, "p90_days": None}
+        return {
+            "count": len(values),
+            "mean_days": round(sum(values) / len(values), 2),
+            "median_days": round(_percentile(values, 0.5), 2),
+            "p90_days": round(_percentile(values, 0.9), 2),
+        }
+
+    result = {"days": days, **summarize([row["elapsed"] for row in rows])}
+    for key, column in (("type", "pet_type"), ("city", "city")):
+        if key in breakdown:
+            groups = {}
+            for row in rows:
+                groups.setdefault(row[column] or "未知", []).append(row["elapsed"])
+            result[f"by_{key}"] = {name: summarize(values) for name, values in sorted(groups.items())}
+    return result
+
+@DB_CALL_SECONDS.time()
+def get_pet_history(pet_id):
+    """
+    案件的狀態變更紀錄 (由舊到新)；查無案件回傳 None
+    :return: {"id", "status", "events": [{"event", "at"}, ...]}
+    """
+    with read_connection() as conn:
+        row = conn.execute('''
+            SELECT status FROM lost_pets WHERE id = ?
+            UNION ALL SELECT status FROM lost_pets_archive WHERE id = ?
+        ''', (pet_id, pet_id)).fetchone()
+        if row is None:
+            return None
+        events = [dict(event) for event in conn.execute(
+            "SELECT event, at FROM pet_status_log WHERE pet_id = ? ORDER BY id", (pet_id,))]
+    return {"id": pet_id, "status": row["status"], "events": events}
 
 if __name__ == "__main__":
     init_db()
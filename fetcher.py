@@ -1,20 +1,267 @@
 
-import requests
-import urllib3
-import pandas as pd
 from datetime import datetime
+import asyncio
+import hashlib
+import json
+import os
+import random
 import time
+from raw_cache import RawResponseCache
+import metrics
+from metrics import CRAWL_PHASE_SECONDS, UPSTREAM_ERRORS
+# pandas / httpx / requests 在實際抓取時才載入：API 行程 import 本模組不需付出載入時間 (冷啟動)
 
-# 關閉 SSL 警告
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+# 計算內容指紋時納入的欄位 (對應 lost_pets 中會被更新的內容)
+FINGERPRINT_FIELDS = ["ChipNum", "PetName", "PetType", "Breed", "Sex", "Color",
+                      "LostPlace", "LostTime", "OwnerName", "Phone", "Picture"]
+
+class PermanentFetchError(Exception):
+    """不需重試的抓取錯誤 (例如 4xx)"""
+
+class _RateLimiter:
+    """禮貌性限速：兩次請求的起始時間至少間隔 1/rate 秒"""
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+# 重播模式：完全不連網，以原始回應快取中的資料跑完整流程 (本機測試 / 效能量測用)
+FETCH_REPLAY = os.environ.get("FETCH_REPLAY", "").lower() in ("1", "true", "yes", "on")
 
 class MOAClient:
-    def __init__(self):
+    def __init__(self, concurrency=4, rate_limit=2.0, max_retries=3, backoff_base=0.5,
+                 raw_cache=None, replay=None):
+        """
+        :param concurrency: 非同步模式下同時進行的請求數
+        :param rate_limit: 每秒最多發出幾個請求 (0 為不限速)
+        :param max_retries: 單頁失敗時的重試次數
+        :param backoff_base: 指數退避的基本秒數 (第 n 次重試約等待 base * 2^n 秒再加上隨機抖動)
+        :param raw_cache: RawResponseCache；未指定時使用預設目錄，False 為停用
+        :param replay: 重播模式 (預設依環境變數 FETCH_REPLAY)
+        """
         # 農業部走失動物 API
         self.url = "https://data.moa.gov.tw/Service/OpenData/TransService.aspx?UnitId=IFJomqVzyB0i"
         self.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
         }
+        self.batch_size = 1000
+        self.concurrency = concurrency
+        self.rate_limit = rate_limit
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.raw_cache = RawResponseCache() if raw_cache is None else raw_cache
+        self.replay = FETCH_REPLAY if replay is None else replay
+        if self.replay and not self.raw_cache:
+            raise ValueError("重播模式需要原始回應快取")
+
+    def fetch_lost_pets(self, limit=2000):
+        """
+        以非同步並行模式抓取最新走失資料
+        :param limit: 抓取筆數上限
+        :return: (List of clean dictionaries, complete)
+            complete 為 True 代表每一頁都成功取得；部分失敗時仍回傳已取得的資料，
+            但呼叫端不應以此判斷哪些案件已撤銷
+        """
+        print(f"[{datetime.now()}] 📥 [Fetcher] 開始並行抓取農業部資料 (Limit={limit}, 並行={self.concurrency})...")
+        all_data, complete = asyncio.run(self._fetch_pages_async(limit))
+
+        status = "完整" if complete else "不完整"
+        print(f"   ✅ 共抓取 {len(all_data)} 筆原始資料 ({status})，開始清洗...")
+        return self._clean_data(all_data), complete
+
+    def stream_lost_pets(self, handle_page, limit=None, handle_unchanged=None):
+        """
+        邊抓邊處理：每取得一頁就清洗並交給 handle_page，整份資料不會同時留在記憶體
+        :param handle_page: 處理單頁清洗後資料 (List of dict) 的函式；在背景執行緒中依抵達順序逐頁呼叫
+        :param limit: 抓取筆數上限 (None 為抓到資料結尾)
+        :param handle_unchanged: 內容與上次相同的頁面不清洗也不呼叫 handle_page，
+            只把該頁的 UniqueKey 清單交給此函式 (例如記錄為本次有看到的案件)
+        :return: dict - pages (有變動的頁數) / skipped (未變動的頁數) / rows (有變動頁面的筆數) /
+            total (全部頁面的筆數) / complete (同 fetch_lost_pets)
+        """
+        mode = "重播快取" if self.replay else f"並行={self.concurrency}"
+        print(f"[{datetime.now()}] 📥 [Fetcher] 開始串流抓取農業部資料 (Limit={limit or '全部'}, {mode})...")
+        result = asyncio.run(self._stream_pages_async(handle_page, limit, handle_unchanged))
+        if self.raw_cache and not self.replay:
+            self.raw_cache.prune()
+
+        status = "完整" if result["complete"] else "不完整"
+        print(f"   ✅ 共處理 {result['pages']} 頁 / {result['rows']} 筆，未變動略過 {result['skipped']} 頁 ({status})")
+        return result
+
+    async def _stream_pages_async(self, handle_page, limit, handle_unchanged=None):
+        status = {}
+        pages = 0
+        skipped = 0
+        rows = 0
+        total = 0
+        async for skip, data, changed in self._iter_pages_async(limit, status):
+            total += len(data)
+            if not changed:
+                skipped += 1
+                if handle_unchanged:
+                    keys = await asyncio.to_thread(self._unique_keys, data)
+                    await asyncio.to_thread(handle_unchanged, keys)
+                continue
+            # 清洗與寫入在執行緒中進行，期間其他頁面繼續下載
+            clean = await asyncio.to_thread(self._clean_data, data)
+            await asyncio.to_thread(handle_page, clean)
+            if self.raw_cache and not self.replay:
+                # 寫入成功後才記錄，失敗的頁面下次仍會重新處理
+                self.raw_cache.mark_applied(self.raw_cache.key(self.url, self._page_params(skip)))
+            pages += 1
+            rows += len(clean)
+        return {"pages": pages, "skipped": skipped, "rows": rows, "total": total, "complete": status["complete"]}
+
+    def probe_pages(self, skips):
+        """
+        只抓指定的幾頁 (判斷是否需要完整爬取)：不清洗、不寫入，也不標記為已處理
+        :return: {skip: (筆數, changed)}；抓取失敗時為 (None, True)
+        """
+        return asyncio.run(self._probe_pages_async(skips))
+
+    async def _probe_pages_async(self, skips):
+        import httpx
+        limiter = _RateLimiter(self.rate_limit)
+        results = {}
+        async with httpx.AsyncClient(headers=self.headers, verify=False, timeout=30) as client:
+            for skip in skips:
+                try:
+                    data, changed = await self._get_page_async(client, limiter, skip)
+                    results[skip] = (len(data), changed)
+                except Exception as e:
+                    print(f"   ❌ 探測錯誤 (Skip={skip}): {e}")
+                    results[skip] = (None, True)
+        return results
+
+    async def _fetch_pages_async(self, limit):
+        pages = {}
+        status = {}
+        async for skip, data, _ in self._iter_pages_async(limit, status):
+            pages[skip] = data
+
+        end = status["end"]
+        all_data = [row for skip in sorted(pages) if skip < end for row in pages[skip]]
+        return all_data, status["complete"]
+
+    async def _iter_pages_async(self, limit, status):
+        """
+        並行抓取各頁，依抵達順序產生 (skip, data, changed)
+        - 佇列上限為 concurrency：消費端較慢時下載會暫停，記憶體中最多約 2 * concurrency 頁
+        - 結束後 status["end"] 為資料結尾，status["complete"] 表示結尾以前的每一頁都成功取得
+        """
+        failed = []
+        # next: 下一個要分派的 $skip；end: 目前已知的資料結尾 (遇到空頁後縮小)
+        state = {"next": 0, "end": limit if limit else float("inf")}
+        pages = asyncio.Queue(maxsize=self.concurrency)
+        import httpx
+        limiter = _RateLimiter(self.rate_limit)
+        client_limits = httpx.Limits(max_connections=self.concurrency,
+                                     max_keepalive_connections=self.concurrency)
+
+        async with httpx.AsyncClient(headers=self.headers, verify=False, timeout=30,
+                                     limits=client_limits) as client:
+            async def worker():
+                while state["next"] < state["end"]:
+                    skip = state["next"]
+                    state["next"] += self.batch_size
+                    try:
+                        data, changed = await self._get_page_async(client, limiter, skip)
+                    except Exception as e:
+                        print(f"   ❌ 抓取錯誤 (Skip={skip})，已放棄: {e}")
+                        failed.append(skip)
+                        if not limit:
+                            # 不設上限時無從得知結尾，停止往後分派 (本次視為不完整)
+                            state["end"] = min(state["end"], skip + self.batch_size)
+                        continue
+                    if not data:
+                        state["end"] = min(state["end"], skip)
+                    else:
+                        await pages.put((skip, data, changed))
+
+            async def produce():
+                await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+                await pages.put(None)
+
+            producer = asyncio.create_task(produce())
+            try:
+                while True:
+                    item = await pages.get()
+                    if item is None:
+                        break
+                    # 結尾之後的頁面 (抓取期間資料變動) 不處理
+                    if item[0] < state["end"]:
+                        yield item
+                await producer
+            finally:
+                if not producer.done():
+                    producer.cancel()
+                    try:
+                        await producer
+                    except asyncio.CancelledError:
+                        pass
+
+        status["end"] = state["end"]
+        status["complete"] = not any(skip < state["end"] for skip in failed)
+
+    def _page_params(self, skip):
+        return {"$top": self.batch_size, "$skip": skip}
+
+    async def _get_page_async(self, client, limiter, skip):
+        """
+        抓取單頁，遇到連線錯誤、429 或 5xx 時以指數退避 + 抖動重試
+        有原始回應快取時送出條件式請求 (ETag / Last-Modified)，伺服器不支援則比對內容雜湊
+        :return: (data, changed) - changed 為 False 代表與上次抓到的內容相同
+        """
+        params = self._page_params(skip)
+        cache_key = self.raw_cache.key(self.url, params) if self.raw_cache else None
+        if self.replay:
+            # 快取中沒有的頁面視為資料結尾
+            body = self.raw_cache.load(cache_key)
+            return (json.loads(body) if body else []), True
+
+        import httpx
+        # httpx 的 params 會取代 URL 上原有的查詢字串 (UnitId)，需改為合併
+        url = httpx.URL(self.url).copy_merge_params(params)
+        headers = self.raw_cache.conditional_headers(cache_key) if self.raw_cache else {}
+        with CRAWL_PHASE_SECONDS.time(phase="fetch"):
+            for attempt in range(self.max_retries + 1):
+                await limiter.wait()
+                try:
+                    response = await client.get(url, headers=headers)
+                    if response.status_code == 304:
+                        return json.loads(self.raw_cache.load(cache_key)), self.raw_cache.is_pending(cache_key)
+                    if response.status_code == 429 or response.status_code >= 500:
+                        response.raise_for_status()
+                    elif response.status_code >= 400:
+                        # 其他 4xx 重試也不會成功
+                        UPSTREAM_ERRORS.inc(source="moa", reason=str(response.status_code))
+                        raise PermanentFetchError(f"HTTP {response.status_code}")
+                    data = response.json()
+                    changed = True
+                    if self.raw_cache:
+                        changed = self.raw_cache.store(cache_key, response.content, response.headers)
+                    return data, changed
+                except PermanentFetchError:
+                    raise
+                except Exception as e:
+                    UPSTREAM_ERRORS.inc(source="moa", reason=metrics.error_reason(e))
+                    if attempt >= self.max_retries:
+                        raise
+                delay = self.backoff_base * (2 ** attempt)
+                delay += random.uniform(0, delay)
+                print(f"   🔁 重試 (Skip={skip}, 第 {attempt + 1} 次，{delay:.1f}s 後)")
+                await asyncio.sleep(delay)
 
     def fetch_all_lost_pets(self, limit=2000):
         """
@@ -22,6 +269,10 @@ class MOAClient:
         :param limit: 抓取筆數上限
         :return: List of clean dictionaries
         """
+        import requests
+        import urllib3
+        # 關閉 SSL 警告
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
         print(f"[{datetime.now()}] 📥 [Fetcher] 開始抓取農業部資料 (Limit={limit})...")
         
         all_data = []
@@ -44,16 +295,17 @@ class MOAClient:
                 skip += batch_size
                 time.sleep(0.5) # 禮貌性暫停
             except Exception as e:
+                UPSTREAM_ERRORS.inc(source="moa", reason=metrics.error_reason(e))
                 print(f"   ❌ 抓取錯誤 (Skip={skip}): {e}")
                 break
         
         print(f"   ✅ 共抓取 {len(all_data)} 筆原始資料，開始清洗...")
         return self._clean_data(all_data)
 
-    def _clean_data(self, raw_data):
-        if not raw_data:
-            return []
-
+    @staticmethod
+    def _frame(raw_data):
+        """原始資料 -> DataFrame (統一欄位名稱並產生 UniqueKey)"""
+        import pandas as pd
         df = pd.DataFrame(raw_data)
         
         # 1. 欄位重新命名 (統一英文字段)
@@ -86,9 +338,30 @@ class MOAClient:
         df['ChipNum'] = df['ChipNum'].fillna('').astype(str).str.strip()
         df['PetName'] = df['PetName'].fillna('未知').astype(str).str.strip()
         df['UniqueKey'] = df['ChipNum'] + "_" + df['PetName'] # 產生唯一鍵值
+        return df
+
+    def _unique_keys(self, raw_data):
+        """只取出 UniqueKey (未變動的頁面不需完整清洗)"""
+        if not raw_data:
+            return []
+        return self._frame(raw_data)['UniqueKey'].tolist()
+
+    @CRAWL_PHASE_SECONDS.time(phase="clean")
+    def _clean_data(self, raw_data):
+        if not raw_data:
+            return []
+
+        import pandas as pd
+        df = self._frame(raw_data)
         
         # 時間格式標準化 (嘗試轉為 YYYY-MM-DD format)
-        df['LostTime'] = df['LostTime'].apply(self._parse_date)
+        df['LostTime'] = self._normalize_dates(df['LostTime'])
+
+        # 內容指紋 (用於同步時跳過未變動的案件)
+        fields = [df[col].fillna('').astype(str) if col in df.columns else pd.Series('', index=df.index)
+                  for col in FINGERPRINT_FIELDS]
+        joined = fields[0].str.cat(fields[1:], sep='\x1f')
+        df['Fingerprint'] = [hashlib.sha1(text.encode('utf-8')).hexdigest() for text in joined]
         
         # 4. 排序 (最新的在前)
         df = df.sort_values(by='LostTime', ascending=False)
@@ -97,31 +370,38 @@ class MOAClient:
         clean_list = df.to_dict(orient='records')
         return clean_list
 
-    def _parse_date(self, date_str):
-        if pd.isna(date_str) or str(date_str).strip() == '':
-            return ""
-            
-        s = str(date_str).strip().replace(".", "/").replace("-", "/")
-        try:
-            # 嘗試解析正常格式
-            dt = pd.to_datetime(s, errors='coerce')
-            if pd.notna(dt):
-                return dt.strftime('%Y-%m-%d')
-        except:
-            pass
-            
-        # 處理民國年 (e.g. 112/01/01)
-        try:
-            parts = s.split('/')
-            if len(parts) == 3:
-                year = int(parts[0])
-                if year < 1911: 
-                    year += 1911
-                return f"{year}-{parts[1].zfill(2)}-{parts[2].zfill(2)}"
-        except:
-            pass
-            
-        return ""
+    # YYYY/MM/DD 或民國 YYY/MM/DD，後面可接時間 (分隔符號已統一為 /)
+    _YMD_PATTERN = r"^(\d{1,4})/(\d{1,2})/(\d{1,2})(?:[ T].*)?$"
+
+    @classmethod
+    def _normalize_dates(cls, series):
+        """
+        批次將日期欄位轉為 YYYY-MM-DD (整欄字串運算，不逐列呼叫 to_datetime)
+        - 支援 / - . 分隔；年份 1~3 位數視為民國年 (+1911)
+        - 無法辨識的格式交給 pd.to_datetime 一次處理，仍失敗則為空字串
+        """
+        import pandas as pd
+        s = series.astype("string").str.strip()
+        s = s.str.replace(r"[.\-]", "/", regex=True)
+        result = pd.Series("", index=series.index, dtype=object)
+
+        parts = s.str.extract(cls._YMD_PATTERN)
+        matched = parts[0].notna()
+        if matched.any():
+            year_str = parts.loc[matched, 0]
+            year = year_str.astype(int)
+            year = year.where(year_str.str.len() > 3, year + 1911)
+            result[matched] = (year.astype(str) + "-"
+                               + parts.loc[matched, 1].str.zfill(2) + "-"
+                               + parts.loc[matched, 2].str.zfill(2)).astype(object)
+
+        # 其他格式 (e.g. 20250105, 1/5/2025) 一次交給 pandas 解析
+        rest = ~matched & s.notna() & (s != "")
+        if rest.any():
+            parsed = pd.to_datetime(s[rest], errors="coerce", format="mixed")
+            result[rest] = parsed.dt.strftime("%Y-%m-%d").fillna("").astype(object)
+
+        return result
 
 if __name__ == "__main__":
     # Test Run
@@ -0,0 +1,218 @@
+import math
+from taiwan_admin import parse_location
+
+# 鄉鎮市區代表點 (緯度, 經度)，取公所 / 市中心附近的近似位置，誤差約 1~3 公里
+# 只用於「附近的動物醫院」這類排序，不適合當精確定位
+DISTRICT_CENTROIDS = {
+    "臺北市": {
+        "中正區": (25.0324, 121.5199), "大同區": (25.0634, 121.5130), "中山區": (25.0685, 121.5266),
+        "松山區": (25.0597, 121.5577), "大安區": (25.0264, 121.5435), "萬華區": (25.0287, 121.4977),
+        "信義區": (25.0330, 121.5654), "士林區": (25.0925, 121.5246), "北投區": (25.1320, 121.4987),
+        "內湖區": (25.0690, 121.5880), "南港區": (25.0547, 121.6066), "文山區": (24.9897, 121.5703),
+    },
+    "新北市": {
+        "板橋區": (25.0118, 121.4626), "新莊區": (25.0360, 121.4500), "中和區": (24.9994, 121.4990),
+        "永和區": (25.0077, 121.5160), "土城區": (24.9727, 121.4433), "樹林區": (24.9907, 121.4203),
+        "三峽區": (24.9340, 121.3687), "鶯歌區": (24.9550, 121.3540), "三重區": (25.0614, 121.4880),
+        "蘆洲區": (25.0849, 121.4737), "五股區": (25.0827, 121.4382), "泰山區": (25.0590, 121.4310),
+        "林口區": (25.0775, 121.3918), "八里區": (25.1468, 121.3987), "淡水區": (25.1696, 121.4410),
+        "三芝區": (25.2580, 121.5010), "石門區": (25.2904, 121.5680), "金山區": (25.2220, 121.6360),
+        "萬里區": (25.1790, 121.6890), "汐止區": (25.0630, 121.6580), "瑞芳區": (25.1090, 121.8100),
+        "貢寮區": (25.0220, 121.9080), "平溪區": (25.0260, 121.7390), "雙溪區": (25.0340, 121.8660),
+        "新店區": (24.9676, 121.5418), "深坑區": (25.0020, 121.6160), "石碇區": (24.9910, 121.6590),
+        "坪林區": (24.9370, 121.7110), "烏來區": (24.8650, 121.5500),
+    },
+    "基隆市": {
+        "仁愛區": (25.1276, 121.7400), "信義區": (25.1290, 121.7510), "中正區": (25.1420, 121.7740),
+        "中山區": (25.1500, 121.7300), "安樂區": (25.1200, 121.7100), "暖暖區": (25.0990, 121.7400),
+        "七堵區": (25.0950, 121.7130),
+    },
+    "桃園市": {
+        "桃園區": (24.9937, 121.3010), "中壢區": (24.9653, 121.2245), "平鎮區": (24.9459, 121.2180),
+        "八德區": (24.9285, 121.2846), "楊梅區": (24.9076, 121.1458), "蘆竹區": (25.0456, 121.2917),
+        "大溪區": (24.8803, 121.2868), "龍潭區": (24.8640, 121.2160), "龜山區": (24.9925, 121.3378),
+        "大園區": (25.0640, 121.1960), "觀音區": (25.0330, 121.0820), "新屋區": (24.9720, 121.1060),
+        "復興區": (24.8200, 121.3520),
+    },
+    "新竹市": {
+        "東區": (24.8039, 120.9750), "北區": (24.8160, 120.9580), "香山區": (24.7767, 120.9140),
+    },
+    "新竹縣": {
+        "竹北市": (24.8390, 121.0040), "竹東鎮": (24.7370, 121.0900), "新埔鎮": (24.8250, 121.0730),
+        "關西鎮": (24.7890, 121.1770), "湖口鄉": (24.9030, 121.0440), "新豐鄉": (24.8990, 120.9840),
+        "峨眉鄉": (24.6860, 120.9930), "寶山鄉": (24.7610, 120.9860), "北埔鄉": (24.7000, 121.0540),
+        "芎林鄉": (24.7740, 121.0770), "橫山鄉": (24.7200, 121.1160), "尖石鄉": (24.7070, 121.1990),
+        "五峰鄉": (24.6360, 121.1200),
+    },
+    "苗栗縣": {
+        "苗栗市": (24.5700, 120.8210), "頭份市": (24.6880, 120.9030), "竹南鎮": (24.6860, 120.8730),
+        "後龍鎮": (24.6120, 120.7870), "通霄鎮": (24.4890, 120.6790), "苑裡鎮": (24.4400, 120.6520),
+        "卓蘭鎮": (24.3100, 120.8230), "造橋鄉": (24.6420, 120.8630), "西湖鄉": (24.5570, 120.7440),
+        "頭屋鄉": (24.5740, 120.8460), "公館鄉": (24.4990, 120.8230), "銅鑼鄉": (24.4890, 120.7870),
+        "三義鄉": (24.4130, 120.7650), "大湖鄉": (24.4220, 120.8650), "獅潭鄉": (24.5400, 120.9230),
+        "三灣鄉": (24.6510, 120.9510), "南庄鄉": (24.5970, 121.0010), "泰安鄉": (24.4440, 120.9040),
+    },
+    "臺中市": {
+        "中區": (24.1420, 120.6800), "東區": (24.1370, 120.6970), "南區": (24.1210, 120.6630),
+        "西區": (24.1410, 120.6630), "北區": (24.1590, 120.6820), "北屯區": (24.1820, 120.6860),
+        "西屯區": (24.1810, 120.6250), "南屯區": (24.1380, 120.6440), "太平區": (24.1270, 120.7180),
+        "大里區": (24.0990, 120.6780), "霧峰區": (24.0620, 120.7000), "烏日區": (24.1050, 120.6240),
+        "豐原區": (24.2520, 120.7180), "后里區": (24.3090, 120.7110), "石岡區": (24.2750, 120.7800),
+        "東勢區": (24.2590, 120.8280), "和平區": (24.2690, 120.9600), "新社區": (24.2340, 120.8100),
+        "潭子區": (24.2100, 120.7050), "大雅區": (24.2290, 120.6480), "神岡區": (24.2580, 120.6620),
+        "大肚區": (24.1540, 120.5410), "沙鹿區": (24.2330, 120.5660), "龍井區": (24.1920, 120.5460),
+        "梧棲區": (24.2550, 120.5310), "清水區": (24.2680, 120.5590), "大甲區": (24.3480, 120.6220),
+        "外埔區": (24.3320, 120.6540), "大安區": (24.3460, 120.5860),
+    },
+    "彰化縣": {
+        "彰化市": (24.0810, 120.5380), "員林市": (23.9590, 120.5740), "和美鎮": (24.1110, 120.4970),
+        "鹿港鎮": (24.0560, 120.4340), "溪湖鎮": (23.9620, 120.4790), "二林鎮": (23.8990, 120.3740),
+        "田中鎮": (23.8580, 120.5800), "北斗鎮": (23.8700, 120.5210), "花壇鄉": (24.0290, 120.5380),
+        "芬園鄉": (24.0140, 120.6290), "大村鄉": (23.9930, 120.5400), "永靖鄉": (23.9240, 120.5480),
+        "伸港鄉": (24.1560, 120.4850), "線西鄉": (24.1290, 120.4660), "福興鄉": (24.0480, 120.4440),
+        "秀水鄉": (24.0350, 120.5030), "埔心鄉": (23.9530, 120.5440), "埔鹽鄉": (23.9990, 120.4640),
+        "大城鄉": (23.8530, 120.3210), "芳苑鄉": (23.9250, 120.3200), "竹塘鄉": (23.8600, 120.4270),
+        "社頭鄉": (23.8970, 120.5830), "二水鄉": (23.8070, 120.6190), "田尾鄉": (23.8910, 120.5250),
+        "埤頭鄉": (23.8900, 120.4620), "溪州鄉": (23.8510, 120.4920),
+    },
+    "南投縣": {
+        "南投市": (23.9150, 120.6840), "埔里鎮": (23.9650, 120.9680), "草屯鎮": (23.9740, 120.6800),
+        "竹山鎮": (23.7570, 120.6720), "集集鎮": (23.8290, 120.7850), "名間鄉": (23.8380, 120.6570),
+        "鹿谷鄉": (23.7450, 120.7530), "中寮鄉": (23.8790, 120.7670), "魚池鄉": (23.8960, 120.9360),
+        "國姓鄉": (24.0420, 120.8580), "水里鄉": (23.8120, 120.8540), "信義鄉": (23.7000, 120.8550),
+        "仁愛鄉": (24.0240, 121.1330),
+    },
+    "雲林縣": {
+        "斗六市": (23.7110, 120.5430), "斗南鎮": (23.6790, 120.4790), "虎尾鎮": (23.7080, 120.4330),
+        "西螺鎮": (23.7980, 120.4660), "土庫鎮": (23.6780, 120.3920), "北港鎮": (23.5720, 120.3020),
+        "古坑鄉": (23.6440, 120.5620), "大埤鄉": (23.6460, 120.4300), "莿桐鄉": (23.7610, 120.5030),
+        "林內鄉": (23.7590, 120.6150), "二崙鄉": (23.7710, 120.4160), "崙背鄉": (23.7580, 120.3550),
+        "麥寮鄉": (23.7530, 120.2520), "東勢鄉": (23.6750, 120.2530), "褒忠鄉": (23.6940, 120.3100),
+        "臺西鄉": (23.7030, 120.1960), "元長鄉": (23.6500, 120.3150), "四湖鄉": (23.6370, 120.2250),
+        "口湖鄉": (23.5850, 120.1850), "水林鄉": (23.5720, 120.2450),
+    },
+    "嘉義市": {
+        "東區": (23.4800, 120.4640), "西區": (23.4800, 120.4350),
+    },
+    "嘉義縣": {
+        "太保市": (23.4590, 120.3330), "朴子市": (23.4650, 120.2470), "布袋鎮": (23.3780, 120.1670),
+        "大林鎮": (23.6010, 120.4710), "民雄鄉": (23.5510, 120.4290), "溪口鄉": (23.6020, 120.3940),
+        "新港鄉": (23.5540, 120.3470), "六腳鄉": (23.4950, 120.2910), "東石鄉": (23.4590, 120.1540),
+        "義竹鄉": (23.3360, 120.2430), "鹿草鄉": (23.4110, 120.3080), "水上鄉": (23.4280, 120.3990),
+        "中埔鄉": (23.4250, 120.5220), "竹崎鄉": (23.5230, 120.5510), "梅山鄉": (23.5840, 120.5570),
+        "番路鄉": (23.4650, 120.5550), "大埔鄉": (23.2960, 120.5930), "阿里山鄉": (23.4670, 120.7330),
+    },
+    "臺南市": {
+        "中西區": (22.9920, 120.2000), "東區": (22.9800, 120.2240), "南區": (22.9620, 120.1880),
+        "北區": (23.0080, 120.2080), "安平區": (22.9920, 120.1660), "安南區": (23.0480, 120.1850),
+        "永康區": (23.0260, 120.2570), "歸仁區": (22.9670, 120.2930), "新化區": (23.0380, 120.3100),
+        "左鎮區": (23.0580, 120.4070), "玉井區": (23.1240, 120.4600), "楠西區": (23.1730, 120.4850),
+        "南化區": (23.0420, 120.4770), "仁德區": (22.9720, 120.2520), "關廟區": (22.9630, 120.3280),
+        "龍崎區": (22.9650, 120.3610), "官田區": (23.1940, 120.3140), "麻豆區": (23.1810, 120.2480),
+        "佳里區": (23.1650, 120.1770), "西港區": (23.1230, 120.2030), "七股區": (23.1400, 120.1400),
+        "將軍區": (23.1990, 120.1560), "學甲區": (23.2320, 120.1800), "北門區": (23.2670, 120.1260),
+        "新營區": (23.3100, 120.3170), "後壁區": (23.3660, 120.3620), "白河區": (23.3510, 120.4160),
+        "東山區": (23.3260, 120.4040), "六甲區": (23.2320, 120.3480), "下營區": (23.2360, 120.2640),
+        "柳營區": (23.2780, 120.3110), "鹽水區": (23.3200, 120.2660), "善化區": (23.1320, 120.2970),
+        "大內區": (23.1190, 120.3490), "山上區": (23.1030, 120.3530), "新市區": (23.0790, 120.2950),
+        "安定區": (23.1220, 120.2370),
+    },
+    "高雄市": {
+        "楠梓區": (22.7270, 120.3260), "左營區": (22.6900, 120.2950), "鼓山區": (22.6480, 120.2740),
+        "三民區": (22.6490, 120.3230), "鹽埕區": (22.6240, 120.2850), "前金區": (22.6270, 120.2940),
+        "新興區": (22.6310, 120.3090), "苓雅區": (22.6210, 120.3120), "前鎮區": (22.5950, 120.3140),
+        "旗津區": (22.5900, 120.2690), "小港區": (22.5650, 120.3380), "鳳山區": (22.6270, 120.3570),
+        "大寮區": (22.6050, 120.3950), "鳥松區": (22.6590, 120.3640), "林園區": (22.5000, 120.3950),
+        "仁武區": (22.7010, 120.3480), "大樹區": (22.6930, 120.4300), "大社區": (22.7300, 120.3470),
+        "岡山區": (22.7970, 120.2960), "路竹區": (22.8560, 120.2620), "橋頭區": (22.7570, 120.3060),
+        "梓官區": (22.7600, 120.2670), "彌陀區": (22.7830, 120.2470), "永安區": (22.8190, 120.2250),
+        "燕巢區": (22.7930, 120.3620), "田寮區": (22.8690, 120.3590), "阿蓮區": (22.8830, 120.3270),
+        "茄萣區": (22.9060, 120.1830), "湖內區": (22.9080, 120.2110), "旗山區": (22.8880, 120.4830),
+        "美濃區": (22.8980, 120.5420), "內門區": (22.9430, 120.4620), "杉林區": (22.9710, 120.5390),
+        "甲仙區": (23.0830, 120.5880), "六龜區": (22.9970, 120.6330), "茂林區": (22.8860, 120.6630),
+        "桃源區": (23.1590, 120.7630), "那瑪夏區": (23.2170, 120.6990),
+    },
+    "屏東縣": {
+        "屏東市": (22.6690, 120.4880), "潮州鎮": (22.5500, 120.5420), "東港鎮": (22.4660, 120.4490),
+        "恆春鎮": (22.0020, 120.7440), "萬丹鄉": (22.5890, 120.4860), "長治鄉": (22.6770, 120.5280),
+        "麟洛鄉": (22.6500, 120.5270), "九如鄉": (22.7400, 120.4900), "里港鄉": (22.7790, 120.4940),
+        "鹽埔鄉": (22.7540, 120.5730), "高樹鄉": (22.8260, 120.6000), "萬巒鄉": (22.5720, 120.5660),
+        "內埔鄉": (22.6120, 120.5670), "竹田鄉": (22.5850, 120.5440), "新埤鄉": (22.4700, 120.5500),
+        "枋寮鄉": (22.3660, 120.5930), "新園鄉": (22.5440, 120.4620), "崁頂鄉": (22.5150, 120.5140),
+        "林邊鄉": (22.4310, 120.5150), "南州鄉": (22.4900, 120.5100), "佳冬鄉": (22.4160, 120.5450),
+        "琉球鄉": (22.3420, 120.3700), "車城鄉": (22.0720, 120.7100), "滿州鄉": (22.0210, 120.8380),
+        "枋山鄉": (22.2600, 120.6560), "霧臺鄉": (22.7450, 120.7320), "瑪家鄉": (22.7070, 120.6440),
+        "泰武鄉": (22.5920, 120.6330), "來義鄉": (22.5250, 120.6330), "春日鄉": (22.3700, 120.6280),
+        "獅子鄉": (22.2020, 120.7050), "牡丹鄉": (22.1260, 120.7700), "三地門鄉": (22.7160, 120.6540),
+    },
+    "宜蘭縣": {
+        "宜蘭市": (24.7520, 121.7530), "羅東鎮": (24.6770, 121.7670), "蘇澳鎮": (24.5960, 121.8510),
+        "頭城鎮": (24.8590, 121.8230), "礁溪鄉": (24.8270, 121.7700), "壯圍鄉": (24.7450, 121.7810),
+        "員山鄉": (24.7420, 121.7220), "冬山鄉": (24.6340, 121.7920), "五結鄉": (24.6850, 121.7980),
+        "三星鄉": (24.6670, 121.6530), "大同鄉": (24.6760, 121.6040), "南澳鄉": (24.4640, 121.8000),
+    },
+    "花蓮縣": {
+        "花蓮市": (23.9910, 121.6110), "鳳林鎮": (23.7440, 121.4520), "玉里鎮": (23.3350, 121.3120),
+        "新城鄉": (24.1280, 121.6400), "吉安鄉": (23.9720, 121.5680), "壽豐鄉": (23.8690, 121.5080),
+        "光復鄉": (23.6690, 121.4230), "豐濱鄉": (23.5970, 121.5190), "瑞穗鄉": (23.4970, 121.3760),
+        "富里鄉": (23.1790, 121.2480), "秀林鄉": (24.1160, 121.6200), "萬榮鄉": (23.7150, 121.4070),
+        "卓溪鄉": (23.3460, 121.3010),
+    },
+    "臺東縣": {
+        "臺東市": (22.7580, 121.1440), "成功鎮": (23.0990, 121.3760), "關山鎮": (23.0470, 121.1630),
+        "卑南鄉": (22.7860, 121.0860), "鹿野鄉": (22.9130, 121.1360), "池上鄉": (23.1260, 121.2180),
+        "東河鄉": (22.9700, 121.3010), "長濱鄉": (23.3150, 121.4510), "太麻里鄉": (22.6150, 121.0070),
+        "大武鄉": (22.3400, 120.8900), "綠島鄉": (22.6610, 121.4900), "海端鄉": (23.1010, 121.1720),
+        "延平鄉": (22.9020, 121.0840), "金峰鄉": (22.5960, 120.9700), "達仁鄉": (22.2960, 120.8840),
+        "蘭嶼鄉": (22.0450, 121.5480),
+    },
+    "澎湖縣": {
+        "馬公市": (23.5660, 119.5790), "湖西鄉": (23.5830, 119.6590), "白沙鄉": (23.6660, 119.5980),
+        "西嶼鄉": (23.6010, 119.5070), "望安鄉": (23.3580, 119.5020), "七美鄉": (23.2060, 119.4300),
+    },
+    "金門縣": {
+        "金城鎮": (24.4340, 118.3170), "金湖鎮": (24.4390, 118.4190), "金沙鎮": (24.4900, 118.4110),
+        "金寧鄉": (24.4560, 118.3350), "烈嶼鄉": (24.4330, 118.2440), "烏坵鄉": (24.9930, 119.4530),
+    },
+    "連江縣": {
+        "南竿鄉": (26.1530, 119.9460), "北竿鄉": (26.2220, 119.9970), "莒光鄉": (25.9720, 119.9400),
+        "東引鄉": (26.3660, 120.4890),
+    },
+}
+
+# 縣市代表點：取轄下鄉鎮區代表點的平均 (只知道縣市時使用)
+CITY_CENTROIDS = {
+    city: (round(sum(p[0] for p in points.values()) / len(points), 4),
+           round(sum(p[1] for p in points.values()) / len(points), 4))
+    for city, points in DISTRICT_CENTROIDS.items()
+}
+
+EARTH_RADIUS_KM = 6371.0088
+
+def locate(city, district=None):
+    """
+    縣市 / 鄉鎮區 -> 代表點 (lat, lon)；只有縣市時退回縣市代表點
+    :return: (lat, lon) 或 None
+    """
+    if not city:
+        return None
+    point = DISTRICT_CENTROIDS.get(city, {}).get(district) if district else None
+    return point or CITY_CENTROIDS.get(city)
+
+def geocode(text):
+    """地址 / 地點描述 -> (lat, lon) 或 None (離線)"""
+    return locate(*parse_location(text))
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """兩點大圓距離 (公里)"""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+def bounding_box(lat, lon, radius_km):
+    """以 (lat, lon) 為中心、半徑 radius_km 的經緯度外接矩形 (min_lat, max_lat, min_lon, max_lon)"""
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    dlon = math.degrees(radius_km / (EARTH_RADIUS_KM * max(math.cos(math.radians(lat)), 1e-6)))
+    return lat - dlat, lat + dlat, lon - dlon, lon + dlon
@@ -0,0 +1,252 @@
+"""
+拾獲動物 -> 走失案件比對
+- 品種、毛色、性別、種類正規化 (來源資料寫法不一：貴賓犬 / 泰迪、黑白 / 賓士、虎班 / 虎斑)
+- 反向索引的鍵：(種類, 地區, 走失週, 品種或毛色 token)；只在「附近地區 × 日期視窗內的週」中找候選
+- 候選案件依品種、毛色、性別、距離、走失日期遠近計分
+
+索引列的格式由 index_rows 決定；規則變動時調高 MATCH_INDEX_VERSION (與 db.SCHEMA_VERSION)，init_db 會重建索引
+"""
+import heapq
+import re
+from datetime import date
+from gazetteer import DISTRICT_CENTROIDS, CITY_CENTROIDS, bounding_box, haversine_km
+from taiwan_admin import parse_location
+
+MATCH_INDEX_VERSION = 1
+
+MIXED_BREED = "混種"
+MIXED_WORDS = ("混種", "米克斯", "土狗", "土貓", "台灣土狗", "臺灣土狗")
+# 去掉括號與常見修飾詞、結尾的 犬/貓/狗 之後再對照
+BREED_ALIASES = {
+    "馬爾濟斯": "瑪爾濟斯", "拉不拉多": "拉布拉多", "泰迪": "貴賓", "紅貴賓": "貴賓",
+    "黃金": "黃金獵", "英短": "英國短毛", "美短": "美國短毛", "英長": "英國長毛",
+    "加菲": "異國短毛", "柯基": "威爾斯柯基", "雪橇": "哈士奇", "西伯利亞雪橇": "哈士奇",
+    "德國狼": "德國牧羊", "狼": "德國牧羊", "邊牧": "邊境牧羊", "豹": "孟加拉豹", "孟加拉": "孟加拉豹",
+    "法鬥": "法國鬥牛", "狐狸": "日本狐狸", "臺灣": "台灣", "羅威那": "洛威納", "柴": "柴犬",
+}
+_BREED_PREFIXES = ("迷你", "標準", "玩具", "長毛", "短毛")
+_BREED_SUFFIXES = "犬貓狗"
+_PARENTHESES = re.compile(r"[(（].*?[)）]")
+_UNKNOWN = {"", "其他", "不詳", "未知", "無", "不明"}
+
+# 毛色關鍵字 -> token (依序比對，比對到的字會移除，避免「三花」又算成「花」)
+COLOR_KEYWORDS = [
+    ("三花", ("三花", "黑", "白", "橘")),
+    ("玳瑁", ("玳瑁", "黑", "橘")),
+    ("賓士", ("黑", "白")),
+    ("虎斑", ("虎斑",)), ("虎班", ("虎斑",)), ("豹紋", ("虎斑",)),
+    ("巧克力", ("棕",)), ("咖啡", ("棕",)), ("奶油", ("米",)),
+    ("黑", ("黑",)), ("白", ("白",)), ("黃", ("黃",)), ("金", ("黃",)),
+    ("棕", ("棕",)), ("褐", ("棕",)), ("茶", ("棕",)), ("赤", ("棕",)), ("紅", ("棕",)),
+    ("灰", ("灰",)), ("銀", ("灰",)), ("藍", ("灰",)),
+    ("橘", ("橘",)), ("橙", ("橘",)), ("米", ("米",)), ("杏", ("米",)),
+]
+
+# 地區 (縣市 + 鄉鎮區；只知道縣市時為縣市) -> 代表點
+AREA_POINTS = {f"{city}{district}": point for city, points in DISTRICT_CENTROIDS.items()
+               for district, point in points.items()}
+AREA_POINTS.update(CITY_CENTROIDS)
+_DISTRICT_POINTS = [(f"{city}{district}", city, point) for city, points in DISTRICT_CENTROIDS.items()
+                    for district, point in points.items()]
+
+# 計分權重 (合計 1)；拾獲者不確定的欄位 (未提供) 以 0.5 計
+WEIGHTS = {"breed": 0.3, "color": 0.3, "sex": 0.1, "distance": 0.15, "recency": 0.15}
+MIXED_BREED_SCORE = 0.6  # 混種很常見，相符的鑑別力較低
+
+_EPOCH = date(1970, 1, 1).toordinal()
+
+def normalize_type(text):
+    text = (text or "").strip()
+    if not text:
+        return ""
+    if "貓" in text:
+        return "貓"
+    if "狗" in text or "犬" in text:
+        return "狗"
+    return "其他"
+
+def normalize_breed(text):
+    """品種 -> 正規化名稱；不詳時回傳空字串"""
+    text = _PARENTHESES.sub("", (text or "").replace(" ", "")).strip()
+    if text in _UNKNOWN:
+        return ""
+    if any(word in text for word in MIXED_WORDS):
+        return MIXED_BREED
+    for prefix in _BREED_PREFIXES:
+        if text.startswith(prefix) and len(text) > len(prefix) + 1:
+            text = text[len(prefix):]
+    if text in BREED_ALIASES:
+        return BREED_ALIASES[text]
+    if len(text) > 2 and text[-1] in _BREED_SUFFIXES:
+        text = text[:-1]
+    return BREED_ALIASES.get(text, text)
+
+def color_tokens(text):
+    """毛色描述 -> 顏色 / 花紋 token 集合 (黑白 -> {黑, 白})"""
+    text = (text or "").replace(" ", "")
+    tokens = set()
+    for keyword, values in COLOR_KEYWORDS:
+        if keyword in text:
+            tokens.update(values)
+            text = text.replace(keyword, "")
+    return tokens
+
+def normalize_sex(text):
+    text = (text or "").strip()
+    if text[:1] in ("公", "雄", "男"):
+        return "公"
+    if text[:1] in ("母", "雌", "女"):
+        return "母"
+    return ""
+
+def day_number(value):
+    """YYYY-MM-DD (或 date) -> 1970-01-01 起算的天數；無法解析時為 None"""
+    if isinstance(value, date):
+        return value.toordinal() - _EPOCH
+    try:
+        return date.fromisoformat((value or "")[:10]).toordinal() - _EPOCH
+    except ValueError:
+        return None
+
+def day_date(day):
+    """day_number 的反函數 -> date"""
+    return date.fromordinal(day + _EPOCH)
+
+def area_of(city, district):
+    return f"{city or ''}{district or ''}"
+
+def index_rows(pet_type, breed, sex, color, lost_time, city, district):
+    """
+    一筆案件的索引列 [(pet_type, area, week, token, breed, sex, colors, lost_day), ...]
+    token 用於產生候選；breed / sex / colors (毛色 token 串接) / lost_day 為計分用的內容，每列都有一份
+    沒有種類、縣市或走失日期的案件不建索引 (比對時這三項為必要條件)
+    """
+    pet_type = normalize_type(pet_type)
+    lost_day = day_number(lost_time)
+    area = area_of(city, district)
+    if not pet_type or not city or lost_day is None:
+        return []
+    breed = normalize_breed(breed)
+    sex = normalize_sex(sex)
+    week = lost_day // 7
+    colors = sorted(color_tokens(color))
+    tokens = [f"b:{breed}"] if breed else []
+    tokens.extend(f"c:{token}" for token in colors)
+    # 品種與毛色都不詳的案件仍要能被找到 (只以地區與日期比對)
+    return [(pet_type, area, week, token, breed, sex, ",".join(colors), lost_day) for token in tokens or ["*"]]
+
+class Sighting:
+    """
+    一筆拾獲 / 目擊資料與其候選範圍
+    :param location: 地點描述 (解析出縣市 / 鄉鎮區代表點)；或直接給 lat / lon
+    :param radius_km: 候選案件的地區代表點距離上限
+    :param days_back: 走失日期最多早於拾獲日期幾天
+    """
+    def __init__(self, pet_type, breed=None, color=None, sex=None, location=None, lat=None, lon=None,
+                 seen_on=None, radius_km=10.0, days_back=30):
+        self.pet_type = normalize_type(pet_type)
+        if not self.pet_type:
+            raise ValueError("需要指定種類 (狗 / 貓 / 其他)")
+        self.breed = normalize_breed(breed)
+        self.colors = color_tokens(color)
+        self.sex = normalize_sex(sex)
+        if lat is None or lon is None:
+            city, district = parse_location(location or "")
+            if not city:
+                raise ValueError(f"無法判斷拾獲地點: {location}")
+            lat, lon = AREA_POINTS.get(area_of(city, district)) or AREA_POINTS[city]
+        self.lat, self.lon = lat, lon
+        self.radius_km = radius_km
+        self.days_back = days_back
+        self.day = day_number(seen_on or date.today())
+        if self.day is None:
+            raise ValueError(f"無法解析日期: {seen_on}")
+        self.seen_on = day_date(self.day).isoformat()
+
+        # 候選地區：代表點在半徑內的鄉鎮區，以及其所屬縣市 (只知道縣市的案件)
+        # 先以外接矩形排除，只對矩形內的代表點算距離
+        min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_km)
+        self.areas = {}
+        cities = set()
+        for area, city, (point_lat, point_lon) in _DISTRICT_POINTS:
+            if min_lat <= point_lat <= max_lat and min_lon <= point_lon <= max_lon:
+                distance = haversine_km(lat, lon, point_lat, point_lon)
+                if distance <= radius_km:
+                    self.areas[area] = distance
+                    cities.add(city)
+        for city in cities:
+            self.areas[city] = haversine_km(lat, lon, *CITY_CENTROIDS[city])
+        # 拾獲前 days_back 天到拾獲後 1 天 (日期登記誤差)
+        self.first_day = self.day - days_back
+        self.last_day = self.day + 1
+        self.weeks = list(range(self.first_day // 7, self.last_day // 7 + 1))
+
+    @property
+    def tokens(self):
+        """候選條件：品種或任一毛色相符；兩者都未提供時為 None (不限)"""
+        tokens = [f"b:{self.breed}"] if self.breed else []
+        tokens.extend(f"c:{token}" for token in sorted(self.colors))
+        return tokens + ["*"] if tokens else None
+
+    def parts(self, area, breed, sex, colors):
+        """
+        走失日期以外的各項分數 (0~1)
+        :param colors: 案件的毛色 token (逗號分隔，同索引的 colors 欄位)
+        """
+        parts = {}
+        if not self.breed or not breed:
+            parts["breed"] = 0.5
+        elif breed == self.breed:
+            parts["breed"] = MIXED_BREED_SCORE if breed == MIXED_BREED else 1.0
+        else:
+            parts["breed"] = 0.0
+        colors = set(colors.split(",")) if colors else set()
+        parts["color"] = len(colors & self.colors) / len(self.colors) if self.colors and colors else 0.5
+        parts["sex"] = 0.5 if not self.sex or not sex else float(sex == self.sex)
+        parts["distance"] = self.proximity(area)
+        return parts
+
+    def proximity(self, area):
+        distance = self.areas.get(area, self.radius_km)
+        return max(0.0, 1 - distance / self.radius_km) if self.radius_km else 1.0
+
+    def recency(self, lost_day):
+        gap = max(0, self.day - lost_day)
+        return max(0.0, 1 - gap / self.days_back) if self.days_back else 1.0
+
+    def score(self, area, breed, sex, colors, lost_day):
+        """計分 (0~1) 與說明 (各項分數、距離、相符的毛色)"""
+        parts = self.parts(area, breed, sex, colors)
+        parts["recency"] = self.recency(lost_day)
+        total = sum(WEIGHTS[key] * value for key, value in parts.items())
+        return round(total, 4), {
+            "score_parts": {key: round(value, 3) for key, value in parts.items()},
+            "distance_km": round(self.areas.get(area, self.radius_km), 2),
+            "days_before_sighting": self.day - lost_day,
+            "matched_colors": sorted(set(colors.split(",")) & self.colors) if colors else [],
+        }
+
+def rank(sighting, rows, limit):
+    """
+    在 Python 中計分排序 (不經資料庫時使用，例如基準測試的對照組；db.find_matching_pets 在 SQLite 內計分)
+    候選列 (area, pet_id, breed, sex, colors, lost_day) -> (前 limit 名 [(score, pet_id, detail), ...], 候選數)
+    同一案件有多個 token 相符時會出現多列，只計一次
+    候選多半共用少數幾種 (地區, 品種, 性別, 毛色) 組合：走失日期以外的分數依組合快取，只有前 limit 名產生說明
+    """
+    totals = {}
+    profiles = {}
+    recency_weight = WEIGHTS["recency"]
+    for area, pet_id, breed, sex, colors, lost_day in rows:
+        if pet_id in totals:
+            continue
+        profile = (area, breed, sex, colors)
+        base = profiles.get(profile)
+        if base is None:
+            base = profiles[profile] = sum(WEIGHTS[key] * value
+                                           for key, value in sighting.parts(*profile).items())
+        totals[pet_id] = (base + recency_weight * sighting.recency(lost_day), profile, lost_day)
+
+    top = heapq.nsmallest(limit, totals.items(), key=lambda item: (-item[1][0], item[0]))
+    ranked = [(*sighting.score(*profile, lost_day), pet_id) for pet_id, (_, profile, lost_day) in top]
+    ranked.sort(key=lambda item: (-item[0], item[2]))
+    return [(score, pet_id, detail) for score, detail, pet_id in ranked], len(totals)
@@ -0,0 +1,217 @@
+"""
+Prometheus 文字格式的指標 (不依賴 prometheus_client)
+
+    REQUESTS = counter("pet_requests_total", "說明", ["route"])
+    REQUESTS.inc(route="/pets")
+
+    LATENCY = histogram("pet_db_call_duration_seconds", "說明", ["function"])
+    @LATENCY.time()              # 裝飾器：function 標籤預設為函式名稱 (__qualname__)
+    def upsert_pets(...): ...
+    with LATENCY.time(function="x"):   # context manager
+        ...
+
+METRICS_ENABLED=0 時不收集：裝飾器直接回傳原函式，context manager 為共用的空物件
+"""
+import bisect
+import functools
+import os
+import threading
+import time
+
+ENABLED = os.environ.get("METRICS_ENABLED", "1").lower() not in ("0", "false", "no", "off")
+
+# 預設的 histogram 區間 (秒)：涵蓋單一 SQL (ms 以下) 到整次爬取 (數十分鐘)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 300, 900, 1800, 3600)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} 需要標籤 {self.labelnames}，收到 {tuple(labels)}")
+        return tuple([str(labels[name]) for name in self.labelnames])
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            for key, value in items:
+                lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        if not ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        if not ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class _Timer:
+    """histogram 計時：可當 context manager 或裝飾器"""
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+    def __call__(self, fn):
+        labels = dict(self.labels)
+        if "function" in self.histogram.labelnames:
+            labels.setdefault("function", fn.__qualname__)
+        histogram = self.histogram
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+
+class _NullTimer:
+    """停用時的計時器：裝飾器不包裝函式，context manager 不做事"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return None
+
+    def __call__(self, fn):
+        return fn
+
+_NULL = _NullTimer()
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        if not ENABLED:
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [各區間次數..., 超出最大區間的次數, 總和]
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    def time(self, **labels):
+        """計時 (context manager / 裝飾器)"""
+        if not ENABLED:
+            return _NULL
+        return _Timer(self, labels)
+
+    def _samples(self, key, state):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), state[:-1]):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, [("le", _format_value(float(bound)))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(state[-1])}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+def _register(cls, name, *args, **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f"指標 {name} 已註冊為 {metric.type}")
+        return metric
+
+def counter(name, documentation, labelnames=()):
+    return _register(Counter, name, documentation, labelnames)
+
+def gauge(name, documentation, labelnames=()):
+    return _register(Gauge, name, documentation, labelnames)
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram, name, documentation, labelnames, buckets)
+
+def render():
+    """所有指標的 Prometheus 文字格式 (text/plain; version=0.0.4)"""
+    with _registry_lock:
+        metrics = sorted(_registry.values(), key=lambda m: m.name)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def error_reason(exc):
+    """例外 -> 錯誤標籤：HTTP 錯誤為狀態碼，其他為例外類別名稱"""
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None)
+    return str(status) if status else type(exc).__name__
+
+# 跨模組共用的指標
+UPSTREAM_ERRORS = counter("pet_upstream_http_errors_total",
+                          "呼叫外部服務失敗次數 (含之後重試成功的)", ["source", "reason"])
+CRAWL_PHASE_SECONDS = histogram("pet_crawl_phase_duration_seconds",
+                                "爬取各階段耗時 (fetch / clean / upsert 為每頁，close / photos 為每次爬取)", ["phase"])
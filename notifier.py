@@ -1,21 +1,59 @@
-
-import requests
 import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+import db
+import metrics
+import photos
+from metrics import UPSTREAM_ERRORS
+
+NOTIFY_SECONDS = metrics.histogram("pet_notification_request_duration_seconds", "發送通知的 HTTP 請求耗時", ["platform"])
+NOTIFICATIONS = metrics.counter("pet_notifications_total", "通知投遞結果 (sent / retried / failed / rate_limited / deferred / suppressed)",
+                                ["result"])
 
 # 設定 - 在實際部屬時建議移至環境變數
 DISCORD_WEBHOOK_URL = ""  # 使用者需填入自己的 Webhook
 LINE_NOTIFY_TOKEN = ""    # 使用者需填入自己的 Token
+LINE_NOTIFY_URL = "https://notify-api.line.me/api/notify"
+
+REQUEST_TIMEOUT = 10      # 單次發送逾時秒數
+
+# 每個端點的限速 (token bucket：每秒補充幾個 token, 桶容量)
+RATE_LIMITS = {
+    "discord": (0.5, 5),   # Discord webhook 約 5 次 / 2 秒，保守設定
+    "line": (0.25, 10),    # LINE Notify 每小時 1000 次
+}
+DISCORD_BATCH_SIZE = 10   # Discord 單則訊息最多 10 個 embeds
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 5          # 秒，第 n 次失敗後約等待 base * 2^(n-1) 秒
+MAX_BACKOFF = 600
+# 照片與較早刊登的 Open 案件相同時不發送 (同一隻動物以不同 UniqueKey 重複刊登)
+SUPPRESS_PHOTO_DUPLICATES = True
+
+def format_message(pet_data):
+    return f"🚨 【急尋】{pet_data['PetName']} ({pet_data['PetType']})\n" \
+           f"📅 時間: {pet_data['LostTime']}\n" \
+           f"📍 地點: {pet_data['LostPlace']}\n" \
+           f"🐶 品種: {pet_data['Breed']} / {pet_data['Color']}\n" \
+           f"📞 聯絡: {pet_data['OwnerName']} {pet_data['Phone']}\n" \
+           f"🖼 照片: {pet_data['Picture']}"
+
+def delivery_targets():
+    """目前設定的通知目的地 [(platform, endpoint), ...]，供爬蟲寫入外寄佇列"""
+    targets = []
+    if DISCORD_WEBHOOK_URL:
+        targets.append(("discord", DISCORD_WEBHOOK_URL))
+    if LINE_NOTIFY_TOKEN:
+        targets.append(("line", LINE_NOTIFY_TOKEN))
+    return targets
 
 def send_notification(pet_data, platform='all'):
     """
-    發送新走失案件通知
+    直接發送新走失案件通知 (同步；Daemon 改走外寄佇列，這裡保留給手動測試)
     """
-    message = f"🚨 【急尋】{pet_data['PetName']} ({pet_data['PetType']})\n" \
-              f"📅 時間: {pet_data['LostTime']}\n" \
-              f"📍 地點: {pet_data['LostPlace']}\n" \
-              f"🐶 品種: {pet_data['Breed']} / {pet_data['Color']}\n" \
-              f"📞 聯絡: {pet_data['OwnerName']} {pet_data['Phone']}\n" \
-              f"🖼 照片: {pet_data['Picture']}"
+    message = format_message(pet_data)
 
     if platform in ['discord', 'all'] and DISCORD_WEBHOOK_URL:
         _send_discord(message, pet_data['Picture'])
@@ -25,24 +63,254 @@ def send_notification(pet_data, platform='all'):
 
 def _send_discord(text, image_url):
     try:
-        payload = {
-            "content": text,
-            "embeds": [{
-                "image": {"url": image_url}
-            }]
-        }
-        requests.post(DISCORD_WEBHOOK_URL, json=payload)
+        _post_discord(DISCORD_WEBHOOK_URL, [{"text": text, "image": image_url}])
     except Exception as e:
         print(f"❌ Discord 發送失敗: {e}")
 
 def _send_line(text, image_url):
     try:
-        headers = {"Authorization": "Bearer " + LINE_NOTIFY_TOKEN}
-        payload = {"message": text, "imageThumbnail": image_url, "imageFullsize": image_url}
-        requests.post("https://notify-api.line.me/api/notify", headers=headers, data=payload)
+        _post_line(LINE_NOTIFY_TOKEN, text, image_url)
     except Exception as e:
         print(f"❌ LINE 發送失敗: {e}")
 
+def _post_discord(webhook_url, messages):
+    """發送一則 Discord 訊息；多筆案件合併成多個 embeds"""
+    if len(messages) == 1:
+        payload = {
+            "content": messages[0]["text"],
+            "embeds": [{
+                "image": {"url": messages[0]["image"]}
+            }]
+        }
+    else:
+        payload = {
+            "content": f"🚨 {len(messages)} 筆新走失案件",
+            "embeds": [{
+                "description": m["text"],
+                "image": {"url": m["image"]}
+            } for m in messages]
+        }
+    import requests
+    return requests.post(webhook_url, json=payload, timeout=REQUEST_TIMEOUT)
+
+def _post_line(token, text, image_url):
+    import requests
+    headers = {"Authorization": "Bearer " + token}
+    payload = {"message": text, "imageThumbnail": image_url, "imageFullsize": image_url}
+    return requests.post(LINE_NOTIFY_URL, headers=headers, data=payload, timeout=REQUEST_TIMEOUT)
+
+def _retry_after(response):
+    """解析 429 的等待秒數 (Retry-After header 或 Discord 的 retry_after 欄位)"""
+    header = response.headers.get("Retry-After")
+    if header:
+        try:
+            return float(header)
+        except ValueError:
+            pass
+    try:
+        return float(response.json().get("retry_after", 1))
+    except Exception:
+        return 1.0
+
+class TokenBucket:
+    """單一端點的限速器 (thread-safe)"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """取得一個 token；成功回傳 0，否則回傳需等待的秒數 (不消耗 token)"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds):
+        """收到 429 時暫停此端點"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+class NotificationWorker:
+    """
+    通知投遞 Worker：從 db 外寄佇列取出通知，依端點分組並行發送
+    - 每個端點有自己的 token bucket，遵守 429 Retry-After
+    - 失敗以指數退避重試，超過 MAX_ATTEMPTS 標記為 failed
+    - Discord 同時有多筆待發時合併成一則訊息
+    - 照片與較早案件相同的重複通報標記為 suppressed，不發送
+    """
+    def __init__(self, max_workers=4, poll_interval=2.0, claim_limit=100):
+        self.poll_interval = poll_interval
+        self.claim_limit = claim_limit
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="notifier")
+        self.buckets = {}
+        self.counters = {"sent": 0, "retried": 0, "failed": 0, "rate_limited": 0, "deferred": 0, "suppressed": 0}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        db.reset_stale_outbox()
+        self._thread = threading.Thread(target=self.run_forever, daemon=True, name="notifier-dispatch")
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        """
+        停止並等待結束：投遞執行緒跑完目前這一批、送出中的請求完成後才返回
+        (之後才能安全地由新的 Worker 呼叫 reset_stale_outbox，避免同一筆被重送)
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.executor.shutdown(wait=True)
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            try:
+                self.dispatch_once()
+            except Exception as e:
+                print(f"[{datetime.now()}] ❌ 通知投遞錯誤: {e}")
+            self._stop.wait(self.poll_interval)
+
+    def dispatch_once(self):
+        """取出一批到期通知，依端點分組後並行投遞，回傳處理筆數"""
+        items = db.claim_outbox(self.claim_limit)
+        if not items:
+            return 0
+        count = len(items)
+        items = self._suppress_duplicates(items)
+
+        groups = {}
+        for item in items:
+            groups.setdefault((item["platform"], item["endpoint"]), []).append(item)
+
+        futures = [self.executor.submit(self._deliver_group, platform, endpoint, group)
+                   for (platform, endpoint), group in groups.items()]
+        wait(futures)
+        for future in futures:
+            if future.exception():
+                print(f"[{datetime.now()}] ❌ 通知投遞錯誤: {future.exception()}")
+        return count
+
+    def _suppress_duplicates(self, items):
+        """照片與較早刊登的案件相同者不發送；照片無法判斷時照常發送"""
+        if not SUPPRESS_PHOTO_DUPLICATES:
+            return items
+        try:
+            duplicates = photos.find_duplicates({item["pet_id"] for item in items})
+        except Exception as e:
+            print(f"[{datetime.now()}] ⚠️ 照片比對失敗，照常發送: {e}")
+            return items
+        if not duplicates:
+            return items
+
+        kept = []
+        suppressed = {}
+        for item in items:
+            original = duplicates.get(item["pet_id"])
+            if original is None:
+                kept.append(item)
+            else:
+                suppressed.setdefault(original, []).append(item["id"])
+        for original, ids in suppressed.items():
+            db.suppress_outbox(ids, f"照片與案件 {original} 相同")
+            self._count("suppressed", len(ids))
+        print(f"[{datetime.now()}] 🔕 略過 {len(items) - len(kept)} 則重複案件通知 (照片相同)")
+        return kept
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+        counters.update(db.outbox_stats())
+        return counters
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.counters[key] += n
+        NOTIFICATIONS.inc(n, result=key)
+
+    def _bucket(self, platform, endpoint):
+        with self._lock:
+            if endpoint not in self.buckets:
+                rate, capacity = RATE_LIMITS.get(platform, (1.0, 1))
+                self.buckets[endpoint] = TokenBucket(rate, capacity)
+            return self.buckets[endpoint]
+
+    def _deliver_group(self, platform, endpoint, items):
+        bucket = self._bucket(platform, endpoint)
+        size = DISCORD_BATCH_SIZE if platform == "discord" else 1
+        chunks = [items[i:i+size] for i in range(0, len(items), size)]
+
+        for index, chunk in enumerate(chunks):
+            # 等 token；要等太久就把剩下的延後，不卡住其他端點
+            delay = bucket.try_acquire()
+            while delay:
+                if delay > self.poll_interval:
+                    remaining = [item["id"] for rest in chunks[index:] for item in rest]
+                    db.retry_outbox(remaining, delay, count_attempt=False)
+                    self._count("deferred", len(remaining))
+                    return
+                time.sleep(delay)
+                delay = bucket.try_acquire()
+
+            ids = [item["id"] for item in chunk]
+            try:
+                with NOTIFY_SECONDS.time(platform=platform):
+                    if platform == "discord":
+                        messages = [{"text": format_message(item["payload"]), "image": item["payload"].get("Picture", "")}
+                                    for item in chunk]
+                        response = _post_discord(endpoint, messages)
+                    else:
+                        pet = chunk[0]["payload"]
+                        response = _post_line(endpoint, format_message(pet), pet.get("Picture", ""))
+            except Exception as e:
+                UPSTREAM_ERRORS.inc(source=platform, reason=metrics.error_reason(e))
+                self._retry(chunk, str(e))
+                continue
+
+            if response.status_code >= 300:
+                UPSTREAM_ERRORS.inc(source=platform, reason=str(response.status_code))
+
+            if 200 <= response.status_code < 300:
+                db.complete_outbox(ids)
+                self._count("sent", len(ids))
+            elif response.status_code == 429:
+                retry_after = _retry_after(response)
+                bucket.pause(retry_after)
+                remaining = [item["id"] for rest in chunks[index:] for item in rest]
+                db.retry_outbox(remaining, retry_after, "HTTP 429", count_attempt=False)
+                self._count("rate_limited", len(remaining))
+                return
+            elif response.status_code >= 500:
+                self._retry(chunk, f"HTTP {response.status_code}")
+            else:
+                db.fail_outbox(ids, f"HTTP {response.status_code}: {response.text[:200]}")
+                self._count("failed", len(ids))
+
+    def _retry(self, chunk, error):
+        ids = [item["id"] for item in chunk]
+        attempts = max(item["attempts"] for item in chunk) + 1
+        if attempts >= MAX_ATTEMPTS:
+            db.fail_outbox(ids, error)
+            self._count("failed", len(ids))
+            return
+        delay = min(MAX_BACKOFF, BACKOFF_BASE * 2 ** (attempts - 1))
+        delay *= 1 + random.random() * 0.5
+        db.retry_outbox(ids, delay, error)
+        self._count("retried", len(ids))
+
 if __name__ == "__main__":
     # Test
     fake_pet = {
@@ -1,70 +1,393 @@
 
+import json
+import os
+import random
+import signal
+import socket
+import threading
 import time
-import schedule
+import uuid
 from datetime import datetime
-from db import init_db, upsert_pet, close_missing_pets
+import db
+from db import init_db, PetIngest
 from fetcher import MOAClient
-from notifier import send_notification
+from notifier import NotificationWorker, delivery_targets
+import photos
+import metrics
+from metrics import CRAWL_PHASE_SECONDS
+
+CRAWL_SECONDS = metrics.histogram("pet_crawl_duration_seconds", "整次爬取 (run_task) 耗時")
+CRAWLS = metrics.counter("pet_crawls_total", "爬取次數 (complete / incomplete / empty / error)", ["outcome"])
+CRAWL_ROWS = metrics.counter("pet_crawl_rows_total", "爬取處理的案件數", ["result"])
+LAST_CRAWL_ROWS = metrics.gauge("pet_crawl_last_rows", "最近一次爬取處理的案件數", ["result"])
+LAST_SUCCESS = metrics.gauge("pet_crawl_last_success_timestamp_seconds", "最近一次完整爬取完成的時間 (Unix 秒)")
+CRAWL_INTERVAL_GAUGE = metrics.gauge("pet_crawl_interval_seconds", "自適應排程目前的爬取間隔")
+CRAWL_DECISIONS = metrics.counter("pet_crawl_decisions_total", "排程決策 (crawl / skip / error)", ["action"])
+
+# 每次爬取的筆數上限 (0 / 未設定為抓取全部)
+CRAWL_LIMIT = int(os.environ.get("CRAWL_LIMIT", "0")) or None
+# 兩次爬取的初始間隔秒數 (以上次開始時間起算，重啟後沿用資料庫中的紀錄)
+CRAWL_INTERVAL = float(os.environ.get("CRAWL_INTERVAL_SECONDS", "3600"))
+# 自適應排程的間隔上下限：最近的爬取有變動時縮短 (乘以 CRAWL_SPEEDUP)，沒有變動時拉長 (乘以 CRAWL_BACKOFF)
+CRAWL_MIN_INTERVAL = float(os.environ.get("CRAWL_MIN_INTERVAL_SECONDS", "600"))
+CRAWL_MAX_INTERVAL = float(os.environ.get("CRAWL_MAX_INTERVAL_SECONDS", "14400"))
+CRAWL_SPEEDUP = float(os.environ.get("CRAWL_SPEEDUP", "0.5"))
+CRAWL_BACKOFF = float(os.environ.get("CRAWL_BACKOFF", "1.5"))
+# 間隔的隨機抖動比例 (±)，多個部署不會同時打上游
+CRAWL_JITTER = float(os.environ.get("CRAWL_JITTER", "0.1"))
+# 間隔至少為平均爬取耗時的幾倍 (爬取不會佔掉大部分時間)
+CRAWL_DURATION_FACTOR = 2
+# 保留最近幾筆排程決策 (狀態查詢用)
+MAX_DECISIONS = 20
+# 領導者租約有效秒數：持有者每 1/3 租期續約，停止續約超過租期後由其他行程接手
+LEASE_TTL = float(os.environ.get("CRAWLER_LEASE_TTL", "60"))
+# 啟動後至少等待幾秒才第一次爬取 (嵌入 API 行程時，避免與冷啟動後的第一批請求搶資源)
+CRAWL_STARTUP_DELAY = float(os.environ.get("CRAWL_STARTUP_DELAY", "0"))
+# 每次爬取後最多處理幾個案件的照片 (0 為不處理)；新案件優先，其餘留到下次
+PHOTO_BATCH_LIMIT = int(os.environ.get("PHOTO_BATCH_LIMIT", "500"))
+LEASE_NAME = "crawler"
+LAST_RUN_KEY = "crawler.last_run_at"
+LAST_SUCCESS_KEY = "crawler.last_success_at"
+SCHEDULE_KEY = "crawler.schedule"
+
+class LeaderLease:
+    """
+    跨行程的領導者租約 (存在 SQLite 的 leases 表)，同一時間只有一個行程執行爬蟲
+    背景執行緒每 ttl/3 秒嘗試取得或續約；續約因資料庫忙碌失敗時，在原租期內仍視為領導者
+    """
+    def __init__(self, name=LEASE_NAME, ttl=LEASE_TTL):
+        self.name = name
+        self.ttl = ttl
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._expires = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def is_leader(self):
+        return time.time() < self._expires
+
+    def try_acquire(self):
+        started = time.time()
+        try:
+            held = db.acquire_lease(self.name, self.holder, self.ttl)
+        except Exception as e:
+            print(f"[{datetime.now()}] ⚠️ 租約續約失敗: {e}")
+            return self.is_leader
+        was_leader = self.is_leader
+        self._expires = started + self.ttl if held else 0.0
+        if held and not was_leader:
+            print(f"[{datetime.now()}] 👑 取得爬蟲租約 ({self.holder})")
+        elif was_leader and not held:
+            print(f"[{datetime.now()}] ⚠️ 爬蟲租約已被其他行程接手")
+        return held
+
+    def _heartbeat(self):
+        while not self._stop.is_set():
+            self.try_acquire()
+            self._stop.wait(self.ttl / 3)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True, name="crawler-lease")
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        """停止續約並釋放租約 (其他行程不必等到過期)"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.is_leader:
+            db.release_lease(self.name, self.holder)
+            self._expires = 0.0
+
+class AdaptiveSchedule:
+    """
+    依最近爬取觀察到的變動量調整爬取間隔 (狀態存在 app_meta：重啟後沿用，API 行程也查得到)
+    - 有新增 / 變動 / 關閉：間隔乘以 speedup；沒有變動或探測判斷不必爬：乘以 backoff
+    - 間隔介於 [min_interval, max_interval]，且至少為平均爬取耗時的 CRAWL_DURATION_FACTOR 倍
+    - 下次時間 = max(本次開始 + 間隔 × 抖動, 本次結束)：上一次還沒結束不會開始下一次
+    - 探測 (只抓第一頁與尾頁) 看不到清單中段的關閉，距上次完整爬取超過 max_interval 時一律完整爬取
+    """
+    def __init__(self, interval=CRAWL_INTERVAL, min_interval=CRAWL_MIN_INTERVAL, max_interval=CRAWL_MAX_INTERVAL,
+                 speedup=CRAWL_SPEEDUP, backoff=CRAWL_BACKOFF, jitter=CRAWL_JITTER, rng=None):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.speedup = speedup
+        self.backoff = backoff
+        self.jitter = jitter
+        self.rng = rng or random.Random()
+        self.initial_interval = self._clamp(interval)
+        self.reload()
+
+    def _clamp(self, interval):
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def reload(self):
+        """從資料庫重新讀取狀態 (租約換手後沿用前一個領導者的排程)"""
+        try:
+            state = json.loads(db.get_meta(SCHEDULE_KEY) or "{}")
+        except ValueError:
+            state = {}
+        state.setdefault("interval", self.initial_interval)
+        state.setdefault("decisions", [])
+        if "next_run_at" not in state:
+            # 舊版只記錄上次開始時間
+            last = db.get_meta(LAST_RUN_KEY)
+            state["next_run_at"] = float(last) + state["interval"] if last is not None else 0.0
+        self.state = state
+        CRAWL_INTERVAL_GAUGE.set(state["interval"])
+        return state
+
+    @property
+    def interval(self):
+        return self.state["interval"]
+
+    @property
+    def next_run_at(self):
+        return self.state["next_run_at"]
+
+    def needs_full_crawl(self, now):
+        """不能只靠探測決定 (從未完整爬取過，或距上次完整爬取已超過 max_interval)"""
+        last_full = self.state.get("last_full_at")
+        return last_full is None or self.state.get("total_rows") is None or now - last_full >= self.max_interval
+
+    def probe_pages(self, batch_size):
+        """
+        探測的頁面 -> 預期筆數：第一頁，以及上次資料結尾所在的頁面
+        (結尾剛好切齊頁面時為下一頁，預期是空的；上游在尾端新增或移除都會改變這一頁)
+        """
+        total = self.state["total_rows"]
+        tail = total // batch_size * batch_size
+        return {0: min(batch_size, total), tail: total - tail}
+
+    def record(self, started, finished, action, reason, changes=None, total_rows=None, complete=False):
+        """
+        記錄一次決策並排定下次時間
+        :param action: crawl (完整爬取) / skip (探測後略過) / error
+        :param changes: 新增 + 變動 + 關閉筆數；None 表示無從判斷 (失敗、不完整)，間隔不變
+        :param complete: 本次爬取每一頁都成功 (才算完整爬取，探測可以依此略過)；
+            取不到資料或不完整的爬取只計入平均耗時，不更新上次完整爬取時間與筆數
+        """
+        state = self.state
+        if action == "crawl":
+            duration = finished - started
+            average = state.get("avg_duration")
+            state["avg_duration"] = duration if average is None else 0.7 * average + 0.3 * duration
+            if complete:
+                state["last_full_at"] = started
+                if total_rows is not None:
+                    state["total_rows"] = total_rows
+
+        interval = state["interval"]
+        if changes is not None:
+            interval *= self.speedup if changes else self.backoff
+        floor = CRAWL_DURATION_FACTOR * (state.get("avg_duration") or 0.0)
+        interval = self._clamp(max(interval, floor))
+        state["interval"] = interval
+        jittered = interval * self.rng.uniform(1 - self.jitter, 1 + self.jitter)
+        state["next_run_at"] = max(started + jittered, finished)
+
+        decision = {
+            "at": round(started, 3),
+            "action": action,
+            "reason": reason,
+            "changes": changes,
+            "duration_s": round(finished - started, 3),
+            "interval_s": round(interval, 1),
+            "next_run_at": round(state["next_run_at"], 3),
+        }
+        state["decisions"] = (state["decisions"] + [decision])[-MAX_DECISIONS:]
+        db.set_meta(SCHEDULE_KEY, json.dumps(state))
+        CRAWL_INTERVAL_GAUGE.set(interval)
+        CRAWL_DECISIONS.inc(action=action)
+        return decision
+
+    def status(self):
+        return {
+            "interval_seconds": round(self.interval, 1),
+            "min_interval_seconds": self.min_interval,
+            "max_interval_seconds": self.max_interval,
+            "next_run_at": self.next_run_at or None,
+            "avg_crawl_seconds": self.state.get("avg_duration"),
+            "last_full_crawl_at": self.state.get("last_full_at"),
+            "total_rows": self.state.get("total_rows"),
+            "decisions": list(reversed(self.state["decisions"])),
+        }
+
+def schedule_status():
+    """自適應排程的目前狀態 (API 的 /stats/crawler 用)"""
+    return AdaptiveSchedule().status()
 
 class PetCrawlerDaemon:
-    def __init__(self):
+    def __init__(self, interval=CRAWL_INTERVAL, lease_ttl=LEASE_TTL, startup_delay=CRAWL_STARTUP_DELAY):
         self.client = MOAClient()
+        self.startup_delay = startup_delay
+        self.lease = LeaderLease(ttl=lease_ttl)
+        # 通知投遞只在領導者行程執行 (啟動時會重設卡在 sending 的通知)
+        self.notifier = None
+        self._stop = threading.Event()
         # 初始化資料庫
         init_db()
+        self.schedule = AdaptiveSchedule(interval)
 
     def run_task(self):
-        """核心任務：更新資料庫並通知"""
+        """核心任務：(探測後) 更新資料庫並通知，再依觀察到的變動量排定下次時間"""
         print(f"\n[{datetime.now()}] ⏰ 定時任務啟動：開始更新資料庫...")
+        # 開始時就記錄，爬到一半重啟也不會馬上再爬一次
+        started = time.time()
+        db.set_meta(LAST_RUN_KEY, started)
+        try:
+            reason = "full_due"
+            # 沒有原始回應快取 (或重播模式) 時無從判斷頁面是否變動，一律完整爬取
+            if self.client.raw_cache and not self.client.replay and not self.schedule.needs_full_crawl(started):
+                if not self._probe():
+                    CRAWLS.inc(outcome="skipped")
+                    decision = self.schedule.record(started, time.time(), "skip", "probe_unchanged", changes=0)
+                    print(f"   💤 探測：第一頁與尾頁都沒有變動，略過本次爬取 "
+                          f"(下次間隔 {decision['interval_s'] / 60:.0f} 分鐘)")
+                    return None
+                reason = "probe_changed"
+            with CRAWL_SECONDS.time():
+                delta, result = self._crawl()
+        except Exception:
+            CRAWLS.inc(outcome="error")
+            self.schedule.record(started, time.time(), "error", "error")
+            raise
+
+        changes = None
+        total_rows = None
+        complete = delta is not None and result["complete"]
+        if complete:
+            # 同 LAST_SUCCESS gauge：只記錄完整爬取，爬到一半失敗不算成功
+            db.set_meta(LAST_SUCCESS_KEY, time.time())
+        if delta is not None:
+            changes = delta["inserted"] + delta["changed"] + delta["closed"]
+            if complete:
+                total_rows = result["total"]
+            elif not changes:
+                # 不完整且沒看到變動：不能當作上游沒有變動
+                changes = None
+        decision = self.schedule.record(started, time.time(), "crawl", reason, changes=changes, total_rows=total_rows,
+                                        complete=complete)
+        print(f"   📅 下次間隔 {decision['interval_s'] / 60:.0f} 分鐘 (本次變動 {changes if changes is not None else '未知'} 筆)")
+        return delta
+
+    def _probe(self):
+        """只抓第一頁與上次資料結尾所在的頁面；筆數不同或內容與上次處理過的不同時回傳 True (需要完整爬取)"""
+        expected = self.schedule.probe_pages(self.client.batch_size)
+        with CRAWL_PHASE_SECONDS.time(phase="probe"):
+            results = self.client.probe_pages(sorted(expected))
+        for skip, rows in expected.items():
+            count, changed = results[skip]
+            if count != rows or (count and changed):
+                return True
+        return False
+
+    def _crawl(self):
+        """完整爬取一次；回傳 (delta, 抓取結果)，取不到任何資料時 delta 為 None"""
+        # 新案件的通知在同一交易中寫入外寄佇列，由 NotificationWorker 另外投遞
+        ingest = PetIngest(outbox_targets=delivery_targets())
+
+        def handle_page(pets):
+            # 每頁抓到就寫入 (只寫入有變動的案件)，不等整份資料下載完
+            with CRAWL_PHASE_SECONDS.time(phase="upsert"):
+                page = ingest.write_page(pets)
+            new_ids = set(page["new_ids"])
+            for pet in pets:
+                if pet.get("UniqueKey") in new_ids:
+                    # 同批次重複的 ID 只顯示一次
+                    new_ids.discard(pet["UniqueKey"])
+                    print(f"   🔥 新案件發現！[{pet['PetName']}] @ {pet['LostPlace']}")
 
-        # 1. 抓取資料 (抓取全部，確保沒有遺漏)
-        pets = self.client.fetch_all_lost_pets(limit=1000)
-        if not pets:
+        # 1. 邊抓邊同步 (抓取全部，確保沒有遺漏)
+        # 與上次內容相同的頁面不清洗、不寫入，只記錄看過的 ID
+        result = self.client.stream_lost_pets(handle_page, limit=CRAWL_LIMIT, handle_unchanged=ingest.mark_seen)
+        if not result["pages"] and not result["skipped"]:
             print("   ⚠️ 無法取得新資料或資料為空。")
-            return
-
-        active_ids = []
-        new_count = 0
-        updated_count = 0
-
-        # 2. 存入資料庫
-        for pet in pets:
-            # 收集 ID 用於比對撤銷案件
-            if "UniqueKey" in pet:
-                active_ids.append(pet["UniqueKey"])
-
-            # upsert_pet 會回傳 True 如果是新案件
-            is_new = upsert_pet(pet)
-            
-            if is_new:
-                new_count += 1
-                print(f"   🔥 新案件發現！[{pet['PetName']}] @ {pet['LostPlace']}")
-                try:
-                    send_notification(pet)
-                except:
-                    pass
-            else:
-                updated_count += 1
-
-        # 3. 標記已撤銷案件 (API 沒給但 DB 是 Open 的)
-        close_missing_pets(active_ids)
-
-        print(f"   ✅ 更新完成: 新增 {new_count} 筆 / 更新 {updated_count} 筆")
-        
+            CRAWLS.inc(outcome="empty")
+            return None, result
+
+        # 2. 只有完整抓取才標記已撤銷案件
+        if not result["complete"]:
+            print("   ⚠️ 部分頁面抓取失敗，本次不關閉任何案件。")
+        with CRAWL_PHASE_SECONDS.time(phase="close"):
+            delta = ingest.finish(result["complete"])
+
+        for key in ("inserted", "changed", "unchanged", "closed"):
+            CRAWL_ROWS.inc(delta[key], result=key)
+            LAST_CRAWL_ROWS.set(delta[key], result=key)
+        CRAWLS.inc(outcome="complete" if result["complete"] else "incomplete")
+        if result["complete"]:
+            LAST_SUCCESS.set(time.time())
+
+        print(f"   ✅ 更新完成: 新增 {delta['inserted']} 筆 / 變動 {delta['changed']} 筆 / "
+              f"未變 {delta['unchanged']} 筆 / 關閉 {delta['closed']} 筆")
+
+        # 3. 照片索引 (失敗不影響本次爬取結果)
+        if PHOTO_BATCH_LIMIT:
+            try:
+                with CRAWL_PHASE_SECONDS.time(phase="photos"):
+                    stats = photos.index_photos(limit=PHOTO_BATCH_LIMIT)
+                if stats and stats["pets"]:
+                    print(f"   🖼️ 照片索引: 下載 {stats['downloaded']} 張 / 沿用 {stats['reused']} 筆 / "
+                          f"失敗 {stats['failed']} 張 / 稍後重試 {stats['skipped']} 張")
+            except Exception as e:
+                print(f"   ⚠️ 照片索引失敗: {e}")
+        return delta, result
+
+    def next_run_at(self):
+        """下次應執行的時間 (epoch 秒)；從未執行過時為 0 (立即執行)"""
+        self.schedule.reload()
+        return self.schedule.next_run_at
+
+    def _sync_notifier(self):
+        """只有領導者投遞通知；失去租約時停止"""
+        if self.lease.is_leader and self.notifier is None:
+            # 通知投遞與爬蟲分開執行，webhook 再慢也不影響爬蟲
+            self.notifier = NotificationWorker()
+            self.notifier.start()
+        elif not self.lease.is_leader and self.notifier is not None:
+            # stop() 等舊 Worker 送完手上的通知才返回，重新取得租約時才建立新的 Worker
+            self.notifier.stop()
+            self.notifier = None
+
     def start_daemon(self):
-        print("=== 🚀 寵物爬蟲 Daemon v2.0 啟動 (Ctrl+C 可停止) ===")
-        print("   📅 設定排程：每 1 小時執行一次 (測試用)")
-        
-        # 立即先執行一次
-        self.run_task()
-        
-        # 設定排程 (範例: 每小時)
-        schedule.every(1).hours.do(self.run_task)
-        # schedule.every().day.at("09:00").do(self.run_task)
-
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+        print("=== 🚀 寵物爬蟲 Daemon v2.1 啟動 (Ctrl+C 可停止) ===")
+        print(f"   📅 目前每 {self.schedule.interval / 60:g} 分鐘執行一次 (依變動量在 "
+              f"{self.schedule.min_interval / 60:g}–{self.schedule.max_interval / 60:g} 分鐘間調整)；"
+              f"多個行程中只有取得租約者會執行")
+        self.lease.start()
+        # 上次爬取時間存在資料庫：重啟後距上次不到一個間隔就不會立刻再爬
+        not_before = time.time() + self.startup_delay
 
-if __name__ == "__main__":
+        while not self._stop.is_set():
+            self._sync_notifier()
+            wait = self.lease.ttl / 3
+            if self.lease.is_leader:
+                if time.time() >= max(self.next_run_at(), not_before):
+                    try:
+                        self.run_task()
+                    except Exception as e:
+                        print(f"[{datetime.now()}] ❌ 爬取失敗: {e}")
+                wait = min(max(self.next_run_at(), not_before) - time.time(), wait)
+            self._stop.wait(max(wait, 1))
+
+        if self.notifier is not None:
+            self.notifier.stop()
+            self.notifier = None
+        self.lease.stop()
+        print(f"[{datetime.now()}] 👋 爬蟲 Daemon 已停止")
+
+    def stop(self):
+        self._stop.set()
+
+def main():
+    """獨立的爬蟲 worker (Procfile 的 worker)；收到 SIGTERM / Ctrl+C 時釋放租約後結束"""
     daemon = PetCrawlerDaemon()
-    daemon.start_daemon()
\ No newline at end of file
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: daemon.stop())
+    daemon.start_daemon()
+
+if __name__ == "__main__":
+    main()
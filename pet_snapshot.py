@@ -0,0 +1,321 @@
+"""
+Open 案件的記憶體快照：/pets 常見查詢不經 SQLite
+- 案件只在爬蟲同步後變動；資料世代 (generation) 改變時在背景整份重建，建好後一次替換參考，查詢不持有鎖
+- 欄位式存放：每個欄位一個 list / array，重複性高的字串 intern 共用，走失日期存成日序數 array
+- 依 (lost_time, id) 由新到舊排列，日期範圍與 cursor 分頁都是連續區段；
+  種類、縣市、鄉鎮區各有遞增的列位置 postings，篩選以交集加切片完成，只有回傳的那一頁才組成 dict
+- 快照回答不了的查詢 (關鍵字、已關閉案件、無法辨識的地名、LIKE 萬用字元) 或快照尚未追上目前世代時回傳 None，
+  由呼叫端改查 SQLite —— 回應快取以目前世代為 key，不能用舊快照回答
+
+可用環境變數 PET_SNAPSHOT=0 停用
+"""
+import itertools
+import operator
+import os
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+import db
+import metrics
+from taiwan_admin import city_candidates, district_candidates
+
+SNAPSHOT_ROWS = metrics.gauge("pet_snapshot_rows", "記憶體快照中的 Open 案件數")
+SNAPSHOT_QUERIES = metrics.counter("pet_snapshot_queries_total", "/pets 查詢由快照回答 (hit) 或改查 SQLite (fallback)",
+                                   ["result"])
+
+ENABLED = os.environ.get("PET_SNAPSHOT", "1").lower() not in ("0", "false", "no", "off")
+
+# 值重複性高的欄位：intern 後同樣的值共用一個字串物件
+INTERNED_COLUMNS = ("pet_type", "breed", "sex", "color", "lost_time", "created_at", "status", "city", "district")
+FLOAT_COLUMNS = ("lat", "lon")
+INT_COLUMNS = ("notified",)
+# 建立 postings 的欄位 (對應 iter_recent_pets 的種類 / 縣市 / 鄉鎮區篩選)
+POSTING_COLUMNS = ("pet_type", "city", "district")
+
+_ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+def _like_lower(text):
+    """SQLite 的 LIKE 只有 ASCII 字母不分大小寫"""
+    return text.translate(_ASCII_LOWER)
+
+def _float_column(values):
+    """數值欄位存成 array('d')，NULL 以 NaN 表示；有非數值時保留 list"""
+    try:
+        return array('d', [float('nan') if v is None else v for v in values])
+    except TypeError:
+        return list(values)
+
+def _int_column(values):
+    try:
+        return array('q', values)
+    except (TypeError, OverflowError):
+        return list(values)
+
+def _date_ordinal(text):
+    """'YYYY-MM-DD...' -> date.toordinal()；空字串為 0 (排在最舊)；其他格式回傳 None"""
+    if text == "":
+        return 0
+    if not isinstance(text, str) or len(text) < 10 or text[4] != "-" or text[7] != "-":
+        return None
+    try:
+        return datetime.strptime(text[:10], "%Y-%m-%d").toordinal()
+    except ValueError:
+        return None
+
+def _window(positions, start, end):
+    """遞增的列位置中落在 [start, end) 的部分"""
+    return positions[bisect_left(positions, start):bisect_left(positions, end)]
+
+def _union(lists):
+    if len(lists) == 1:
+        return lists[0]
+    return sorted(itertools.chain.from_iterable(lists))
+
+def _intersect(lists):
+    """多個遞增序列的交集 (逐一產生)：以最短的為主，其餘用二分搜尋往前推進"""
+    lists = sorted(lists, key=len)
+    first, rest = lists[0], lists[1:]
+    offsets = [0] * len(rest)
+    for pos in first:
+        for i, other in enumerate(rest):
+            j = bisect_left(other, pos, offsets[i])
+            offsets[i] = j
+            if j == len(other) or other[j] != pos:
+                break
+        else:
+            yield pos
+
+class PetSnapshot:
+    """
+    某個資料世代的 Open 案件 (建好後不再修改，可在執行緒間共用)
+    列位置 0 為最新的案件，順序同 iter_recent_pets (lost_time DESC, id DESC)
+    """
+    def __init__(self, generation, columns, rows):
+        started = time.perf_counter()
+        self.generation = generation
+        self.size = len(rows)
+        self.names = list(columns)
+        self._columns = {}
+        values_by_column = zip(*rows) if rows else [()] * len(columns)
+        for name, values in zip(columns, values_by_column):
+            if name in FLOAT_COLUMNS:
+                self._columns[name] = _float_column(values)
+            elif name in INT_COLUMNS:
+                self._columns[name] = _int_column(values)
+            elif name in INTERNED_COLUMNS:
+                self._columns[name] = [sys.intern(v) if isinstance(v, str) else v for v in values]
+            else:
+                self._columns[name] = list(values)
+        self._ids = self._columns["id"]
+        self._lost_time = self._columns["lost_time"]
+
+        # 走失日期的日序數 (遞減)；有無法解析的日期時字串順序與日期順序可能不一致，整份快照不回答查詢
+        ordinals = {}
+        for value in self._lost_time:
+            if value not in ordinals:
+                ordinals[value] = _date_ordinal(value)
+        self.exact = None not in ordinals.values()
+        self._days = array('i', [ordinals[v] or 0 for v in self._lost_time]) if self.exact else array('i')
+
+        self._postings = {}
+        for name in POSTING_COLUMNS:
+            postings = {}
+            for pos, value in enumerate(self._columns.get(name, ())):
+                if isinstance(value, str) and value:
+                    postings.setdefault(value, array('I')).append(pos)
+            self._postings[name] = postings
+
+        self._memory = None
+        self.built_at = datetime.now()
+        self.build_seconds = time.perf_counter() - started
+
+    def __len__(self):
+        return self.size
+
+    def memory_bytes(self):
+        """記憶體用量估計：欄位容器 + 不重複的值物件 (intern 的字串只算一次) + postings"""
+        if self._memory is None:
+            seen = set()
+            total = sys.getsizeof(self._days)
+            for column in self._columns.values():
+                total += sys.getsizeof(column)
+                if isinstance(column, list):
+                    for value in column:
+                        if id(value) not in seen:
+                            seen.add(id(value))
+                            total += sys.getsizeof(value)
+            for postings in self._postings.values():
+                total += sys.getsizeof(postings) + sum(sys.getsizeof(p) for p in postings.values())
+            self._memory = total
+        return self._memory
+
+    def _after(self, lost_time, pet_id):
+        """第一個 (lost_time, id) 小於 cursor 的列位置"""
+        key = (lost_time, pet_id)
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if (self._lost_time[mid], self._ids[mid]) < key:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def _matching(self, name, values):
+        return [self._postings[name][v] for v in values if v in self._postings[name]]
+
+    def query(self, days=14, city_filter=None, type_filter=None, fields=None, cursor=None, limit=None,
+              district_filter=None):
+        """
+        同 db.get_recent_pets (status='Open'、沒有 q)；快照無法回答時回傳 None
+        參數錯誤時與 SQL 版一樣丟出 ValueError
+        """
+        projection = db._projection(fields, db.PET_COLUMNS, ["id", "lost_time"])
+        names = projection.split(", ")
+        if not self.exact:
+            return None
+
+        start, end = 0, self.size
+        if cursor:
+            lost_time, pet_id = db.decode_cursor(cursor, 2)
+            if not isinstance(lost_time, str) or not isinstance(pet_id, str):
+                return None
+            start = self._after(lost_time, pet_id)
+        if days:
+            cutoff = (datetime.now() - timedelta(days=days)).toordinal()
+            end = bisect_right(self._days, -cutoff, key=operator.neg)
+
+        # 每個條件是幾個 postings 的聯集，條件之間取交集
+        filters = []
+        if type_filter:
+            if "%" in type_filter or "_" in type_filter:
+                return None
+            needle = _like_lower(type_filter)
+            filters.append([p for value, p in self._postings["pet_type"].items() if needle in _like_lower(value)])
+        cities = city_candidates(city_filter) if city_filter else []
+        if city_filter:
+            if not cities:
+                return None
+            filters.append(self._matching("city", cities))
+        if district_filter:
+            districts = district_candidates(district_filter, cities[0] if len(cities) == 1 else None)
+            if not districts:
+                return None
+            filters.append(self._matching("district", districts))
+
+        if start >= end or any(not lists for lists in filters):
+            positions = ()
+        elif filters:
+            positions = _intersect([_union([_window(p, start, end) for p in lists]) for lists in filters])
+        else:
+            positions = range(start, end)
+        if limit:
+            positions = itertools.islice(positions, int(limit))
+
+        columns = [(name, self._columns[name]) for name in names]
+        floats = [name for name in names if isinstance(self._columns[name], array) and self._columns[name].typecode == 'd']
+        results = []
+        for pos in positions:
+            row = {name: column[pos] for name, column in columns}
+            for name in floats:
+                if row[name] != row[name]:
+                    row[name] = None
+            results.append(row)
+        return results
+
+class PetSnapshots:
+    """
+    行程共用的快照參考 (用法類似 photos.PhotoIndex)
+    資料世代改變時在背景執行緒重建；重建期間的查詢改查 SQLite，不等待
+    """
+    def __init__(self):
+        self._current = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.fallbacks = 0
+        self.builds = 0
+
+    def current(self, generation=None):
+        """
+        與目前資料世代一致的快照；落後或尚未建立時觸發背景重建並回傳 None
+        :param generation: 呼叫端已取得的資料世代 (例如回應快取 middleware 查過的)，未指定時才查資料庫
+        """
+        if generation is None:
+            generation = db.get_generation()
+        snapshot = self._current
+        if snapshot is not None and snapshot.generation == generation:
+            return snapshot
+        self.refresh_async()
+        return None
+
+    def refresh(self):
+        """同步重建 (已是目前世代時略過)，回傳是否重建"""
+        with self._lock:
+            return self._rebuild()
+
+    def refresh_async(self):
+        """在背景重建；已有重建進行中時直接返回"""
+        if not self._lock.acquire(blocking=False):
+            return False
+
+        def run():
+            try:
+                self._rebuild()
+            except Exception as e:
+                print(f"[{datetime.now()}] ⚠️ 案件快照重建失敗: {e}")
+            finally:
+                self._lock.release()
+
+        threading.Thread(target=run, name="pet-snapshot", daemon=True).start()
+        return True
+
+    def _rebuild(self):
+        snapshot = self._current
+        if snapshot is not None and snapshot.generation == db.get_generation():
+            return False
+        snapshot = PetSnapshot(*db.load_open_pets())
+        self._current = snapshot
+        self.builds += 1
+        SNAPSHOT_ROWS.set(len(snapshot))
+        print(f"[{datetime.now()}] 🧊 案件快照已重建 (世代 {snapshot.generation}, {len(snapshot)} 筆, "
+              f"{snapshot.build_seconds:.2f}s)")
+        return True
+
+    def query(self, generation=None, **kwargs):
+        """
+        以目前世代的快照回答 /pets 查詢 (其餘參數同 PetSnapshot.query)；無法回答時回傳 None
+        :param generation: 同 current()，傳入時查詢完全不經 SQLite
+        """
+        if not ENABLED:
+            return None
+        snapshot = self.current(generation)
+        result = snapshot.query(**kwargs) if snapshot is not None else None
+        if result is None:
+            self.fallbacks += 1
+            SNAPSHOT_QUERIES.inc(result="fallback")
+        else:
+            self.hits += 1
+            SNAPSHOT_QUERIES.inc(result="hit")
+        return result
+
+    def stats(self):
+        snapshot = self._current
+        stats = {"enabled": ENABLED, "hits": self.hits, "fallbacks": self.fallbacks, "builds": self.builds}
+        if snapshot is not None:
+            memory = snapshot.memory_bytes()
+            stats.update({
+                "generation": snapshot.generation,
+                "rows": len(snapshot),
+                "memory_bytes": memory,
+                "bytes_per_row": round(memory / len(snapshot), 1) if len(snapshot) else 0,
+                "postings": {name: len(postings) for name, postings in snapshot._postings.items()},
+                "build_s": round(snapshot.build_seconds, 4),
+                "built_at": snapshot.built_at.isoformat(timespec="seconds"),
+            })
+        return stats
+
+# 行程共用的快照
+snapshots = PetSnapshots()
@@ -0,0 +1,392 @@
+"""
+案件照片索引：偵測同一隻動物以不同 UniqueKey 重複刊登 (晶片號碼缺漏、名字重打)
+- 每個 picture_url 只下載一次 (有上限的非同步並行)，原圖不保存
+- 以 dHash (64-bit 感知雜湊) 比對：重新壓縮、縮放、轉檔後的同一張照片距離很小
+- 縮圖以原圖內容雜湊存放 (content-addressed)，由 API 直接提供，不必引用政府網站的原圖
+- 記憶體中的多重索引 (multi-index hashing) 依 Hamming 距離查詢相似照片，不需與全部照片逐一比對
+
+Pillow 為選用套件：未安裝時不建立索引，相似查詢與通知去重停用
+"""
+import asyncio
+import functools
+import hashlib
+import io
+import itertools
+import os
+import random
+import threading
+import time
+from datetime import datetime
+import db
+import metrics
+from metrics import UPSTREAM_ERRORS
+
+PHOTO_DOWNLOADS = metrics.counter("pet_photo_downloads_total", "照片處理結果 (downloaded / reused / failed / skipped)",
+                                  ["result"])
+PHOTO_INDEX_SIZE = metrics.gauge("pet_photo_index_size", "照片索引中的案件數")
+
+# 縮圖目錄 (可用環境變數指定)
+PHOTO_CACHE_DIR = os.environ.get("PHOTO_CACHE_DIR", "photo_cache")
+THUMBNAIL_SIZE = 256
+THUMBNAIL_QUALITY = 80
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+# 兩張照片的 dHash 相差幾個位元以內視為同一張 (重新壓縮 / 縮放通常在 5 以內)
+DUPLICATE_DISTANCE = int(os.environ.get("PHOTO_DUPLICATE_DISTANCE", "6"))
+# 同一張圖被這麼多案件使用時視為「無照片」之類的預設圖，不當作重複
+PLACEHOLDER_MIN_PETS = 5
+# 幾乎全為 0 或 1 的雜湊來自單色 / 漸層圖片，沒有比對價值
+MIN_HASH_BITS = 4
+
+_pil_checked = None
+
+def available():
+    """Pillow 是否可用 (第一次呼叫時才載入)"""
+    global _pil_checked
+    if _pil_checked is None:
+        try:
+            import PIL.Image  # noqa: F401
+            _pil_checked = True
+        except ImportError:
+            print(f"[{datetime.now()}] ⚠️ 未安裝 Pillow，照片索引停用 (pip install Pillow)")
+            _pil_checked = False
+    return _pil_checked
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+def informative(phash):
+    bits = phash.bit_count()
+    return MIN_HASH_BITS <= bits <= 64 - MIN_HASH_BITS
+
+def dhash(image):
+    """
+    64-bit difference hash：縮成 9x8 灰階，每列相鄰像素左亮於右記為 1
+    :param image: PIL Image
+    """
+    from PIL import Image
+    small = image.convert("L").resize((9, 8), Image.Resampling.LANCZOS)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(8):
+        offset = row * 9
+        for col in range(8):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+def analyze(content: bytes):
+    """
+    解碼原圖，計算 dHash 並產生縮圖 (只解碼一次；JPEG 以 draft 模式在解碼時直接縮小)
+    :return: dict(sha256, phash, width, height, thumbnail)
+    :raises ValueError: 無法解碼的內容
+    """
+    from PIL import Image, ImageOps
+    try:
+        image = Image.open(io.BytesIO(content))
+        width, height = image.size
+        # thumbnail 自己的 draft 會保留兩倍大小，640x480 的照片就不會縮小解碼，這裡直接要求縮圖尺寸
+        scale = min(THUMBNAIL_SIZE / width, THUMBNAIL_SIZE / height, 1)
+        image.draft("RGB", (max(1, round(width * scale)), max(1, round(height * scale))))
+        # 先縮小再轉正 (方形框內縮圖，旋轉前後結果相同)
+        image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        image = ImageOps.exif_transpose(image).convert("RGB")
+    except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+        raise ValueError(f"無法解碼的圖片: {e}") from e
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+    return {
+        "sha256": hashlib.sha256(content).hexdigest(),
+        "phash": dhash(image),
+        "width": width,
+        "height": height,
+        "thumbnail": buffer.getvalue(),
+    }
+
+class ThumbnailStore:
+    """縮圖的磁碟快取：thumbs/<sha256 前兩碼>/<sha256>.jpg (以原圖內容雜湊為鍵)"""
+    def __init__(self, root=None):
+        self.root = os.path.join(root or PHOTO_CACHE_DIR, "thumbs")
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], f"{digest}.jpg")
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def save(self, digest, body: bytes):
+        path = self.path(digest)
+        if os.path.exists(path):
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(body)
+        os.replace(tmp, path)
+        return path
+
+class PhotoDownloader:
+    """
+    有上限的並行圖片下載
+    - 同時最多 concurrency 個請求；連線錯誤、429、5xx 以指數退避重試
+    - 超過 max_bytes 的回應中止下載
+    """
+    def __init__(self, concurrency=8, timeout=20, max_retries=2, backoff_base=0.5, max_bytes=MAX_IMAGE_BYTES):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_bytes = max_bytes
+        self.headers = {"User-Agent": "Mozilla/5.0 (compatible; PetHunter photo indexer)"}
+
+    def run(self, urls, handle):
+        """
+        下載所有網址，每張下載完就在執行緒中呼叫 handle (解碼與下載同時進行)
+        :param handle: handle(url, content, error, permanent)；成功時 error 為 None，
+                       失敗時 content 為 None，permanent 表示重試也不會成功 (4xx、過大)
+        """
+        urls = list(dict.fromkeys(urls))
+        if urls:
+            asyncio.run(self._run_async(urls, handle))
+
+    async def _run_async(self, urls, handle):
+        import httpx
+        semaphore = asyncio.Semaphore(self.concurrency)
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(headers=self.headers, verify=False, timeout=self.timeout,
+                                     follow_redirects=True, limits=limits) as client:
+            async def one(url):
+                async with semaphore:
+                    content, error, permanent = await self._get(client, url)
+                await asyncio.to_thread(handle, url, content, error, permanent)
+
+            results = await asyncio.gather(*(one(url) for url in urls), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"[{datetime.now()}] ❌ 照片處理錯誤: {result}")
+
+    async def _get(self, client, url):
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with client.stream("GET", url) as response:
+                    if response.status_code == 429 or response.status_code >= 500:
+                        response.raise_for_status()
+                    if response.status_code >= 400:
+                        UPSTREAM_ERRORS.inc(source="photo", reason=str(response.status_code))
+                        return None, f"HTTP {response.status_code}", True
+                    declared = int(response.headers.get("Content-Length") or 0)
+                    if declared > self.max_bytes:
+                        return None, f"圖片過大 ({declared} bytes)", True
+                    chunks = []
+                    size = 0
+                    async for chunk in response.aiter_bytes():
+                        size += len(chunk)
+                        if size > self.max_bytes:
+                            return None, f"圖片過大 (> {self.max_bytes} bytes)", True
+                        chunks.append(chunk)
+                    return b"".join(chunks), None, False
+            except Exception as e:
+                UPSTREAM_ERRORS.inc(source="photo", reason=metrics.error_reason(e))
+                if attempt >= self.max_retries:
+                    return None, str(e) or type(e).__name__, False
+            delay = self.backoff_base * (2 ** attempt)
+            await asyncio.sleep(delay + random.uniform(0, delay))
+
+def index_photos(pet_ids=None, limit=None, downloader=None, store=None):
+    """
+    下載尚未處理的案件照片，寫入雜湊與縮圖
+    相同網址只下載一次，已處理過的網址 (其他案件用過) 直接沿用
+    暫時性錯誤不記錄，下次再試；4xx / 無法解碼則記錄錯誤，網址變更前不再下載
+    :param pet_ids: 只處理指定案件 (通知去重用)；未指定時處理所有 Open 案件
+    :param limit: 本次最多處理幾個案件
+    :return: 統計 dict；Pillow 未安裝時回傳 None
+    """
+    if not available():
+        return None
+    pending = db.pets_missing_photos(pet_ids=pet_ids, limit=limit)
+    stats = {"pets": len(pending), "downloaded": 0, "reused": 0, "failed": 0, "skipped": 0}
+    if not pending:
+        return stats
+
+    pets_by_url = {}
+    for pet_id, url in pending:
+        pets_by_url.setdefault(url, []).append(pet_id)
+    known = db.get_photos_by_url(pets_by_url)
+    store = store or ThumbnailStore()
+    photos = []
+    links = [(pet_id, url, known[url], None) for url in known for pet_id in pets_by_url[url]]
+    stats["reused"] = len(links)
+    lock = threading.Lock()
+
+    def handle(url, content, error, permanent):
+        # 在多個執行緒中執行
+        if content is not None:
+            try:
+                photo = analyze(content)
+            except ValueError as e:
+                error, permanent = str(e), True
+            else:
+                store.save(photo["sha256"], photo.pop("thumbnail"))
+                with lock:
+                    photos.append(photo)
+                    links.extend((pet_id, url, photo["sha256"], None) for pet_id in pets_by_url[url])
+                    stats["downloaded"] += 1
+                return
+        with lock:
+            if permanent:
+                links.extend((pet_id, url, None, error) for pet_id in pets_by_url[url])
+                stats["failed"] += 1
+            else:
+                stats["skipped"] += 1
+
+    (downloader or PhotoDownloader()).run([url for url in pets_by_url if url not in known], handle)
+    db.save_pet_photos(photos, links)
+    for key in ("downloaded", "reused", "failed", "skipped"):
+        PHOTO_DOWNLOADS.inc(stats[key], result=key)
+    return stats
+
+@functools.lru_cache(maxsize=None)
+def _flip_masks(bits, radius):
+    """bits 位元內所有 1 的個數不超過 radius 的遮罩 (查詢各段的鄰近鍵用)"""
+    return tuple(sum(1 << i for i in combo)
+                 for r in range(radius + 1) for combo in itertools.combinations(range(bits), r))
+
+class MultiIndexHash:
+    """
+    64-bit 雜湊的多重索引 (multi-index hashing)：切成 4 段 16 位元，每段一張 hash table
+    距離 <= r 的兩個雜湊至少有一段相差 <= r // 4 個位元 (鴿籠原理)，只需查各段 r // 4 以內的鄰近鍵再驗證完整距離
+    (BK-tree 在 64-bit 隨機雜湊上幾乎無法剪枝：距離都集中在 32 附近，實測比逐一比對還慢)
+    """
+    CHUNKS = 4
+    BITS = 16
+
+    def __init__(self):
+        self._tables = [{} for _ in range(self.CHUNKS)]
+        self._values = {}
+
+    def __len__(self):
+        return len(self._values)
+
+    def add(self, key, value):
+        values = self._values.get(key)
+        if values is None:
+            values = self._values[key] = set()
+            mask = (1 << self.BITS) - 1
+            for i, table in enumerate(self._tables):
+                table.setdefault((key >> (i * self.BITS)) & mask, []).append(key)
+        values.add(value)
+
+    def search(self, key, radius):
+        """距離 radius 以內的雜湊 [(distance, hash, 值的集合), ...]，依距離排序"""
+        mask = (1 << self.BITS) - 1
+        flips = _flip_masks(self.BITS, min(radius // self.CHUNKS, self.BITS))
+        seen = set()
+        found = []
+        for i, table in enumerate(self._tables):
+            part = (key >> (i * self.BITS)) & mask
+            for flip in flips:
+                for candidate in table.get(part ^ flip, ()):
+                    if candidate in seen:
+                        continue
+                    seen.add(candidate)
+                    distance = hamming(key, candidate)
+                    if distance <= radius:
+                        found.append((distance, candidate, self._values[candidate]))
+        found.sort(key=lambda item: item[0])
+        return found
+
+class PhotoIndex:
+    """
+    照片雜湊的記憶體索引 (每個行程一份)
+    photo_generation 變動時 (有新照片寫入) 整份重建後替換，查詢不需持有鎖
+    """
+    def __init__(self):
+        self._table = MultiIndexHash()
+        self._hashes = {}
+        self._digests = {}
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        generation = db.get_generation("photo_generation")
+        if generation == self._generation:
+            return False
+        with self._lock:
+            if generation == self._generation:
+                return False
+            started = time.perf_counter()
+            table = MultiIndexHash()
+            hashes = {}
+            digests = {}
+            for pet_id, phash, digest in db.get_photo_hashes():
+                table.add(phash, pet_id)
+                hashes[pet_id] = phash
+                digests[pet_id] = digest
+            self._table, self._hashes, self._digests, self._generation = table, hashes, digests, generation
+            PHOTO_INDEX_SIZE.set(len(hashes))
+            print(f"[{datetime.now()}] 🖼️ 照片索引已重建 ({len(hashes)} 筆, {time.perf_counter() - started:.2f}s)")
+            return True
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def phash(self, pet_id):
+        return self._hashes.get(pet_id)
+
+    def digest(self, pet_id):
+        """案件照片的內容雜湊 (縮圖檔名)"""
+        return self._digests.get(pet_id)
+
+    def lookup(self, phash, max_distance=DUPLICATE_DISTANCE):
+        """雜湊相近的案件 [(pet_id, distance), ...]；預設圖與單色圖不比對"""
+        if not informative(phash):
+            return []
+        matches = []
+        for distance, _, pet_ids in self._table.search(phash, max_distance):
+            if len(pet_ids) >= PLACEHOLDER_MIN_PETS:
+                continue
+            matches.extend((pet_id, distance) for pet_id in sorted(pet_ids))
+        return matches
+
+    def similar(self, pet_id, max_distance=DUPLICATE_DISTANCE):
+        """與案件照片相近的其他案件；案件尚無照片雜湊時回傳 None"""
+        phash = self._hashes.get(pet_id)
+        if phash is None:
+            return None
+        return [(other, distance) for other, distance in self.lookup(phash, max_distance) if other != pet_id]
+
+# 行程共用的索引 (API 查詢與通知去重)
+index = PhotoIndex()
+
+def find_duplicates(pet_ids, max_distance=DUPLICATE_DISTANCE):
+    """
+    找出照片與較早刊登的 Open 案件相同的案件 (重複通報)
+    尚未處理照片的案件先下載處理；照片無法取得時不視為重複
+    :return: {pet_id: 較早的案件 id}
+    """
+    pet_ids = set(pet_ids)
+    # 在通知投遞前執行：逾時較短且不重試，下載不到的照片留給爬取後的批次處理
+    if not pet_ids or index_photos(pet_ids=pet_ids, downloader=PhotoDownloader(timeout=10, max_retries=0)) is None:
+        return {}
+    index.refresh()
+    matches = {}
+    for pet_id in pet_ids:
+        similar = index.similar(pet_id, max_distance)
+        if similar:
+            matches[pet_id] = similar
+    if not matches:
+        return {}
+
+    others = {other for similar in matches.values() for other, _ in similar}
+    pets = db.get_pets_by_ids(set(matches) | others, fields="created_at,status")
+    duplicates = {}
+    for pet_id, similar in matches.items():
+        me = pets.get(pet_id)
+        if me is None:
+            continue
+        for other, _ in similar:
+            pet = pets.get(other)
+            # 較早刊登 (同時刊登時以 ID 排序) 的案件保留通知
+            if pet and pet["status"] == "Open" and (pet["created_at"], other) < (me["created_at"], pet_id):
+                duplicates[pet_id] = other
+                break
+    return duplicates
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import time
+from urllib.parse import urlencode
+import db
+
+# 原始回應快取目錄 (可用環境變數指定)
+RAW_CACHE_DIR = os.environ.get("RAW_CACHE_DIR", "raw_cache")
+# 已處理內容的雜湊存在資料庫 app_meta 的 key 前綴
+APPLIED_META_PREFIX = "raw_applied:"
+
+class RawResponseCache:
+    """
+    上游原始回應的磁碟快取 (content-addressed)
+    - blobs/<sha256 前兩碼>/<sha256>：回應內容，相同內容只存一份
+    - refs/<key>.json：URL + 參數 -> 內容雜湊與 ETag / Last-Modified，供條件式請求與比對是否變動
+    「是否變動」以最後一次處理成功 (mark_applied) 的內容為準，下載後處理失敗的內容下次仍視為變動
+    已處理的內容雜湊記在資料庫 (app_meta) 而非快取目錄：換成新的、還原的或另一個資料庫 (DB_PATH) 時，
+    快取中的內容對該資料庫一律視為變動，不會因為磁碟上還有快取就略過寫入
+    """
+    def __init__(self, root=None):
+        self.root = root or RAW_CACHE_DIR
+        self.blob_dir = os.path.join(self.root, "blobs")
+        self.ref_dir = os.path.join(self.root, "refs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.ref_dir, exist_ok=True)
+
+    @staticmethod
+    def key(url, params=None):
+        """URL 與參數 (排序後) 的雜湊，作為快取 key"""
+        canonical = url
+        if params:
+            canonical += "\x1f" + urlencode(sorted((str(k), str(v)) for k, v in params.items()))
+        return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+    def _ref_path(self, key):
+        return os.path.join(self.ref_dir, f"{key}.json")
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def get_ref(self, key):
+        try:
+            with open(self._ref_path(key), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _applied(key):
+        return db.get_meta(APPLIED_META_PREFIX + key)
+
+    def conditional_headers(self, key):
+        """條件式請求標頭；快取內容不存在時回傳空 dict (必須完整下載)"""
+        ref = self.get_ref(key)
+        if not ref or not os.path.exists(self._blob_path(ref["sha256"])):
+            return {}
+        headers = {}
+        if ref.get("etag"):
+            headers["If-None-Match"] = ref["etag"]
+        if ref.get("last_modified"):
+            headers["If-Modified-Since"] = ref["last_modified"]
+        return headers
+
+    def load(self, key):
+        """讀取 key 目前對應的內容；沒有快取時回傳 None"""
+        ref = self.get_ref(key)
+        if not ref:
+            return None
+        try:
+            with open(self._blob_path(ref["sha256"]), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_ref(self, key, ref):
+        tmp = f"{self._ref_path(key)}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(ref, f)
+        os.replace(tmp, self._ref_path(key))
+
+    def store(self, key, body: bytes, headers=None):
+        """
+        存入新下載的內容並更新 ref
+        :return: 內容是否與上次處理過的不同 (伺服器不支援條件式請求時，以內容雜湊判斷)
+        """
+        digest = hashlib.sha256(body).hexdigest()
+        path = self._blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(body)
+            os.replace(tmp, path)
+
+        headers = headers or {}
+        ref = {
+            "sha256": digest,
+            "etag": headers.get("ETag") or headers.get("etag"),
+            "last_modified": headers.get("Last-Modified") or headers.get("last-modified"),
+            "fetched_at": time.time(),
+        }
+        self._write_ref(key, ref)
+        return self._applied(key) != digest
+
+    def is_pending(self, key):
+        """目前快取的內容是否尚未處理成功 (伺服器回 304 時用來判斷)"""
+        ref = self.get_ref(key)
+        return not ref or self._applied(key) != ref["sha256"]
+
+    def mark_applied(self, key):
+        """
+        記錄目前快取的內容已處理完成 (寫入資料庫等)，之後相同內容會被略過
+        須在資料寫入成功後呼叫：中間中斷時下次只會重新寫入 (寫入為冪等)，不會漏寫
+        """
+        ref = self.get_ref(key)
+        if ref and self._applied(key) != ref["sha256"]:
+            db.set_meta(APPLIED_META_PREFIX + key, ref["sha256"])
+
+    def prune(self):
+        """刪除已沒有任何 ref 指向的內容，回傳刪除數量"""
+        live = set()
+        for name in os.listdir(self.ref_dir):
+            if name.endswith(".json"):
+                ref = self.get_ref(name[:-5])
+                if ref:
+                    live.add(ref["sha256"])
+        removed = 0
+        for sub in os.listdir(self.blob_dir):
+            sub_dir = os.path.join(self.blob_dir, sub)
+            for digest in os.listdir(sub_dir):
+                if digest not in live and not digest.endswith(".tmp"):
+                    os.remove(os.path.join(sub_dir, digest))
+                    removed += 1
+        return removed
@@ -1,83 +1,208 @@
 
 import pandas as pd
 import requests
+import codecs
+import csv
 import io
 import os
+import json
 import urllib3
-from db import upsert_clinic, init_db
+from db import replace_clinics, init_db
+from raw_cache import RawResponseCache
 
 # 關閉 SSL 警告
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
+# 重播模式：不連網，使用原始回應快取 (同 fetcher.FETCH_REPLAY)
+FETCH_REPLAY = os.environ.get("FETCH_REPLAY", "").lower() in ("1", "true", "yes", "on")
+
+# 判斷格式與編碼時最多看開頭多少位元組
+SNIFF_BYTES = 64 * 1024
+# CSV 每次解析的列數
+CSV_CHUNK_ROWS = 5000
+# 沒有 BOM 時依序嘗試的編碼 (cp950 涵蓋 big5)
+CSV_ENCODINGS = ("utf-8", "cp950")
+# fetch_source 回傳的 DataFrame 在 attrs 中帶著原始回應快取的 key，save_to_db 寫入成功後以此標記已處理
+CACHE_KEY_ATTR = "raw_cache_key"
+
+class ResourceSource:
+    """
+    一個 MOA 開放資料資源：下載網址與欄位對應 (目標欄位 -> 原始欄位名稱的關鍵字)
+    新增資料集 (收容所、認養清單...) 只需宣告一個 ResourceSource，再決定寫入方式
+    """
+    def __init__(self, key, name, url, columns):
+        self.key = key
+        self.name = name
+        self.url = url
+        self.columns = columns
+
+    def map_columns(self, header):
+        """
+        原始欄位名稱 (已去除前後空白) -> {欄位位置: 目標欄位}
+        每個目標取第一個名稱含任一關鍵字、且尚未被其他目標使用的欄位
+        """
+        mapping = {}
+        for target, keywords in self.columns.items():
+            for index, column in enumerate(header):
+                if index not in mapping and any(k in column for k in keywords):
+                    mapping[index] = target
+                    break
+        return mapping
+
+VET_CLINICS = ResourceSource(
+    "vet", "動物醫院", "https://data.moa.gov.tw/Service/OpenData/DataFileService.aspx?UnitId=078",
+    {"name": ["機構名稱"], "tel": ["電話"], "address": ["地址"], "doctor_name": ["獸醫", "負責人"]},
+)
+
+RESOURCE_SOURCES = {source.key: source for source in (VET_CLINICS,)}
+
+def sniff(content: bytes, limit=SNIFF_BYTES):
+    """
+    只看開頭 limit 位元組判斷格式與編碼
+    :return: (format, encoding) - format 為 "json" 或 "csv"
+    """
+    head = content[:limit]
+    if head.startswith(codecs.BOM_UTF8):
+        encoding = "utf-8-sig"
+        head = head[len(codecs.BOM_UTF8):]
+    else:
+        encoding = CSV_ENCODINGS[-1]
+        for candidate in CSV_ENCODINGS:
+            try:
+                # 開頭可能切在多位元組字元中間，不視為結尾
+                codecs.getincrementaldecoder(candidate)().decode(head, final=False)
+            except UnicodeDecodeError:
+                continue
+            encoding = candidate
+            break
+    fmt = "json" if head.lstrip()[:1] in (b"[", b"{") else "csv"
+    return fmt, encoding
+
+def _parse_json(content, encoding, source):
+    data = json.loads(content if encoding.startswith("utf-8") else content.decode(encoding))
+    if not isinstance(data, list):
+        raise ValueError("JSON 不是資料列的陣列")
+    # 欄位依第一次出現的順序 (同 pd.DataFrame)
+    keys = list(dict.fromkeys(key for record in data if isinstance(record, dict) for key in record))
+    mapping = source.map_columns([str(key).strip() for key in keys])
+    if not mapping:
+        return None
+    selected = sorted(mapping.items(), key=lambda item: list(source.columns).index(item[1]))
+    records = [record for record in data if isinstance(record, dict)]
+    # 只取對應到的欄位建表，其餘欄位不會變成 DataFrame 欄
+    df = pd.DataFrame.from_records(records, columns=[keys[index] for index, _ in selected])
+    df.columns = [target for _, target in selected]
+    return df.fillna('')
+
+def _parse_csv(content, encoding, source):
+    # 欄位對應只看標題列 (在開頭的片段內)
+    head = content[:SNIFF_BYTES].decode(encoding, errors="ignore")
+    header = next(csv.reader(io.StringIO(head)), [])
+    if len(header) < 2:
+        return pd.DataFrame()
+    mapping = source.map_columns([column.strip() for column in header])
+    if not mapping:
+        return None
+    targets = [target for target in source.columns if target in mapping.values()]
+    # 由 pandas 直接串流解碼：整份內容不另外轉成字串，只保留對應到的欄位
+    # index_col=False：列尾多出欄位時不把第一欄當成索引
+    reader = pd.read_csv(io.BytesIO(content), encoding=encoding, usecols=sorted(mapping), dtype=str, index_col=False,
+                         keep_default_na=False, on_bad_lines="skip", chunksize=CSV_CHUNK_ROWS)
+    chunks = []
+    for chunk in reader:
+        chunk.columns = [mapping[index] for index in sorted(mapping)]
+        chunks.append(chunk[targets])
+    return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=targets)
+
+def parse_resource(content: bytes, source: ResourceSource):
+    """
+    解析資源內容 (整份只解析一次)：由開頭判斷格式與編碼，只保留 source 對應到的欄位，空值為 ''
+    :return: DataFrame；欄位對應失敗時回傳 None，無法解析時為空 DataFrame
+    """
+    fmt, encoding = sniff(content)
+    parse = _parse_json if fmt == "json" else _parse_csv
+    # 開頭判斷為 UTF-8、後段卻不是時 (極少見) 改用 cp950 重新解析
+    for candidate in dict.fromkeys([encoding, CSV_ENCODINGS[-1]]):
+        try:
+            return parse(content, candidate, source)
+        except (UnicodeDecodeError, ValueError):
+            continue
+    return pd.DataFrame()
+
 class PetResourcesCrawlerV11:
-    def __init__(self):
+    def __init__(self, raw_cache=None, replay=None, force=False):
+        """
+        :param raw_cache: RawResponseCache；未指定時使用預設目錄
+        :param replay: 重播模式 (預設依環境變數 FETCH_REPLAY)
+        :param force: 內容未變動時仍重新解析與寫入
+        """
         self.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
         }
+        self.raw_cache = raw_cache or RawResponseCache()
+        self.replay = FETCH_REPLAY if replay is None else replay
+        self.force = force
         init_db()
 
+    def _download(self, url):
+        """
+        下載原始內容 (條件式請求 + 內容雜湊比對)
+        :return: (content, changed, cache_key)；重播模式下快取沒有資料時 content 為 None
+        """
+        key = self.raw_cache.key(url)
+        if self.replay:
+            return self.raw_cache.load(key), True, key
+
+        headers = dict(self.headers, **self.raw_cache.conditional_headers(key))
+        response = requests.get(url, headers=headers, verify=False, timeout=30)
+        if response.status_code == 304:
+            return self.raw_cache.load(key), self.raw_cache.is_pending(key), key
+        response.raise_for_status()
+        changed = self.raw_cache.store(key, response.content, response.headers)
+        return response.content, changed, key
+
     def fetch_data_robust(self, url, name, target_columns_keywords):
         """
         最強韌的抓取函式 (V9核心)：同時支援 JSON/CSV，並具備自動欄位清洗功能
+        :return: DataFrame；內容與上次處理過的相同時回傳 None (不需解析與寫入)
         """
+        return self.fetch_source(ResourceSource(None, name, url, target_columns_keywords))
+
+    def fetch_source(self, source: ResourceSource):
+        """
+        下載並解析一個資源 (格式與編碼由內容開頭判斷，只解析一次)
+        :return: DataFrame (只含對應到的欄位，df.attrs[CACHE_KEY_ATTR] 為原始回應快取的 key)；
+            內容與上次處理過的相同時回傳 None (不需解析與寫入)
+        """
+        name = source.name
         print(f"📥 正在下載【{name}】...")
         try:
             # 嘗試加入 &IsOD=1 參數，有時候能抓到更多資料
+            url = source.url
             if "?" in url:
                 url += "&IsOD=1"
             else:
                 url += "?IsOD=1"
 
-            response = requests.get(url, headers=self.headers, verify=False, timeout=30)
-            
-            df = pd.DataFrame()
-            is_json = False
-
-            # 1. 嘗試當作 JSON 解析
-            try:
-                content_start = response.content[:10].decode('utf-8', errors='ignore').strip()
-                if content_start.startswith('[') or content_start.startswith('{'):
-                    json_data = response.json()
-                    df = pd.DataFrame(json_data)
-                    is_json = True
-            except:
-                pass
-
-            # 2. 如果失敗，嘗試當作 CSV 解析
-            if not is_json or df.empty:
-                content = response.content
-                encodings = ['utf-8', 'utf-8-sig', 'big5', 'cp950']
-                for enc in encodings:
-                    try:
-                        df = pd.read_csv(io.StringIO(content.decode(enc)), on_bad_lines='skip')
-                        if not df.empty and len(df.columns) > 1:
-                            break
-                    except:
-                        continue
-
-            if df.empty:
-                print(f"   ❌ {name} 讀取失敗")
+            content, changed, cache_key = self._download(url)
+            if content is None:
+                print(f"   ❌ {name} 快取中沒有資料 (重播模式)")
                 return pd.DataFrame()
-
-            # 清洗
-            df.columns = df.columns.str.strip()
-            final_col_map = {}
-            for target_key, keywords in target_columns_keywords.items():
-                for col in df.columns:
-                    if any(k in col for k in keywords):
-                        final_col_map[col] = target_key
-                        break
+            if not changed and not self.force:
+                print(f"   ⏭️ {name} 內容與上次相同，略過解析與寫入")
+                return None
             
-            if not final_col_map:
+            df = parse_resource(content, source)
+            if df is None:
                 print(f"   ⚠️ {name} 欄位對應失敗")
                 return pd.DataFrame()
+            if df.empty:
+                print(f"   ❌ {name} 讀取失敗")
+                return pd.DataFrame()
 
-            df.rename(columns=final_col_map, inplace=True)
-            found_cols = [c for c in final_col_map.values() if c in df.columns]
-            df = df[found_cols].fillna('')
-            
             print(f"   ✅ 成功讀取 {len(df)} 筆原始資料")
+            df.attrs[CACHE_KEY_ATTR] = cache_key
             return df
 
         except Exception as e:
@@ -85,30 +210,35 @@ class PetResourcesCrawlerV11:
             return pd.DataFrame()
 
     def get_vet_clinics(self):
-        url = "https://data.moa.gov.tw/Service/OpenData/DataFileService.aspx?UnitId=078"
-        keywords = {"name": ["機構名稱"], "tel": ["電話"], "address": ["地址"], "doctor_name": ["獸醫", "負責人"]}
+        df = self.fetch_source(VET_CLINICS)
 
-        df = self.fetch_data_robust(url, "動物醫院", keywords)
-
-        if not df.empty:
+        if df is not None and not df.empty:
             print(f"   🔨 正在生成 Google Maps 連結...")
-            df['google_map_link'] = df.apply(
-                lambda row: f"https://www.google.com/maps/search/?api=1&query={row['name']}", axis=1
-            )
+            # 整欄字串相加，不逐列呼叫 apply
+            df['google_map_link'] = "https://www.google.com/maps/search/?api=1&query=" + df['name'].astype(str)
         return df
 
-    def save_to_db(self, df, type_name):
-        if df.empty:
+    def save_to_db(self, df, type_name, cache_key=None):
+        """
+        寫入資料庫；成功後把這份內容標記為已處理
+        :param cache_key: 原始回應快取的 key (預設取 fetch_source 放在 df.attrs 的 key，沒有時不標記)
+        """
+        if df is None or df.empty:
             return
+        cache_key = cache_key or df.attrs.get(CACHE_KEY_ATTR)
             
         print(f"   💾 正在存入資料庫 ({type_name})...")
-        count = 0
-        for _, row in df.iterrows():
-            data = row.to_dict()
-            if type_name == 'vet':
-                upsert_clinic(data)
-                count += 1
-        print(f"   ✅ 已更新 {count} 筆 {type_name} 資料")
+        if type_name == 'vet':
+            # 整份快照一次寫入暫存表再套用差異，讀取端不會看到更新到一半的資料
+            diff = replace_clinics(df.to_dict(orient='records'))
+            if diff is None:
+                print(f"   ⚠️ {type_name} 資料未更新")
+                return
+            print(f"   ✅ 已更新 {len(df)} 筆 {type_name} 資料: 新增 {diff['added']} / 變動 {diff['changed']} / "
+                  f"移除 {diff['removed']} / 未變 {diff['unchanged']}")
+        if cache_key and not self.replay:
+            # 寫入成功才記錄，下次相同內容可直接略過
+            self.raw_cache.mark_applied(cache_key)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,71 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+class CachedResponse:
+    __slots__ = ("body", "media_type", "etag")
+
+    def __init__(self, body, media_type):
+        self.body = body
+        self.media_type = media_type
+        # 強 ETag：以回應內容計算
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+
+class ResponseCache:
+    """
+    以記憶體大小為上限的 LRU 回應快取
+    key 由呼叫端組成 (路徑 + 正規化查詢參數 + 資料世代)，資料世代變動後舊項目自然被淘汰
+    """
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body, media_type):
+        entry = CachedResponse(body, media_type)
+        if len(body) > self.max_bytes:
+            return entry  # 太大的回應不快取
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old.body)
+            self._entries[key] = entry
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.body)
+                self.evictions += 1
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
@@ -1,13 +1,66 @@
 
-from fastapi import FastAPI, Query
+from fastapi import FastAPI, Query, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, Response, FileResponse, RedirectResponse
+from starlette.concurrency import run_in_threadpool
 import uvicorn
+import json
+import os
+import re
+import time
+from datetime import date
 from typing import Optional
-from db import get_recent_pets, get_db_connection
+from db import iter_recent_pets, iter_clinics, pet_cursor, clinic_cursor, pool_stats, outbox_stats, get_generation
+from db import get_nearby_clinics, get_pet_location, get_pet_photo, get_pets_by_ids, find_matching_pets
+from db import get_stats as aggregate_stats, get_resolution_stats, get_pet_history
+from response_cache import ResponseCache
+import metrics
+import photos
+from matching import Sighting
+from pet_snapshot import snapshots as pet_snapshots, ENABLED as SNAPSHOT_ENABLED
+
+REQUEST_SECONDS = metrics.histogram("pet_http_request_duration_seconds",
+                                    "API 請求耗時 (到回應標頭送出為止)", ["method", "route", "status"])
 
 app = FastAPI(title="Pet Hunter API", description="搜集全台走失寵物資料", version="2.1")
 
-# 允許跨域
+# 回應快取：資料只在爬蟲同步後變動，相同查詢在同一資料世代內直接回傳
+CACHEABLE_PATHS = {"/pets", "/pets/match", "/clinics", "/clinics/nearby", "/stats", "/stats/resolution"}
+response_cache = ResponseCache(max_bytes=int(os.environ.get("RESPONSE_CACHE_MB", "32")) * 1024 * 1024)
+
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+@app.middleware("http")
+async def cache_responses(request: Request, call_next):
+    if request.method != "GET" or request.url.path not in CACHEABLE_PATHS:
+        return await call_next(request)
+
+    generation = await run_in_threadpool(get_generation)
+    # 端點可沿用 (例如 /pets 的記憶體快照)，不必再查一次
+    request.state.generation = generation
+    # 查詢參數排序後作為 key；加上日期，因為 days 視窗以今天為基準
+    key = (request.url.path, tuple(sorted(request.query_params.multi_items())),
+           generation, date.today().isoformat())
+
+    entry = response_cache.get(key)
+    if entry is None:
+        response = await call_next(request)
+        # 串流回應由端點標記 no-store (stream 參數的解析交給 FastAPI)，不緩衝也不快取
+        if response.status_code != 200 or "no-store" in response.headers.get("cache-control", ""):
+            return response
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        entry = response_cache.put(key, body, response.media_type or response.headers.get("content-type"))
+
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type=entry.media_type, headers=headers)
+
+# 允許跨域 (須在快取之後加入，才會包在最外層，快取命中的回應也帶 CORS header)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -16,94 +69,374 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_latency(request: Request, call_next):
+    # 最外層 (快取命中也計入)；metrics 停用時直接略過
+    if not metrics.ENABLED:
+        return await call_next(request)
+    start = time.perf_counter()
+    response = await call_next(request)
+    # 以路由樣板 (/pets/{pet_id}/nearby-clinics) 為標籤；快取命中時沒有經過路由，使用路徑
+    route = request.scope.get("route")
+    if route is not None:
+        path = route.path
+    elif request.url.path in CACHEABLE_PATHS:
+        path = request.url.path
+    else:
+        path = "unmatched"
+    REQUEST_SECONDS.observe(time.perf_counter() - start, method=request.method, route=path,
+                            status=response.status_code)
+    return response
+
 # 整合爬蟲 Daemon (For Render Free Tier)
+# 多個 web 行程時以租約選出唯一的爬蟲；另有獨立 worker (Procfile) 時設 RUN_CRAWLER=0 關閉
 import threading
-from pet_crawler_daemon import PetCrawlerDaemon
+from db import init_db, get_lease, get_meta
+# fetcher 的 pandas / httpx 延遲到第一次爬取才載入，import daemon 模組本身很輕
+from pet_crawler_daemon import PetCrawlerDaemon, LEASE_NAME, LAST_RUN_KEY, LAST_SUCCESS_KEY, schedule_status
 
-@app.on_event("startup")
-def startup_event():
-    print("🚀 Server starting... Launching Background Crawler...")
+RUN_CRAWLER = os.environ.get("RUN_CRAWLER", "1").lower() in ("1", "true", "yes", "on")
+# 嵌入時第一次爬取至少延後的秒數 (上次爬取距今未滿間隔時本來就不會立刻爬)
+EMBEDDED_CRAWL_DELAY = float(os.environ.get("CRAWL_STARTUP_DELAY", "60"))
+
+def _run_embedded_crawler():
     try:
-        daemon = PetCrawlerDaemon()
-        # 使用 daemon thread，主程式結束時它也會跟著結束
-        t = threading.Thread(target=daemon.start_daemon, daemon=True)
-        t.start()
+        daemon = PetCrawlerDaemon(startup_delay=EMBEDDED_CRAWL_DELAY)
         print("✅ Background Crawler started!")
+        daemon.start_daemon()
     except Exception as e:
         print(f"❌ Failed to start crawler: {e}")
 
+@app.on_event("startup")
+def startup_event():
+    # 結構已是最新版本時只讀一次 user_version
+    init_db()
+    # Open 案件快照在背景建立；建好之前 /pets 照常查 SQLite
+    if SNAPSHOT_ENABLED:
+        pet_snapshots.refresh_async()
+    if not RUN_CRAWLER:
+        print("🚀 Server starting... (RUN_CRAWLER=0，爬蟲由獨立 worker 執行)")
+        return
+    print("🚀 Server starting... Launching Background Crawler...")
+    # 爬蟲的初始化在背景執行緒進行，不延遲第一個請求
+    # 使用 daemon thread，主程式結束時它也會跟著結束
+    threading.Thread(target=_run_embedded_crawler, daemon=True, name="crawler").start()
+
 @app.get("/")
 def home():
     return {"message": "Welcome to Pet Hunter API v2.0 - Use /pets to search"}
 
+MAX_PAGE_SIZE = 1000
+
+def _paged_response(make_rows, limit, cursor_fn, stream):
+    """
+    共用的分頁輸出：多抓一筆判斷是否還有下一頁
+    stream=True 時邊讀 cursor 邊編碼 JSON，不在記憶體中組出整份結果
+    """
+    try:
+        rows = make_rows(limit + 1 if limit else None)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if not stream:
+        data = list(rows)
+        next_cursor = None
+        if limit and len(data) > limit:
+            data = data[:limit]
+            next_cursor = cursor_fn(data[-1])
+        return {
+            "count": len(data),
+            "data": data,
+            "next_cursor": next_cursor
+        }
+
+    def generate():
+        count = 0
+        last = None
+        next_cursor = None
+        yield '{"data":['
+        for row in rows:
+            if limit and count == limit:
+                next_cursor = cursor_fn(last)
+                break
+            yield ("," if count else "") + json.dumps(row, ensure_ascii=False)
+            last = row
+            count += 1
+        yield f'],"count":{count},"next_cursor":{json.dumps(next_cursor)}}}'
+
+    return StreamingResponse(generate(), media_type="application/json", headers={"Cache-Control": "no-store"})
+
 @app.get("/pets")
 def search_pets(
+    request: Request,
     city: Optional[str] = Query(None, description="縣市篩選 (e.g. 台北)"),
+    district: Optional[str] = Query(None, description="鄉鎮區篩選 (e.g. 大安)"),
     type: Optional[str] = Query(None, description="種類篩選 (e.g. 狗, 貓)"),
-    days: int = Query(14, description="搜尋最近幾天 (預設14)")
+    days: int = Query(14, description="搜尋最近幾天 (預設14)"),
+    status: str = Query("Open", pattern="^(Open|Close)$", description="案件狀態：Open (協尋中) / Close (已關閉，查封存表)"),
+    q: Optional[str] = Query(None, description="關鍵字搜尋 名字/品種/毛色/地點/種類 (空白分隔多個詞)"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE, description="每頁筆數 (不填則回傳全部)"),
+    cursor: Optional[str] = Query(None, description="上一頁回傳的 next_cursor"),
+    fields: Optional[str] = Query(None, description="只回傳指定欄位 (逗號分隔，e.g. id,pet_name,lost_time)"),
+    stream: bool = Query(False, description="以串流方式輸出 JSON")
+):
+    """
+    搜尋走失寵物 (依遺失時間由新到舊，支援 keyset 分頁)
+    Open 案件且沒有關鍵字時由記憶體快照回答，其餘查 SQLite
+    """
+    def rows(n):
+        if status == "Open" and not q:
+            # 沿用回應快取 middleware 查到的資料世代，快照查詢不經 SQLite
+            data = pet_snapshots.query(generation=getattr(request.state, "generation", None),
+                                       days=days, city_filter=city, type_filter=type, fields=fields,
+                                       cursor=cursor, limit=n, district_filter=district)
+            if data is not None:
+                return data
+        return iter_recent_pets(days=days, city_filter=city, type_filter=type, status=status, q=q,
+                                fields=fields, cursor=cursor, limit=n, district_filter=district)
+
+    return _paged_response(rows, limit, pet_cursor, stream)
+
+@app.get("/clinics")
+def search_clinics(
+    city: Optional[str] = Query(None, description="縣市篩選 (e.g. 台北)"),
+    district: Optional[str] = Query(None, description="鄉鎮區篩選 (e.g. 大安)"),
+    q: Optional[str] = Query(None, description="關鍵字搜尋 醫院名稱/地址 (空白分隔多個詞)"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE, description="每頁筆數 (不填則回傳全部)"),
+    cursor: Optional[str] = Query(None, description="上一頁回傳的 next_cursor"),
+    fields: Optional[str] = Query(None, description="只回傳指定欄位 (逗號分隔，e.g. id,name,tel)"),
+    stream: bool = Query(False, description="以串流方式輸出 JSON")
 ):
     """
-    搜尋走失寵物
+    搜尋動物醫院 (依 id 排序，支援 keyset 分頁)
     """
-    pets = get_recent_pets(days=days, city_filter=city, type_filter=type)
+    return _paged_response(
+        lambda n: iter_clinics(city_filter=city, q=q, fields=fields, cursor=cursor, limit=n,
+                               district_filter=district),
+        limit, clinic_cursor, stream
+    )
+
+MAX_NEARBY_RADIUS_KM = 50
+
+def _nearby_response(lat, lon, radius, limit, fields):
+    try:
+        data = get_nearby_clinics(lat, lon, radius_km=radius, limit=limit, fields=fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {
-        "count": len(pets),
-        "data": pets
+        "center": {"lat": lat, "lon": lon},
+        "radius_km": radius,
+        "count": len(data),
+        "data": data
     }
 
-@app.get("/clinics")
-def search_clinics(city: Optional[str] = Query(None)):
-    """
-    搜尋動物醫院
-    """
-    conn = get_db_connection()
-    c = conn.cursor()
-    query = "SELECT * FROM vet_clinics"
-    params = []
-    
-    if city:
-        query += " WHERE address LIKE ?"
-        params.append(f"%{city}%")
-        
-    c.execute(query, params)
-    rows = c.fetchall()
-    conn.close()
-    
+@app.get("/clinics/nearby")
+def search_nearby_clinics(
+    lat: float = Query(..., ge=-90, le=90, description="緯度"),
+    lon: float = Query(..., ge=-180, le=180, description="經度"),
+    radius: float = Query(5.0, gt=0, le=MAX_NEARBY_RADIUS_KM, description="搜尋半徑 (公里)"),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE, description="最多筆數"),
+    fields: Optional[str] = Query(None, description="只回傳指定欄位 (逗號分隔)")
+):
+    """
+    附近的動物醫院 (依距離由近到遠，座標為鄉鎮區代表點)
+    """
+    return _nearby_response(lat, lon, radius, limit, fields)
+
+@app.get("/pets/{pet_id}/nearby-clinics")
+def pet_nearby_clinics(
+    pet_id: str,
+    radius: float = Query(5.0, gt=0, le=MAX_NEARBY_RADIUS_KM, description="搜尋半徑 (公里)"),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE, description="最多筆數"),
+    fields: Optional[str] = Query(None, description="只回傳指定欄位 (逗號分隔)")
+):
+    """
+    走失地點附近的動物醫院
+    """
+    pet = get_pet_location(pet_id)
+    if pet is None:
+        raise HTTPException(status_code=404, detail="查無此案件")
+    if pet["lat"] is None:
+        raise HTTPException(status_code=422, detail=f"無法判斷走失地點座標: {pet['lost_place']}")
+    result = _nearby_response(pet["lat"], pet["lon"], radius, limit, fields)
+    result["pet"] = pet
+    return result
+
+MAX_PHOTO_DISTANCE = 16
+SIMILAR_FIELDS = "pet_name,pet_type,breed,color,lost_place,lost_time,status,created_at"
+thumbnails = photos.ThumbnailStore()
+
+def _thumbnail_url(digest):
+    return f"/photos/{digest}.jpg" if digest else None
+
+@app.get("/pets/{pet_id}/similar")
+def similar_pets(
+    pet_id: str,
+    max_distance: int = Query(photos.DUPLICATE_DISTANCE, ge=0, le=MAX_PHOTO_DISTANCE,
+                              description="照片雜湊最多相差幾個位元 (越小越嚴格)"),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE, description="最多筆數")
+):
+    """
+    照片相似的其他案件 (可能是同一隻動物重複刊登)，依相似程度排序
+    """
+    if not photos.available():
+        raise HTTPException(status_code=503, detail="照片索引未啟用 (未安裝 Pillow)")
+    photo = get_pet_photo(pet_id)
+    if photo is None:
+        raise HTTPException(status_code=404, detail="查無此案件")
+    if photo["phash"] is None:
+        raise HTTPException(status_code=422, detail=photo["error"] or "此案件的照片尚未建立索引")
+    photos.index.refresh()
+    matches = [(other, distance) for other, distance in photos.index.lookup(photo["phash"], max_distance)
+               if other != pet_id][:limit]
+    pets = get_pets_by_ids([other for other, _ in matches], fields=SIMILAR_FIELDS)
+    data = [dict(pets[other], distance=distance, thumbnail_url=_thumbnail_url(photos.index.digest(other)))
+            for other, distance in matches if other in pets]
     return {
-        "count": len(rows),
-        "data": [dict(r) for r in rows]
+        "pet": {"id": pet_id, "picture_url": photo["picture_url"], "thumbnail_url": _thumbnail_url(photo["sha256"])},
+        "max_distance": max_distance,
+        "count": len(data),
+        "data": data
     }
 
-@app.get("/stats")
-def get_stats(days: int = Query(30, description="統計最近幾天 (預設30)")):
-    """
-    取得統計數據
-    """
-    from datetime import datetime, timedelta
-    cutoff_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
-    
-    conn = get_db_connection()
-    c = conn.cursor()
-    
-    # 統計總數 (加上 lost_time >= cutoff_date)
-    c.execute("SELECT COUNT(*) FROM lost_pets WHERE status='Open' AND lost_time >= ?", (cutoff_date,))
-    total_open = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM lost_pets WHERE status='Open' AND pet_type LIKE '%狗%' AND lost_time >= ?", (cutoff_date,))
-    dogs = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM lost_pets WHERE status='Open' AND pet_type LIKE '%貓%' AND lost_time >= ?", (cutoff_date,))
-    cats = c.fetchone()[0]
-    
-    conn.close()
-    
+_DIGEST = re.compile(r"^[0-9a-f]{64}$")
+
+@app.get("/photos/{digest}.jpg")
+def get_thumbnail(digest: str):
+    """
+    案件照片縮圖 (以原圖內容雜湊命名，內容不會變動)
+    """
+    if not _DIGEST.match(digest) or not thumbnails.exists(digest):
+        raise HTTPException(status_code=404, detail="查無此縮圖")
+    return FileResponse(thumbnails.path(digest), media_type="image/jpeg",
+                        headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+@app.get("/pets/{pet_id}/thumbnail")
+def pet_thumbnail(pet_id: str):
+    """
+    案件目前照片的縮圖；尚未建立縮圖時轉址到原圖
+    """
+    photo = get_pet_photo(pet_id)
+    if photo is None or not photo["picture_url"]:
+        raise HTTPException(status_code=404, detail="此案件沒有照片")
+    if photo["sha256"] and photo["photo_url"] == photo["picture_url"] and thumbnails.exists(photo["sha256"]):
+        return RedirectResponse(_thumbnail_url(photo["sha256"]), status_code=302)
+    return RedirectResponse(photo["picture_url"], status_code=302)
+
+@app.get("/pets/{pet_id}/history")
+def pet_history(pet_id: str):
+    """
+    案件的狀態變更紀錄 (opened / closed / reopened，由舊到新)
+    """
+    history = get_pet_history(pet_id)
+    if history is None:
+        raise HTTPException(status_code=404, detail="查無此案件")
+    return history
+
+MAX_MATCH_RADIUS_KM = 50
+MAX_MATCH_DAYS = 180
+
+@app.get("/pets/match")
+def match_pets(
+    type: str = Query(..., description="種類 (狗 / 貓)"),
+    breed: Optional[str] = Query(None, description="品種 (e.g. 柴犬、米克斯)"),
+    color: Optional[str] = Query(None, description="毛色 (e.g. 黑白、虎斑)"),
+    sex: Optional[str] = Query(None, description="性別 (公 / 母)"),
+    location: Optional[str] = Query(None, description="拾獲地點 (e.g. 台北市大安區)；或改給 lat / lon"),
+    lat: Optional[float] = Query(None, ge=-90, le=90, description="拾獲地點緯度"),
+    lon: Optional[float] = Query(None, ge=-180, le=180, description="拾獲地點經度"),
+    seen_on: Optional[date] = Query(None, alias="date", description="拾獲日期 YYYY-MM-DD (預設今天)"),
+    radius: float = Query(10.0, gt=0, le=MAX_MATCH_RADIUS_KM, description="走失地點距離上限 (公里，以鄉鎮區代表點計)"),
+    days: int = Query(30, ge=1, le=MAX_MATCH_DAYS, description="走失日期最多早於拾獲日期幾天"),
+    limit: int = Query(20, ge=1, le=100, description="最多筆數")
+):
+    """
+    拾獲動物比對：依品種、毛色、性別、距離與走失日期計分，回傳可能相符的 Open 走失案件
+    """
+    try:
+        sighting = Sighting(type, breed=breed, color=color, sex=sex, location=location, lat=lat, lon=lon,
+                            seen_on=seen_on, radius_km=radius, days_back=days)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    data, candidates = find_matching_pets(sighting, limit=limit)
     return {
-        "days": days,
-        "total_active_cases": total_open,
-        "dogs": dogs,
-        "cats": cats,
-        "others": total_open - dogs - cats
+        "sighting": {"type": sighting.pet_type, "breed": sighting.breed or None, "colors": sorted(sighting.colors),
+                     "sex": sighting.sex or None, "lat": sighting.lat, "lon": sighting.lon,
+                     "date": sighting.seen_on},
+        "candidates": candidates,
+        "count": len(data),
+        "data": data
     }
 
+@app.get("/stats")
+def get_stats(
+    days: int = Query(30, description="統計最近幾天 (預設30)"),
+    breakdown: Optional[str] = Query(None, description="額外細項，逗號分隔：city (各縣市), day (每日)")
+):
+    """
+    取得統計數據 (由預先彙總的統計表加總)
+    """
+    parts = tuple(p.strip() for p in breakdown.split(",")) if breakdown else ()
+    return aggregate_stats(days=days, breakdown=parts)
+
+@app.get("/stats/resolution")
+def get_resolution(
+    days: int = Query(90, description="統計最近幾天內關閉的案件 (預設90)"),
+    breakdown: Optional[str] = Query(None, description="額外細項，逗號分隔：type (各種類), city (各縣市)")
+):
+    """
+    結案時間統計：從開啟到關閉經過的天數 (平均、中位數、P90)
+    """
+    parts = tuple(p.strip() for p in breakdown.split(",")) if breakdown else ()
+    return get_resolution_stats(days=days, breakdown=parts)
+
+@app.get("/stats/pool")
+def get_pool_stats():
+    """
+    資料庫連線池統計 (用於調整 DB_READ_POOL_SIZE)
+    """
+    return pool_stats()
+
+@app.get("/stats/cache")
+def get_cache_stats():
+    """
+    回應快取統計 (命中/未命中/淘汰次數)
+    """
+    return dict(response_cache.stats(), generation=get_generation())
+
+@app.get("/stats/snapshot")
+def get_snapshot_stats():
+    """
+    Open 案件記憶體快照統計 (筆數、記憶體用量、命中/改查 SQLite 次數)
+    """
+    return pet_snapshots.stats()
+
+@app.get("/stats/notifications")
+def get_notification_stats():
+    """
+    通知外寄佇列指標 (佇列深度、投遞延遲)
+    """
+    return outbox_stats()
+
+@app.get("/stats/crawler")
+def get_crawler_stats():
+    """
+    爬蟲狀態 (目前持有租約的行程、上次執行 / 成功時間、自適應排程的目前間隔、下次預計執行時間與最近的決策)
+    """
+    lease = get_lease(LEASE_NAME)
+    return dict({
+        "leader": lease["holder"] if lease and lease["expires_at"] > time.time() else None,
+        "lease": lease,
+        "last_run_at": get_meta(LAST_RUN_KEY),
+        "last_success_at": get_meta(LAST_SUCCESS_KEY),
+    }, **schedule_status())
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    """
+    Prometheus 指標 (API 延遲、db 函式與 SQL 耗時、爬取各階段耗時、外部服務錯誤)
+    """
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,193 @@
+import re
+
+# 全台 22 縣市 / 368 鄉鎮市區 (內政部行政區劃，一律使用「臺」)
+DIVISIONS = {
+    "臺北市": ["中正區", "大同區", "中山區", "松山區", "大安區", "萬華區", "信義區", "士林區",
+              "北投區", "內湖區", "南港區", "文山區"],
+    "新北市": ["板橋區", "新莊區", "中和區", "永和區", "土城區", "樹林區", "三峽區", "鶯歌區",
+              "三重區", "蘆洲區", "五股區", "泰山區", "林口區", "八里區", "淡水區", "三芝區",
+              "石門區", "金山區", "萬里區", "汐止區", "瑞芳區", "貢寮區", "平溪區", "雙溪區",
+              "新店區", "深坑區", "石碇區", "坪林區", "烏來區"],
+    "基隆市": ["仁愛區", "信義區", "中正區", "中山區", "安樂區", "暖暖區", "七堵區"],
+    "桃園市": ["桃園區", "中壢區", "平鎮區", "八德區", "楊梅區", "蘆竹區", "大溪區", "龍潭區",
+              "龜山區", "大園區", "觀音區", "新屋區", "復興區"],
+    "新竹市": ["東區", "北區", "香山區"],
+    "新竹縣": ["竹北市", "竹東鎮", "新埔鎮", "關西鎮", "湖口鄉", "新豐鄉", "峨眉鄉", "寶山鄉",
+              "北埔鄉", "芎林鄉", "橫山鄉", "尖石鄉", "五峰鄉"],
+    "苗栗縣": ["苗栗市", "頭份市", "竹南鎮", "後龍鎮", "通霄鎮", "苑裡鎮", "卓蘭鎮", "造橋鄉",
+              "西湖鄉", "頭屋鄉", "公館鄉", "銅鑼鄉", "三義鄉", "大湖鄉", "獅潭鄉", "三灣鄉",
+              "南庄鄉", "泰安鄉"],
+    "臺中市": ["中區", "東區", "南區", "西區", "北區", "北屯區", "西屯區", "南屯區",
+              "太平區", "大里區", "霧峰區", "烏日區", "豐原區", "后里區", "石岡區", "東勢區",
+              "和平區", "新社區", "潭子區", "大雅區", "神岡區", "大肚區", "沙鹿區", "龍井區",
+              "梧棲區", "清水區", "大甲區", "外埔區", "大安區"],
+    "彰化縣": ["彰化市", "員林市", "和美鎮", "鹿港鎮", "溪湖鎮", "二林鎮", "田中鎮", "北斗鎮",
+              "花壇鄉", "芬園鄉", "大村鄉", "永靖鄉", "伸港鄉", "線西鄉", "福興鄉", "秀水鄉",
+              "埔心鄉", "埔鹽鄉", "大城鄉", "芳苑鄉", "竹塘鄉", "社頭鄉", "二水鄉", "田尾鄉",
+              "埤頭鄉", "溪州鄉"],
+    "南投縣": ["南投市", "埔里鎮", "草屯鎮", "竹山鎮", "集集鎮", "名間鄉", "鹿谷鄉", "中寮鄉",
+              "魚池鄉", "國姓鄉", "水里鄉", "信義鄉", "仁愛鄉"],
+    "雲林縣": ["斗六市", "斗南鎮", "虎尾鎮", "西螺鎮", "土庫鎮", "北港鎮", "古坑鄉", "大埤鄉",
+              "莿桐鄉", "林內鄉", "二崙鄉", "崙背鄉", "麥寮鄉", "東勢鄉", "褒忠鄉", "臺西鄉",
+              "元長鄉", "四湖鄉", "口湖鄉", "水林鄉"],
+    "嘉義市": ["東區", "西區"],
+    "嘉義縣": ["太保市", "朴子市", "布袋鎮", "大林鎮", "民雄鄉", "溪口鄉", "新港鄉", "六腳鄉",
+              "東石鄉", "義竹鄉", "鹿草鄉", "水上鄉", "中埔鄉", "竹崎鄉", "梅山鄉", "番路鄉",
+              "大埔鄉", "阿里山鄉"],
+    "臺南市": ["中西區", "東區", "南區", "北區", "安平區", "安南區", "永康區", "歸仁區",
+              "新化區", "左鎮區", "玉井區", "楠西區", "南化區", "仁德區", "關廟區", "龍崎區",
+              "官田區", "麻豆區", "佳里區", "西港區", "七股區", "將軍區", "學甲區", "北門區",
+              "新營區", "後壁區", "白河區", "東山區", "六甲區", "下營區", "柳營區", "鹽水區",
+              "善化區", "大內區", "山上區", "新市區", "安定區"],
+    "高雄市": ["楠梓區", "左營區", "鼓山區", "三民區", "鹽埕區", "前金區", "新興區", "苓雅區",
+              "前鎮區", "旗津區", "小港區", "鳳山區", "大寮區", "鳥松區", "林園區", "仁武區",
+              "大樹區", "大社區", "岡山區", "路竹區", "橋頭區", "梓官區", "彌陀區", "永安區",
+              "燕巢區", "田寮區", "阿蓮區", "茄萣區", "湖內區", "旗山區", "美濃區", "內門區",
+              "杉林區", "甲仙區", "六龜區", "茂林區", "桃源區", "那瑪夏區"],
+    "屏東縣": ["屏東市", "潮州鎮", "東港鎮", "恆春鎮", "萬丹鄉", "長治鄉", "麟洛鄉", "九如鄉",
+              "里港鄉", "鹽埔鄉", "高樹鄉", "萬巒鄉", "內埔鄉", "竹田鄉", "新埤鄉", "枋寮鄉",
+              "新園鄉", "崁頂鄉", "林邊鄉", "南州鄉", "佳冬鄉", "琉球鄉", "車城鄉", "滿州鄉",
+              "枋山鄉", "霧臺鄉", "瑪家鄉", "泰武鄉", "來義鄉", "春日鄉", "獅子鄉", "牡丹鄉",
+              "三地門鄉"],
+    "宜蘭縣": ["宜蘭市", "羅東鎮", "蘇澳鎮", "頭城鎮", "礁溪鄉", "壯圍鄉", "員山鄉", "冬山鄉",
+              "五結鄉", "三星鄉", "大同鄉", "南澳鄉"],
+    "花蓮縣": ["花蓮市", "鳳林鎮", "玉里鎮", "新城鄉", "吉安鄉", "壽豐鄉", "光復鄉", "豐濱鄉",
+              "瑞穗鄉", "富里鄉", "秀林鄉", "萬榮鄉", "卓溪鄉"],
+    "臺東縣": ["臺東市", "成功鎮", "關山鎮", "卑南鄉", "鹿野鄉", "池上鄉", "東河鄉", "長濱鄉",
+              "太麻里鄉", "大武鄉", "綠島鄉", "海端鄉", "延平鄉", "金峰鄉", "達仁鄉", "蘭嶼鄉"],
+    "澎湖縣": ["馬公市", "湖西鄉", "白沙鄉", "西嶼鄉", "望安鄉", "七美鄉"],
+    "金門縣": ["金城鎮", "金湖鎮", "金沙鎮", "金寧鄉", "烈嶼鄉", "烏坵鄉"],
+    "連江縣": ["南竿鄉", "北竿鄉", "莒光鄉", "東引鄉"],
+}
+
+# 舊縣市名 (升格 / 合併前) -> 現行縣市
+CITY_ALIASES = {
+    "臺北縣": "新北市",
+    "桃園縣": "桃園市",
+    "臺中縣": "臺中市",
+    "臺南縣": "臺南市",
+    "高雄縣": "高雄市",
+}
+
+# 省略「市/縣」的簡稱 (e.g. 台北、高雄)；新竹、嘉義市縣同名，由鄉鎮區判斷
+_SHORT_NAMES = {}
+for _city in DIVISIONS:
+    _SHORT_NAMES.setdefault(_city[:2], []).append(_city)
+
+_SUFFIXES = "區鄉鎮市"
+
+def _stem(name):
+    """去掉行政區尾字 (大安區 -> 大安)；兩字的區名 (東區) 保留原樣"""
+    return name[:-1] if len(name) > 2 and name[-1] in _SUFFIXES else name
+
+# 每個縣市的鄉鎮區比對表：全名與去尾字的名稱都可對應 (舊制「板橋市」-> 板橋區)
+_DISTRICT_LOOKUP = {}
+for _city, _districts in DIVISIONS.items():
+    lookup = {}
+    for _d in _districts:
+        lookup[_d] = _d
+        lookup[_stem(_d)] = _d
+    _DISTRICT_LOOKUP[_city] = lookup
+
+# 全國唯一的鄉鎮區全名 -> 縣市 (地址沒寫縣市時使用)
+_UNIQUE_DISTRICTS = {}
+_seen = {}
+for _city, _districts in DIVISIONS.items():
+    for _d in _districts:
+        _seen.setdefault(_d, []).append(_city)
+for _d, _cities in _seen.items():
+    if len(_cities) == 1:
+        _UNIQUE_DISTRICTS[_d] = _cities[0]
+
+# 全國唯一的鄉鎮區簡稱 (e.g. 石碇、六甲)；只在字串開頭比對，避免誤判路名
+_UNIQUE_STEMS = {}
+_stem_seen = {}
+for _city, _districts in DIVISIONS.items():
+    for _d in _districts:
+        if _stem(_d) != _d:
+            _stem_seen.setdefault(_stem(_d), []).append((_city, _d))
+for _s, _matches in _stem_seen.items():
+    if len(_matches) == 1:
+        _UNIQUE_STEMS[_s] = _matches[0]
+
+def _alternation(names):
+    return "|".join(re.escape(n) for n in sorted(names, key=len, reverse=True))
+
+_CITY_RE = re.compile(_alternation(list(DIVISIONS) + list(CITY_ALIASES) + list(_SHORT_NAMES)))
+_UNIQUE_DISTRICT_RE = re.compile(_alternation(_UNIQUE_DISTRICTS))
+_UNIQUE_STEM_RE = re.compile(_alternation(_UNIQUE_STEMS))
+_DISTRICT_RES = {city: re.compile(_alternation(lookup)) for city, lookup in _DISTRICT_LOOKUP.items()}
+
+def normalize_text(text):
+    """統一 台/臺 與空白"""
+    if text is None or (isinstance(text, float) and text != text):
+        return ""
+    return re.sub(r"\s+", "", str(text)).replace("台", "臺")
+
+def _match_district(city, rest):
+    """從縣市名稱之後的字串開頭比對鄉鎮區 (略過郵遞區號等雜訊)"""
+    rest = rest.lstrip("0123456789()（）-,，、")
+    m = _DISTRICT_RES[city].match(rest)
+    return _DISTRICT_LOOKUP[city][m.group(0)] if m else None
+
+def parse_location(text):
+    """
+    解析地址或地點描述中的縣市與鄉鎮區 (離線，不需外部服務)
+    :return: (city, district)；無法判斷的部分為 None
+    """
+    s = normalize_text(text)
+    if not s:
+        return None, None
+
+    m = _CITY_RE.search(s)
+    if m:
+        name = m.group(0)
+        rest = s[m.end():]
+        if name in DIVISIONS:
+            return name, _match_district(name, rest)
+        if name in CITY_ALIASES:
+            city = CITY_ALIASES[name]
+            return city, _match_district(city, rest)
+        # 簡稱：市縣同名時，以能對到鄉鎮區的那個為準
+        # 簡稱也可能其實是縣轄市的開頭 (e.g.「南投市」「臺東市」)
+        candidates = _SHORT_NAMES[name]
+        for city in candidates:
+            district = _match_district(city, rest) or _match_district(city, s[m.start():])
+            if district:
+                return city, district
+        return (candidates[0] if len(candidates) == 1 else None), None
+
+    # 沒寫縣市：用全國唯一的鄉鎮區名稱反推
+    m = _UNIQUE_DISTRICT_RE.search(s)
+    if m:
+        district = m.group(0)
+        return _UNIQUE_DISTRICTS[district], district
+    m = _UNIQUE_STEM_RE.match(s)
+    if m:
+        return _UNIQUE_STEMS[m.group(0)]
+    return None, None
+
+def city_candidates(value):
+    """
+    將縣市查詢參數轉成現行縣市全名清單
+    e.g. 台北 -> [臺北市]、臺中縣 -> [臺中市]、新竹 -> [新竹市, 新竹縣]；無法辨識回傳 []
+    """
+    s = normalize_text(value)
+    if s in DIVISIONS:
+        return [s]
+    if s in CITY_ALIASES:
+        return [CITY_ALIASES[s]]
+    return list(_SHORT_NAMES.get(s, []))
+
+def district_candidates(value, city=None):
+    """將鄉鎮區查詢參數 (大安 / 大安區) 轉成可能的正式名稱清單"""
+    s = normalize_text(value)
+    if not s:
+        return []
+    cities = [city] if city in DIVISIONS else list(DIVISIONS)
+    names = set()
+    for c in cities:
+        lookup = _DISTRICT_LOOKUP[c]
+        if s in lookup:
+            names.add(lookup[s])
+    return sorted(names)